@@ -6,7 +6,10 @@ from functools import wraps
 from core.util.problem_detail import ProblemDetail
 from core.util.flask_util import problem
 from config import Configuration
-from controller import ContentServer
+from controller import (
+    BulkURNLookupController,
+    ContentServer,
+)
 
 import flask
 from flask import Flask, url_for, redirect, Response
@@ -15,10 +18,7 @@ from flask.ext.babel import Babel
 from opds import ContentServerAnnotator
 from core.opds import AcquisitionFeed
 from core.util.flask_util import languages_for_request
-from core.app_server import (
-    URNLookupController,
-    HeartbeatController,
-)
+from core.app_server import HeartbeatController
 from core.log import LogConfiguration
 
 app = Flask(__name__)
@@ -74,9 +74,14 @@ def feed_from_license_source(license_source_name):
 def feed_from_custom_list(list_identifier):
     return app.content_server.opds_feeds.custom_list_feed(list_identifier)
 
+@app.route('/crawlable')
+@returns_problem_detail
+def bulk_export():
+    return app.content_server.opds_feeds.bulk_export()
+
 @app.route('/lookup')
 def lookup():
-    return URNLookupController(app.content_server._db).work_lookup(ContentServerAnnotator)
+    return BulkURNLookupController(app.content_server._db).work_lookup(ContentServerAnnotator)
 
 # Controllers used for operations purposes
 @app.route('/heartbeat')
@@ -84,6 +89,11 @@ def lookup():
 def hearbeat():
     return HeartbeatController().heartbeat()
 
+@app.route('/cache_stats')
+@returns_problem_detail
+def cache_stats():
+    return app.content_server.operations.cache_stats()
+
 if __name__ == '__main__':
     debug = True
     url = Configuration.integration_url(
@@ -1,7 +1,28 @@
 from nose.tools import set_trace
+import base64
+import cPickle
+import datetime
+import hashlib
+import json
 import logging
 import sys
+import time
+import zlib
+from collections import defaultdict
 import flask
+from lxml import etree
+from sqlalchemy import (
+    and_,
+    func,
+    inspect,
+    or_,
+    tuple_,
+)
+from sqlalchemy.orm import (
+    aliased,
+    joinedload,
+)
+from werkzeug.http import http_date
 from core.util.flask_util import languages_for_request
 
 from core.problem_details import *
@@ -21,21 +42,28 @@ from core.app_server import (
     load_facets,
     load_pagination,
     HeartbeatController,
+    URNLookupController,
 )
 
 from core.model import (
     production_session,
+    Contribution,
     CustomList,
     DataSource,
-    Library
+    Edition,
+    Identifier,
+    Library,
+    LicensePool,
+    Work,
 )
 from core.lane import (
     Lane,
     Facets,
     Pagination,
 )
-from core.opds import AcquisitionFeed
+from core.opds import OPDSFeed
 from opds import (
+    ContentServerAcquisitionFeed,
     ContentServerAnnotator,
 )
 
@@ -56,22 +84,198 @@ class ContentServer(object):
             _db = production_session()
             Configuration.load(_db)
         self._db = _db
+        if self._db is not None:
+            ContentServerAnnotator.watch_session(self._db)
         self.testing = testing
 
         self.setup_controllers()
 
     def setup_controllers(self):
         """Set up all the controllers that will be used by the web app."""
+        self.lookups = LookupCache(self._db)
+
         self.opds_feeds = OPDSFeedController(self)
+        self.operations = OperationsController(self)
 
         self.heartbeat = HeartbeatController()
 
 
+class ExpiringCache(object):
+    """A simple in-memory cache whose entries expire after a fixed
+    number of seconds.
+    """
+
+    def __init__(self, ttl, max_size=None, clock=time.time):
+        """Constructor.
+
+        :param ttl: Entries expire after this many seconds.
+        :param max_size: Hold at most this many entries. When the
+            cache is full, the entry closest to expiring is dropped.
+        :param clock: A function returning the current time in
+            seconds, for use in tests.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry:
+            expires, value = entry
+            if expires > self.clock():
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        now = self.clock()
+        if (self.max_size and key not in self.entries
+            and len(self.entries) >= self.max_size):
+            self.prune(now)
+        self.entries[key] = (now + self.ttl, value)
+
+    def prune(self, now):
+        """Make room for one more entry."""
+        for key, (expires, value) in self.entries.items():
+            if expires <= now:
+                del self.entries[key]
+        if len(self.entries) >= self.max_size:
+            expires, key = min(
+                (expires, key) for key, (expires, value)
+                in self.entries.items()
+            )
+            del self.entries[key]
+
+    def clear(self):
+        self.entries = {}
+
+    def stats(self):
+        return dict(size=len(self.entries), hits=self.hits, misses=self.misses)
+
+
+class LookupCache(object):
+    """Keep the small, rarely-changing objects every request needs --
+    the default Library and DataSources -- for the life of the
+    process, so a request doesn't have to look them up again.
+
+    The database session is committed (and its objects expired) after
+    every request, so the cache holds detached copies and merges them
+    into the session without a query. Changes made elsewhere show up
+    after CACHE_TIME, or as soon as invalidate() is called.
+
+    CustomLists change more often, and their update time is part of
+    a feed's ETag, so only their primary keys are cached and the
+    rows themselves are always loaded fresh.
+    """
+
+    # Cached objects are looked up again after this many seconds, so
+    # changes made elsewhere show up eventually.
+    CACHE_TIME = 300
+
+    def __init__(self, _db, ttl=None):
+        self._db = _db
+        self.cache = ExpiringCache(ttl or self.CACHE_TIME)
+
+    def get(self, key, lookup):
+        """Find a cached object, or look it up and cache it.
+
+        :param key: A hashable key identifying the object.
+        :param lookup: A function that finds the object in the
+            database. If it returns None, nothing is cached, so an
+            object that doesn't exist yet will be found once it does.
+        :return: An object attached to the current session, or None.
+        """
+        cached = self.cache.get(key)
+        if cached is not None:
+            # If the session already has this object, use it as is,
+            # rather than copying the cached state over any changes
+            # made to it.
+            obj = self._db.identity_map.get(inspect(cached).key)
+            if obj is not None:
+                return obj
+            return self._db.merge(cached, load=False)
+
+        obj = lookup()
+        if obj is None:
+            return None
+        if obj in self._db.new or obj in self._db.dirty:
+            self._db.flush()
+        if inspect(obj).expired_attributes:
+            self._db.refresh(obj)
+        self.cache.set(key, cPickle.loads(cPickle.dumps(obj, -1)))
+        return obj
+
+    def get_by_id(self, key, lookup):
+        """Find an object by its cached primary key, or look it up
+        and cache its primary key.
+
+        Unlike get(), this always gives the object's current state.
+        """
+        cached = self.cache.get(key)
+        if cached is not None:
+            model, id = cached
+            obj = self._db.query(model).get(id)
+            if obj is not None:
+                return obj
+            # The object has been deleted since it was cached.
+
+        obj = lookup()
+        if obj is None:
+            return None
+        if obj in self._db.new:
+            self._db.flush()
+        self.cache.set(key, (type(obj), obj.id))
+        return obj
+
+    def default_library(self):
+        return self.get(
+            ('library', 'default'), lambda: Library.default(self._db)
+        )
+
+    def data_source(self, name):
+        return self.get(
+            ('data_source', name), lambda: DataSource.lookup(self._db, name)
+        )
+
+    def custom_list(self, source, identifier):
+        return self.get_by_id(
+            ('custom_list', source, identifier),
+            lambda: CustomList.find(self._db, source, identifier)
+        )
+
+    def invalidate(self, model=None):
+        """Forget cached objects, e.g. after a library or data source
+        has been changed.
+
+        :param model: Only forget objects of this class. By default,
+            everything is forgotten.
+        """
+        if model is None:
+            self.cache.clear()
+            return
+        for key, (expires, value) in self.cache.entries.items():
+            if isinstance(value, tuple):
+                cached_model = value[0]
+            else:
+                cached_model = type(value)
+            if issubclass(cached_model, model):
+                del self.cache.entries[key]
+
+    def stats(self):
+        return self.cache.stats()
+
+
 class ContentServerController(object):
     
     def __init__(self, content_server):
         self.content_server = content_server
         self._db = self.content_server._db
+        self.lookups = self.content_server.lookups
 
     def annotator(self, *args, **kwargs):
         """Create an appropriate OPDS annotator."""
@@ -79,10 +283,62 @@ class ContentServerController(object):
 
 
 class OPDSFeedController(ContentServerController):
-    
+
+    # Rendered feeds are kept for this many seconds, and clients and
+    # CDNs are told they can keep them as long.
+    FEED_CACHE_TIME = 600
+
+    # The most rendered feeds to keep in memory.
+    FEED_CACHE_SIZE = 1000
+
+    # Check this often whether any works have changed, and if so,
+    # throw out every cached feed.
+    GENERATION_CHECK_INTERVAL = 60
+
+    # The orders that can be used with cursor pagination, the column
+    # each one sorts on, and what to sort a missing value as.
+    CURSOR_SORT_FIELDS = {
+        Facets.ORDER_TITLE : ('sort_title', u''),
+        Facets.ORDER_AUTHOR : ('sort_author', u''),
+        Facets.ORDER_ADDED_TO_COLLECTION : (
+            'availability_time', datetime.datetime(1900, 1, 1)),
+        Facets.ORDER_LAST_UPDATE : (
+            'last_update_time', datetime.datetime(1900, 1, 1)),
+    }
+
+    CURSOR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+    def __init__(self, content_server):
+        super(OPDSFeedController, self).__init__(content_server)
+        self.feed_cache = ExpiringCache(
+            self.FEED_CACHE_TIME, max_size=self.FEED_CACHE_SIZE)
+        self._generation = None
+        self._generation_checked_at = None
+
+    def generation(self):
+        """Find the current state of the presentation-ready works.
+
+        When a work becomes presentation-ready or is updated, the
+        generation changes and the feed cache is cleared.
+
+        :return: A (last update time, number of works) 2-tuple.
+        """
+        now = time.time()
+        if (self._generation_checked_at is None
+            or now - self._generation_checked_at >= self.GENERATION_CHECK_INTERVAL):
+            generation = self._db.query(
+                func.max(Work.last_update_time), func.count(Work.id)
+            ).filter(Work.presentation_ready==True).one()
+            generation = tuple(generation)
+            if generation != self._generation:
+                self.feed_cache.clear()
+                self._generation = generation
+            self._generation_checked_at = now
+        return self._generation
+
     def feed(self, license_source_name=None):
         if license_source_name:
-            license_source = DataSource.lookup(self._db, license_source_name)
+            license_source = self.lookups.data_source(license_source_name)
             if not license_source:
                 return UNRECOGNIZED_DATA_SOURCE.detailed(
                     "Unrecognized license source: %s" % license_source_name
@@ -92,8 +348,7 @@ class OPDSFeedController(ContentServerController):
             lane_name = flask.request.args.get("lane", "All books")
             license_source=None
 
-        library = Library.default(self._db)
-        lane = Lane(self._db, library, lane_name, license_source=license_source)
+        library = self.lookups.default_library()
 
         url = url_for("feed", _external=True)
 
@@ -105,13 +360,223 @@ class OPDSFeedController(ContentServerController):
         if isinstance(pagination, ProblemDetail):
             return pagination
 
-        opds_feed = AcquisitionFeed.page(
-            self._db, "Open-Access Content", url, lane,
-            annotator=self.annotator(),
-            facets=facets,
-            pagination=pagination,
+        cursor = self.load_cursor_from_request(facets)
+        if isinstance(cursor, ProblemDetail):
+            return cursor
+
+        license_source_name = None
+        if license_source:
+            license_source_name = license_source.name
+        key = self.feed_cache_key(
+            (lane_name, license_source_name), facets, pagination
+        )
+
+        def make_feed():
+            lane = Lane(
+                self._db, library, lane_name, license_source=license_source
+            )
+            if cursor is not None:
+                return self.cursor_page(
+                    "Open-Access Content", url, lane, facets,
+                    pagination.size, cursor
+                )
+            return ContentServerAcquisitionFeed.page(
+                self._db, "Open-Access Content", url, lane,
+                annotator=self.annotator(),
+                facets=facets,
+                pagination=pagination,
+            ).content
+        return self.conditional_feed(key, make_feed)
+
+    def feed_cache_key(self, parts, facets, pagination):
+        """Everything that can make one feed page different from
+        another.
+
+        :param parts: A tuple identifying the feed.
+        """
+        return (flask.request.url_root,) + tuple(parts) + (
+            tuple(sorted(facets.items())),
+            pagination.offset, pagination.size,
+            flask.request.args.get('cursor'),
+            tuple(languages_for_request() or []),
+        )
+
+    def load_cursor_from_request(self, facets):
+        """Find out whether the client wants cursor pagination, and if
+        so, where the page should start.
+
+        Cursor pagination is opt-in: a request with a 'cursor'
+        argument, even an empty one, gets a page that starts after the
+        position the cursor encodes, and a 'next' link with a cursor
+        for the page after that. Unlike offset pagination, every page
+        costs the same no matter how deep it is.
+
+        :return: None if the client didn't ask for cursor pagination,
+            an empty tuple for the first page, a (sort key, work ID)
+            2-tuple for later pages, or a ProblemDetail.
+        """
+        cursor = flask.request.args.get('cursor')
+        if cursor is None:
+            return None
+        if facets.order not in self.CURSOR_SORT_FIELDS:
+            return INVALID_INPUT.detailed(
+                "Cursor pagination is not available when ordering by %s." % facets.order
+            )
+        if not cursor:
+            return ()
+        try:
+            order, key, work_id = json.loads(
+                base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError, UnicodeError):
+            return INVALID_INPUT.detailed("Invalid cursor: %s" % cursor)
+        if order != facets.order:
+            return INVALID_INPUT.detailed(
+                "This cursor can't be used when ordering by %s." % facets.order
+            )
+        # Anything else in the cursor ends up in the query, so it has
+        # to be the right type.
+        if isinstance(work_id, bool) or not isinstance(work_id, (int, long)):
+            return INVALID_INPUT.detailed("Invalid cursor: %s" % cursor)
+        field, default = self.CURSOR_SORT_FIELDS[order]
+        if key is None:
+            # A missing sort key sorts the same as the default.
+            key = default
+        elif not isinstance(key, basestring):
+            return INVALID_INPUT.detailed("Invalid cursor: %s" % cursor)
+        elif isinstance(default, datetime.datetime):
+            try:
+                key = datetime.datetime.strptime(key, self.CURSOR_DATE_FORMAT)
+            except ValueError:
+                return INVALID_INPUT.detailed("Invalid cursor: %s" % cursor)
+        return key, work_id
+
+    @classmethod
+    def encode_cursor(cls, order, key, work_id):
+        if isinstance(key, datetime.datetime):
+            key = key.strftime(cls.CURSOR_DATE_FORMAT)
+        return base64.urlsafe_b64encode(json.dumps([order, key, work_id]))
+
+    def cursor_page(self, title, url, lane, facets, size, cursor):
+        """Render one page of a feed using cursor pagination.
+
+        The lane's query is narrowed to the works that sort after the
+        cursor, so the database never has to count its way past the
+        earlier pages.
+
+        :param cursor: A value from load_cursor_from_request().
+        :return: The feed content.
+        """
+        field, default = self.CURSOR_SORT_FIELDS[facets.order]
+        works = []
+        qu = lane.works(facets)
+        if qu:
+            # The query may already have an ORDER BY (and a DISTINCT
+            # ON to go with it) from the facets. Order by the sort key
+            # and the work ID instead, so that the cursor pins down an
+            # exact position.
+            model = qu.column_descriptions[0]['entity']
+            work = aliased(model, qu.order_by(None).subquery())
+            sort_key = func.coalesce(getattr(work, field), default)
+            position = tuple_(sort_key, work.works_id)
+
+            qu = self._db.query(work)
+            if facets.order_ascending:
+                if cursor:
+                    qu = qu.filter(position > tuple_(*cursor))
+                qu = qu.order_by(sort_key, work.works_id)
+            else:
+                if cursor:
+                    qu = qu.filter(position < tuple_(*cursor))
+                qu = qu.order_by(sort_key.desc(), work.works_id.desc())
+            works = qu.limit(size).all()
+
+        opds_feed = ContentServerAcquisitionFeed(
+            self._db, title, url, works, self.annotator()
         )
-        return feed_response(opds_feed.content) 
+        if len(works) == size:
+            # There may be more works after these.
+            last = works[-1]
+            key = getattr(last, field)
+            if key is None:
+                key = default
+            next_cursor = self.encode_cursor(
+                facets.order, key, last.works_id)
+            opds_feed.add_link_to_feed(
+                opds_feed.feed, rel="next", href=self.cursor_url(next_cursor),
+                type=OPDSFeed.ACQUISITION_FEED_TYPE
+            )
+        return unicode(opds_feed)
+
+    @classmethod
+    def cursor_url(cls, cursor):
+        """The URL to the current feed, starting at a different cursor."""
+        request = flask.request
+        kwargs = dict(request.view_args or {})
+        kwargs.update(request.args.to_dict())
+        kwargs['cursor'] = cursor
+        return cdn_url_for(request.endpoint, _external=True, **kwargs)
+
+    def conditional_feed(self, key, make_feed, last_modified=None):
+        """Serve a feed page from the cache, rendering it if necessary,
+        or tell the client that the copy it has is still good.
+
+        The validators are worked out from the cache key and the
+        generation, without rendering anything, so a 304 is cheap.
+
+        :param key: A key from feed_cache_key().
+        :param make_feed: A function that renders the feed.
+        :param last_modified: When something other than a work (e.g. a
+            custom list) that affects this feed last changed.
+        """
+        generation = self.generation()
+        last_update_time, ignore = generation
+        # Either time may be missing -- there may be no works yet, or
+        # the custom list may never have been updated.
+        candidates = [t for t in (last_update_time, last_modified) if t]
+        last_modified = max(candidates) if candidates else None
+        etag = self.etag(key, generation)
+
+        if self.not_modified(etag, last_modified):
+            response = feed_response(u"", cache_for=self.FEED_CACHE_TIME)
+            response.status_code = 304
+            return self.add_validators(response, etag, last_modified)
+
+        content = self.feed_cache.get(key)
+        if content is None:
+            content = make_feed()
+            self.feed_cache.set(key, content)
+        response = feed_response(content, cache_for=self.FEED_CACHE_TIME)
+        return self.add_validators(response, etag, last_modified)
+
+    @classmethod
+    def etag(cls, key, generation):
+        """A weak ETag for a feed page: the same page rendered from
+        the same works will be equivalent, though not necessarily
+        byte-for-byte identical.
+        """
+        return 'W/"%s"' % hashlib.md5(repr((key, generation))).hexdigest()
+
+    @classmethod
+    def not_modified(cls, etag, last_modified):
+        """Does the client already have this version of the feed?"""
+        request = flask.request
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(
+                etag.replace('W/', '', 1).strip('"'))
+        if request.if_modified_since and last_modified:
+            return last_modified.replace(microsecond=0) <= (
+                request.if_modified_since.replace(tzinfo=None))
+        return False
+
+    @classmethod
+    def add_validators(cls, response, etag, last_modified):
+        response.headers['ETag'] = etag
+        if last_modified:
+            response.headers['Last-Modified'] = http_date(last_modified)
+        # Facet titles are translated, so the feed depends on the
+        # client's language.
+        response.headers['Vary'] = 'Accept-Language'
+        return response
 
     def custom_list_feed(self, list_identifier):
         """Creates an OPDS feed with the Works from a CustomList.
@@ -123,19 +588,15 @@ class OPDSFeedController(ContentServerController):
         """
         # Right now we only allow downloading of staff-created lists.
         source = DataSource.LIBRARY_STAFF
-        custom_list = CustomList.find(self._db, source, list_identifier)
+        custom_list = self.lookups.custom_list(source, list_identifier)
 
         if not custom_list:
             return INVALID_INPUT.detailed(
                 "Available CustomList '%s' not found." % list_identifier
             )
 
-        library = Library.default(self._db)
+        library = self.lookups.default_library()
         lane_name = 'All books from %s' % custom_list.name
-        lane = Lane(
-            self._db, library, lane_name,
-            list_identifier=custom_list.foreign_identifier,
-        )
 
         url = url_for(
             'feed_from_custom_list',
@@ -151,10 +612,228 @@ class OPDSFeedController(ContentServerController):
         if isinstance(pagination, ProblemDetail):
             return pagination
 
-        custom_list_feed = AcquisitionFeed.page(
-            self._db, lane_name, url, lane,
-            annotator=self.annotator(),
-            facets=facets,
-            pagination=pagination,
+        cursor = self.load_cursor_from_request(facets)
+        if isinstance(cursor, ProblemDetail):
+            return cursor
+
+        # A change to the list changes the feed, even if none of the
+        # works have changed.
+        key = self.feed_cache_key(
+            ('list', custom_list.id, lane_name, custom_list.updated),
+            facets, pagination
+        )
+
+        def make_feed():
+            lane = Lane(
+                self._db, library, lane_name,
+                list_identifier=custom_list.foreign_identifier,
+            )
+            if cursor is not None:
+                return self.cursor_page(
+                    lane_name, url, lane, facets, pagination.size, cursor
+                )
+            return ContentServerAcquisitionFeed.page(
+                self._db, lane_name, url, lane,
+                annotator=self.annotator(),
+                facets=facets,
+                pagination=pagination,
+            ).content
+        return self.conditional_feed(
+            key, make_feed, last_modified=custom_list.updated
+        )
+
+    # Load this many works at a time when exporting the whole
+    # collection.
+    BULK_EXPORT_BATCH_SIZE = 500
+
+    def bulk_export(self):
+        """Stream an OPDS feed of every presentation-ready open-access
+        work, gzip-compressed if the client accepts it.
+
+        This is for circulation managers that want the whole
+        collection, and would otherwise have to page through '/'.
+        The feed is written out entry by entry as the works are read
+        from a server-side cursor, so memory use stays flat however
+        big the collection gets.
+        """
+        url = url_for("bulk_export", _external=True)
+        annotator = self.annotator()
+        feed = ContentServerAcquisitionFeed(
+            self._db, "All Open-Access Content", url, [], annotator
+        )
+        body = self.bulk_export_body(feed)
+
+        headers = dict()
+        if 'gzip' in flask.request.accept_encodings:
+            body = self.gzipped(body)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+        return flask.Response(
+            flask.stream_with_context(body),
+            content_type=OPDSFeed.ACQUISITION_FEED_TYPE,
+            headers=headers,
+        )
+
+    def bulk_export_body(self, feed):
+        """Yield the feed a piece at a time."""
+        # The empty feed provides the opening tag and the feed-level
+        # metadata.
+        empty = etree.tostring(feed.feed, encoding="utf-8", xml_declaration=True)
+        closing_tag = empty.rindex("</")
+        yield empty[:closing_tag]
+
+        for works in self.bulk_export_batches():
+            feed.open_access_links = feed.prefetch(self._db, works)
+            for work in works:
+                entry = feed.create_entry(work)
+                if isinstance(entry, etree._Element):
+                    yield etree.tostring(entry, encoding="utf-8")
+
+            # Let go of this batch's works, pools and links, so the
+            # session doesn't grow with the size of the collection.
+            # Committing would close the server-side cursor.
+            feed.open_access_links = None
+            self._db.expunge_all()
+        yield empty[closing_tag:]
+
+    def bulk_export_batches(self):
+        """Yield every presentation-ready open-access work, in lists
+        of BULK_EXPORT_BATCH_SIZE.
+
+        The work IDs come from a server-side cursor, and the works
+        themselves are loaded a batch at a time.
+        """
+        ids = self._db.query(Work.id).join(Work.license_pools).filter(
+            Work.presentation_ready==True,
+            LicensePool.open_access==True,
+        ).distinct().order_by(Work.id).execution_options(
+            stream_results=True
+        ).yield_per(self.BULK_EXPORT_BATCH_SIZE)
+
+        batch = []
+        for [work_id] in ids:
+            batch.append(work_id)
+            if len(batch) >= self.BULK_EXPORT_BATCH_SIZE:
+                yield self._works_by_id(batch)
+                batch = []
+        if batch:
+            yield self._works_by_id(batch)
+
+    def _works_by_id(self, ids):
+        return self._db.query(Work).filter(Work.id.in_(ids)).options(
+            joinedload(Work.license_pools),
+            joinedload(Work.presentation_edition).joinedload(
+                Edition.contributions).joinedload(Contribution.contributor),
+        ).order_by(Work.id).all()
+
+    @classmethod
+    def gzipped(cls, chunks):
+        """Compress a stream of strings into a stream of gzip data."""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+
+class BulkURNLookupController(URNLookupController):
+    """Look up any number of URNs with a single query.
+
+    The default controller parses and resolves URNs one at a time, so
+    a circulation manager syncing a few hundred books costs a few
+    hundred round trips to the database.
+    """
+
+    def process_urns(self, urns, **process_urn_kwargs):
+        parsed = []
+        by_type = defaultdict(set)
+        for urn in urns:
+            try:
+                type, identifier = Identifier.type_and_identifier_for_urn(urn)
+            except ValueError, e:
+                type = identifier = None
+            if type is None:
+                parsed.append((urn, None))
+                continue
+            parsed.append((urn, (type, identifier)))
+            by_type[type].add(identifier)
+
+        resolved = self.resolve(by_type)
+
+        works_seen = set()
+        for urn, key in parsed:
+            if key is None:
+                # Not a well-formed URN.
+                self.add_message(urn, 400, INVALID_URN.detail)
+                continue
+            # Messages carry the URN the client sent, whatever form
+            # it was in, so the client can match them up with its
+            # requests.
+            if key not in resolved:
+                # Either we've never heard of this identifier, or
+                # it's not licensed through anything.
+                self.add_message(urn, 404, self.UNRECOGNIZED_IDENTIFIER)
+                continue
+            identifier, work = resolved[key]
+            if not work:
+                self.add_message(urn, 202, self.WORK_NOT_CREATED)
+            elif not work.presentation_ready:
+                self.add_message(urn, 202, self.WORK_NOT_PRESENTATION_READY)
+            elif work.id not in works_seen:
+                # A work only gets one entry, even if it was asked
+                # for under more than one identifier.
+                works_seen.add(work.id)
+                self.add_work(identifier, work)
+
+    def resolve(self, identifiers_by_type):
+        """Find the licensed identifiers among the given ones, and
+        their works.
+
+        :param identifiers_by_type: A dictionary mapping each identifier
+            type to a set of identifiers.
+        :return: A dictionary mapping (type, identifier) to an
+            (Identifier, Work) 2-tuple. The Work may be None.
+        """
+        if not identifiers_by_type:
+            return {}
+        clauses = [
+            and_(Identifier.type==type, Identifier.identifier.in_(identifiers))
+            for type, identifiers in identifiers_by_type.items()
+        ]
+        qu = self._db.query(Identifier, Work).join(
+            LicensePool, LicensePool.identifier_id==Identifier.id
+        ).outerjoin(
+            Work, LicensePool.work_id==Work.id
+        ).filter(or_(*clauses)).options(
+            # The entries are rendered from these, so load them now
+            # rather than once per work.
+            joinedload(Work.license_pools),
+            joinedload(Work.presentation_edition),
+        )
+
+        resolved = {}
+        for identifier, work in qu:
+            key = (identifier.type, identifier.identifier)
+            if key in resolved:
+                # An identifier may be licensed through more than one
+                # pool. Prefer the pool whose work is furthest along.
+                old_identifier, old_work = resolved[key]
+                if not work or (old_work and (
+                        old_work.presentation_ready or not work.presentation_ready)):
+                    continue
+            resolved[key] = (identifier, work)
+        return resolved
+
+
+class OperationsController(ContentServerController):
+
+    def cache_stats(self):
+        """Report how well the in-process caches are doing."""
+        stats = dict(
+            lookups=self.lookups.stats(),
+            feeds=self.content_server.opds_feeds.feed_cache.stats(),
+        )
+        return flask.Response(
+            json.dumps(stats), 200, {"Content-Type": "application/json"}
         )
-        return feed_response(custom_list_feed.content)
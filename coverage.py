@@ -1,5 +1,7 @@
 import json
+import logging
 import os
+import shutil
 import subprocess
 import tempfile
 import urllib
@@ -21,7 +23,8 @@ from core.model import (
     Resource,
     RightsStatus,
 )
-from core.s3 import S3Uploader
+from opds import ContentServerAnnotator
+from s3 import S3Uploader
 
 class GutenbergEPUBCoverageProvider(IdentifierCoverageProvider):
     """Upload a text's epub to S3.
@@ -34,7 +37,9 @@ class GutenbergEPUBCoverageProvider(IdentifierCoverageProvider):
 
     SERVICE_NAME = DATA_SOURCE_NAME
 
-    DEFAULT_BATCH_SIZE = 5
+    # EPUBs are uploaded a batch at a time, so a bigger batch means
+    # more uploads happening at once.
+    DEFAULT_BATCH_SIZE = 50
 
     INPUT_IDENTIFIER_TYPES = [Identifier.GUTENBERG_ID]
 
@@ -46,9 +51,11 @@ class GutenbergEPUBCoverageProvider(IdentifierCoverageProvider):
                 data_directory, "Gutenberg", "gutenberg-mirror") + "/"
             self.epub_mirror = os.path.join(
                 data_directory, "Gutenberg", "gutenberg-epub") + "/"
+            self.epub_index = GutenbergEPUBIndex.for_mirror(self.epub_mirror)
         else:
             self.gutenberg_mirror = None
             self.epub_mirror = None
+            self.epub_index = None
 
         self.uploader = uploader or S3Uploader.from_config(_db)
 
@@ -57,6 +64,69 @@ class GutenbergEPUBCoverageProvider(IdentifierCoverageProvider):
         )
 
     def process_item(self, identifier):
+        [result] = self.process_batch([identifier])
+        return result
+
+    def process_batch(self, batch):
+        """Mirror the EPUBs for a batch of books.
+
+        Every book in the batch is prepared first, and then all of
+        their EPUBs are handed to the uploader at once, so the
+        uploads happen concurrently rather than one after another.
+        EPUBs whose content is already at the mirror URL are skipped.
+        """
+        results = {}
+        prepared = []
+        for identifier in batch:
+            result = self.prepare(identifier)
+            if isinstance(result, CoverageFailure):
+                results[identifier] = result
+            else:
+                prepared.append((identifier,) + result)
+
+        representations = []
+        for identifier, license_pool, link in prepared:
+            representation = link.resource.representation
+            representation.mirror_exception = None
+            representations.append(representation)
+        if representations:
+            try:
+                # EPUBs that are already in S3 (e.g. from a run that
+                # was interrupted) aren't uploaded again.
+                self.uploader.mirror_batch_if_changed(representations)
+            except Exception, e:
+                self.log.error("Could not mirror EPUBs", exc_info=e)
+                for representation in representations:
+                    representation.mirror_exception = (
+                        "Could not mirror EPUB: %s" % e)
+
+        for identifier, license_pool, link in prepared:
+            representation = link.resource.representation
+            if representation.mirror_exception:
+                results[identifier] = CoverageFailure(
+                    identifier, representation.mirror_exception,
+                    data_source=self.data_source,
+                    transient=True,
+                )
+                continue
+            license_pool.set_delivery_mechanism(
+                Representation.EPUB_MEDIA_TYPE, DeliveryMechanism.NO_DRM, 
+                RightsStatus.GENERIC_OPEN_ACCESS, link.resource
+            )
+            # The work's cached entry may have the old links in it.
+            ContentServerAnnotator.forget_prerendered_entry(license_pool.work)
+            self.handle_success(identifier)
+            results[identifier] = identifier
+
+        return [results[identifier] for identifier in batch]
+
+    def prepare(self, identifier):
+        """Get a book ready to have its EPUB mirrored.
+
+        :return: A CoverageFailure, or a (LicensePool, Hyperlink)
+            2-tuple. The Hyperlink's Representation is ready to be
+            mirrored.
+        """
         edition = self.edition(identifier)
         if isinstance(edition, CoverageFailure):
             return edition
@@ -92,13 +162,7 @@ class GutenbergEPUBCoverageProvider(IdentifierCoverageProvider):
         )
         representation = link.resource.representation
         representation.mirror_url = url
-        self.uploader.mirror_one(representation)
-
-        license_pool.set_delivery_mechanism(
-            Representation.EPUB_MEDIA_TYPE, DeliveryMechanism.NO_DRM, 
-            RightsStatus.GENERIC_OPEN_ACCESS, link.resource
-        )
-        return identifier
+        return license_pool, link
 
     def edition(self, identifier):
         """Finds or creates an edition with license-offering DataSource.GUTENBERG
@@ -122,7 +186,13 @@ class GutenbergEPUBCoverageProvider(IdentifierCoverageProvider):
         epub_directory = os.path.join(
             self.epub_mirror, identifier.identifier
         )
-        if not os.path.exists(epub_directory):
+        if self.epub_index:
+            # Ask the index rather than the filesystem.
+            directory_exists = self.epub_index.has_directory(
+                identifier.identifier)
+        else:
+            directory_exists = os.path.exists(epub_directory)
+        if not directory_exists:
             return CoverageFailure(
                 identifier,
                 "Expected EPUB directory %s does not exist!" % epub_directory,
@@ -130,8 +200,11 @@ class GutenbergEPUBCoverageProvider(IdentifierCoverageProvider):
                 transient=True,
             )
 
-        files = os.listdir(epub_directory)
-        epub_filename = self.best_epub_in(files)
+        if self.epub_index:
+            epub_filename = self.epub_index.best_epub(identifier.identifier)
+        else:
+            files = os.listdir(epub_directory)
+            epub_filename = self.best_epub_in(files)
         if not epub_filename:
             return CoverageFailure(
                 identifier,
@@ -155,3 +228,126 @@ class GutenbergEPUBCoverageProvider(IdentifierCoverageProvider):
             elif not without_images:
                 without_images = i
         return with_images or without_images
+
+
+class GutenbergEPUBIndex(object):
+    """An index of the rsynced mirror of Project Gutenberg's EPUBs.
+
+    Looking through the mirror for a book's EPUB means a stat and a
+    directory listing, which is slow when the mirror holds 60,000+
+    directories on a network filesystem. The index records the best
+    EPUB in every directory, so that finding one is a dictionary
+    lookup. It's kept up to date by refresh(), which runs after
+    bin/update_generated_mirror.
+    """
+
+    FILENAME_SUFFIX = ".index.json"
+
+    def __init__(self, epub_mirror, path):
+        self.epub_mirror = epub_mirror
+        self.path = path
+        self.log = logging.getLogger("Gutenberg EPUB index")
+
+        # Maps each Gutenberg ID in the mirror to the mtime of its
+        # directory when it was last indexed.
+        self.directories = {}
+
+        # Maps each Gutenberg ID to a (filename, size, mtime) 3-list
+        # describing the best EPUB in its directory.
+        self.epubs = {}
+
+    @classmethod
+    def path_for(cls, epub_mirror):
+        """Where the index for the given mirror is kept."""
+        return epub_mirror.rstrip("/") + cls.FILENAME_SUFFIX
+
+    @classmethod
+    def for_mirror(cls, epub_mirror):
+        """Load the index for the given mirror.
+
+        :return: A GutenbergEPUBIndex, or None if the mirror has never
+            been indexed.
+        """
+        path = cls.path_for(epub_mirror)
+        if not os.path.exists(path):
+            return None
+        index = cls(epub_mirror, path)
+        index.load()
+        return index
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        self.directories = data.get('directories', {})
+        self.epubs = data.get('epubs', {})
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                dict(directories=self.directories, epubs=self.epubs), f
+            )
+        shutil.move(tmp_path, self.path)
+
+    def has_directory(self, pg_id):
+        return pg_id in self.directories
+
+    def best_epub(self, pg_id):
+        """The filename of the best EPUB for the given Gutenberg ID,
+        or None if there isn't one.
+        """
+        epub = self.epubs.get(pg_id)
+        if epub:
+            return epub[0]
+        return None
+
+    def refresh(self, pg_ids=None):
+        """Bring the index up to date with the mirror.
+
+        :param pg_ids: Only look at the directories for these
+            Gutenberg IDs, e.g. the ones rsync reported as changed. By
+            default, every directory in the mirror is checked, and
+            only the ones whose mtime has changed are listed.
+
+        :return: The number of directories that were re-indexed.
+        """
+        if pg_ids is None:
+            pg_ids = [x for x in os.listdir(self.epub_mirror) if x.isdigit()]
+            for pg_id in set(self.directories) - set(pg_ids):
+                # This directory has been removed from the mirror.
+                self.forget(pg_id)
+            check_mtime = True
+        else:
+            check_mtime = False
+
+        reindexed = 0
+        for pg_id in pg_ids:
+            directory = os.path.join(self.epub_mirror, pg_id)
+            if not os.path.isdir(directory):
+                self.forget(pg_id)
+                continue
+            mtime = os.stat(directory).st_mtime
+            if check_mtime and self.directories.get(pg_id) == mtime:
+                continue
+            self.index_directory(pg_id, directory, mtime)
+            reindexed += 1
+        self.save()
+        self.log.info(
+            "Re-indexed %d directories; %d EPUBs in the index.",
+            reindexed, len(self.epubs)
+        )
+        return reindexed
+
+    def index_directory(self, pg_id, directory, mtime):
+        self.directories[pg_id] = mtime
+        filename = GutenbergEPUBCoverageProvider.best_epub_in(
+            os.listdir(directory))
+        if filename:
+            stat = os.stat(os.path.join(directory, filename))
+            self.epubs[pg_id] = [filename, stat.st_size, stat.st_mtime]
+        else:
+            self.epubs.pop(pg_id, None)
+
+    def forget(self, pg_id):
+        self.directories.pop(pg_id, None)
+        self.epubs.pop(pg_id, None)
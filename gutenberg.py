@@ -1,7 +1,10 @@
 import datetime
+import hashlib
+import itertools
 import os
 import json
 import logging
+import multiprocessing
 import random
 import re
 import random
@@ -11,6 +14,7 @@ import shutil
 import tarfile
 from urlparse import urljoin, urlparse
 from StringIO import StringIO
+from lxml import etree
 
 from sqlalchemy.orm import aliased
 
@@ -22,6 +26,7 @@ from rdflib import Namespace
 from core.model import (
     get_one_or_create,
     CirculationEvent,
+    Collection,
     Contributor,
     Edition,
     ExternalIntegration,
@@ -66,8 +71,29 @@ class GutenbergAPI(object):
     EVENT_SOURCE = "Gutenberg"
     FILENAME = "rdf-files.tar.bz2"
 
+    # Records how far an interrupted run got through the catalog, so
+    # that the next run can pick up where it left off.
+    CHECKPOINT_FILENAME = FILENAME + ".checkpoint"
+
+    # Records the tar mtime and SHA-1 of the RDF for every book
+    # that's been applied to the database, so that unchanged books
+    # can be skipped.
+    MANIFEST_FILENAME = FILENAME + ".manifest"
+
+    # Records the books whose RDF describes no book, or couldn't be
+    # parsed or applied, so they can be skipped until the RDF changes.
+    SKIP_LIST_FILENAME = FILENAME + ".skip"
+
+    # Write out the manifest and the skip list at most this often, in
+    # seconds.
+    MANIFEST_INTERVAL = 60
+
     ONE_DAY = 60 * 60 * 24
 
+    # When parsing in a pool of worker processes, hand the pool this
+    # many RDF documents at a time.
+    PARSE_CHUNK_SIZE = 500
+
 
     MIRRORS = [
         # "http://www.gutenberg.org/cache/epub/feeds/rdf-files.tar.bz2",
@@ -75,89 +101,574 @@ class GutenbergAPI(object):
         "http://gutenberg.pglaf.org/cache/generated/feeds/rdf-files.tar.bz2",
     ] 
 
+    # Records the validators the mirror sent along with the catalog,
+    # and the progress of any download in progress.
+    DOWNLOAD_STATE_FILENAME = FILENAME + ".download"
+
+    # Write the catalog to disk this many bytes at a time.
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+    # Give up on a mirror that hasn't sent anything in this many
+    # seconds.
+    TIMEOUT = 60
+
     # This will be passed in to Representation.get when downloading
     # the mirror.
-    def http_get_from_random_mirror(self, url, headers):
-        actual_url = random.choice(MIRRORS)
-        return Representations.simple_http_get(actual_url, headers)
+    def http_get_from_random_mirror(self, url, headers, **kwargs):
+        """Try each mirror in random order until one of them answers."""
+        mirrors = list(self.MIRRORS)
+        random.shuffle(mirrors)
+        exception = None
+        for actual_url in mirrors:
+            try:
+                status_code, headers, content = Representation.simple_http_get(
+                    actual_url, headers, **kwargs)
+            except requests.exceptions.RequestException, e:
+                self.log.warn("Could not reach %s: %s", actual_url, e)
+                exception = e
+                continue
+            if status_code < 500:
+                return status_code, headers, content
+            self.log.warn("Got status code %s from %s", status_code, actual_url)
+        if exception:
+            raise exception
+        return status_code, headers, content
 
     GUTENBERG_ORIGINAL_MIRROR = "%(gutenberg_original_mirror)s"
     GUTENBERG_EBOOK_MIRROR = "%(gutenberg_ebook_mirror)s"
     EPUB_ID = re.compile("/([0-9]+)")
 
-    def __init__(self, _db, data_directory):
+    def __init__(self, _db, data_directory, extractor=None, http_get=None):
         self._db = _db
+        self.http_get = http_get or requests.get
+        self.extractor = extractor or GutenbergRDFExtractor
         self.collection = Collection.by_protocol(self._db, ExternalIntegration.GUTENBERG).one()
         self.source = DataSource.lookup(self._db, DataSource.GUTENBERG)
         self.data_directory = data_directory
         self.catalog_path = os.path.join(self.data_directory, self.FILENAME)
+        self.checkpoint_path = os.path.join(
+            self.data_directory, self.CHECKPOINT_FILENAME)
+        self.manifest_path = os.path.join(
+            self.data_directory, self.MANIFEST_FILENAME)
+        self.skip_list_path = os.path.join(
+            self.data_directory, self.SKIP_LIST_FILENAME)
+        self.download_state_path = os.path.join(
+            self.data_directory, self.DOWNLOAD_STATE_FILENAME)
         self.log = logging.getLogger("Gutenberg API")
 
+        # The archive offset of the last catalog member dealt with by
+        # update_books().
+        self.offset = None
+
+        # Loaded by changed_books().
+        self.manifest = None
+        self.skip_list = None
+        self.manifest_saved_at = None
+
     def update_catalog(self):
-        """Download the most recent Project Gutenberg catalog
-        from a randomly selected mirror.
+        """Download the most recent Project Gutenberg catalog.
+
+        Mirrors are tried in random order until one of them works.
 
         We don't use Representation (for now) because the file is huge
         and the tarfile module only supports reading from a file on
         disk.
         """
-        url = random.choice(self.MIRRORS)
-        self.log.info("Refreshing %s", url)
-        response = requests.get(url)
-        if response.status_code == '403':
-            self.log.error("Request blocked by Gutenberg, not updating.")
-            return
+        mirrors = list(self.MIRRORS)
+        random.shuffle(mirrors)
+
+        # If a download was interrupted, go back to the same mirror
+        # first so we can pick up where we left off.
+        state = self._load_json(self.download_state_path) or {}
+        partial_url = (state.get('partial') or {}).get('url')
+        if partial_url in mirrors:
+            mirrors.remove(partial_url)
+            mirrors.insert(0, partial_url)
+
+        for url in mirrors:
+            try:
+                self.download_catalog(url)
+                return
+            except (requests.exceptions.RequestException, IOError), e:
+                self.log.warn("Could not refresh from %s: %s", url, e)
+
+        if os.path.exists(self.catalog_path):
+            self.log.error(
+                "Could not refresh the catalog from any mirror, using the copy we have."
+            )
+        else:
+            raise IOError(
+                "Could not download the catalog from any mirror."
+            )
+
+    def download_catalog(self, url):
+        """Download the catalog from one mirror.
+
+        The catalog is streamed to a temporary file and only moved
+        into place once it's complete. If an earlier download from
+        this mirror was interrupted, we ask for just the rest of the
+        file. If we already have the mirror's current catalog, the
+        mirror tells us so and nothing is downloaded.
+
+        :return: True if a new catalog was downloaded, False if the
+            catalog we have is up to date.
+        """
+        state = self._load_json(self.download_state_path) or {}
         tmp_path = self.catalog_path + ".tmp"
-        open(tmp_path, "wb").write(response.content)
+
+        headers = {}
+        partial = state.get('partial')
+        resume_from = 0
+        if (partial and partial.get('url') == url
+            and os.path.exists(tmp_path)):
+            # Pick up an interrupted download, so long as the file
+            # hasn't changed on the mirror in the meantime.
+            validator = partial.get('etag') or partial.get('last_modified')
+            resume_from = os.path.getsize(tmp_path)
+            if validator and resume_from:
+                headers['Range'] = 'bytes=%d-' % resume_from
+                headers['If-Range'] = validator
+            else:
+                resume_from = 0
+        elif os.path.exists(self.catalog_path):
+            # Only download the catalog if it has changed.
+            if state.get('url') == url and state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+
+        self.log.info("Refreshing %s", url)
+        response = self.http_get(
+            url, headers=headers, stream=True, timeout=self.TIMEOUT
+        )
+        try:
+            if response.status_code == 304:
+                self.log.info("Catalog has not changed.")
+                state['checked_at'] = time.time()
+                self._save_json(self.download_state_path, state)
+                return False
+            if response.status_code == 403:
+                raise IOError("Request blocked by Gutenberg.")
+            if response.status_code == 416:
+                # Our partial file is no good. Start over next time.
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                state.pop('partial', None)
+                self._save_json(self.download_state_path, state)
+                raise IOError("Could not resume download from %s." % url)
+            if response.status_code == 206:
+                mode = "ab"
+            elif response.status_code == 200:
+                # The mirror sent the whole file, either because we
+                # didn't ask for part of it or because it changed.
+                mode = "wb"
+                resume_from = 0
+            else:
+                raise IOError(
+                    "Got status code %s from %s" % (
+                        response.status_code, url)
+                )
+
+            validators = dict(
+                url=url,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+            )
+            state['partial'] = validators
+            self._save_json(self.download_state_path, state)
+
+            size = resume_from
+            with open(tmp_path, mode) as f:
+                for chunk in response.iter_content(self.DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+        finally:
+            response.close()
+
+        expected = self._expected_size(response, resume_from)
+        if expected is not None and size != expected:
+            # Leave the partial file where it is; next time we'll ask
+            # for the rest of it.
+            raise IOError(
+                "Download from %s stopped after %d of %d bytes." % (
+                    url, size, expected)
+            )
+
         shutil.move(tmp_path, self.catalog_path)
+        del state['partial']
+        state.update(validators)
+        state['checked_at'] = time.time()
+        self._save_json(self.download_state_path, state)
+        return True
+
+    def _expected_size(self, response, resume_from):
+        """How big should the catalog be once this response has been
+        written out?
+        """
+        content_range = response.headers.get('Content-Range')
+        if response.status_code == 206 and content_range:
+            total = content_range.rsplit('/', 1)[-1]
+            if total.isdigit():
+                return int(total)
+        if response.headers.get('Content-Encoding'):
+            # The length is the length of the encoded body, not what
+            # we wrote to disk.
+            return None
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit():
+            return resume_from + int(length)
+        return None
 
     def needs_refresh(self):
         """Is it time to download a new version of the catalog?"""
-        if os.path.exists(self.catalog_path):
-            modification_time = os.stat(self.catalog_path).st_mtime
-            return (time.time() - modification_time) >= self.ONE_DAY
-        return True
-
-    def all_books(self):
-        """Yields raw data for every book in the PG catalog."""
+        if not os.path.exists(self.catalog_path):
+            return True
+
+        # If the mirror told us the catalog hadn't changed, the
+        # catalog file wasn't touched, so we go by when we last
+        # checked rather than when the file was last written.
+        state = self._load_json(self.download_state_path) or {}
+        checked_at = state.get(
+            'checked_at', os.stat(self.catalog_path).st_mtime)
+        return (time.time() - checked_at) >= self.ONE_DAY
+
+    def all_books(self, resume=True):
+        """Yields raw data for every book in the PG catalog.
+
+        The archive is read as a stream: each member is handed out as
+        soon as it has been decompressed, and TarFile is not allowed
+        to build up its list of every member it has seen.
+
+        :param resume: If True, skip over the members that were
+            already covered by an interrupted run over the same
+            catalog file.
+        """
         if self.needs_refresh():
             self.update_catalog()
-        archive = tarfile.open(self.catalog_path)
-        next_item = archive.next()
-        a = 0
-        while next_item:
-            if next_item.isfile() and next_item.name.endswith(".rdf"):
-
-                pg_id = self.ID_IN_FILENAME.search(next_item.name).groups()[0]
-                yield pg_id, archive, next_item
+
+        resume_after = None
+        if resume:
+            resume_after = self.load_checkpoint()
+            if resume_after is not None:
+                self.log.info(
+                    "Resuming after archive offset %d", resume_after)
+
+        archive = tarfile.open(self.catalog_path, "r|bz2")
+        try:
             next_item = archive.next()
+            while next_item:
+                # Streaming mode doesn't need the member list, and
+                # keeping it around would hold on to 60,000+ TarInfo
+                # objects.
+                archive.members = []
+                if (next_item.isfile() and next_item.name.endswith(".rdf")
+                    and (resume_after is None
+                         or next_item.offset > resume_after)):
+                    pg_id = self.ID_IN_FILENAME.search(next_item.name).groups()[0]
+                    yield pg_id, archive, next_item
+                next_item = archive.next()
+        finally:
+            archive.close()
+
+    def _load_json(self, path):
+        """Load one of the JSON files we keep next to the catalog.
+
+        :return: The parsed JSON, or None if the file is missing or
+            unreadable.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError, e:
+            self.log.warn("Ignoring unreadable %s: %s", path, e)
+            return None
+
+    def _save_json(self, path, data):
+        """Atomically replace one of the JSON files we keep next to
+        the catalog.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        shutil.move(tmp_path, path)
 
-    def create_missing_books(self, subset=None):
-        """Finds books present in the PG catalog but missing from Edition.
+    def load_checkpoint(self):
+        """Find the archive offset reached by an interrupted run.
 
-        Yields (Edition, LicensePool) 2-tuples.
+        :return: An offset into the uncompressed archive, or None if
+            there is no checkpoint for the current catalog file.
+        """
+        if not os.path.exists(self.catalog_path):
+            return None
+        checkpoint = self._load_json(self.checkpoint_path)
+        if not checkpoint:
+            return None
+
+        # A checkpoint is only good for the catalog file it was made
+        # against.
+        catalog_mtime = os.stat(self.catalog_path).st_mtime
+        if checkpoint.get('catalog_mtime') != catalog_mtime:
+            return None
+        return checkpoint.get('offset')
+
+    def save_checkpoint(self, force=False):
+        """Record that every catalog member up to the last one handed
+        out by update_books() has been dealt with.
+
+        This should only be called once the work done on those members
+        has been committed.
+
+        :param force: Write out the manifest even if it was written
+            out less than MANIFEST_INTERVAL seconds ago.
+        """
+        if self.offset is not None and os.path.exists(self.catalog_path):
+            checkpoint = dict(
+                catalog_mtime=os.stat(self.catalog_path).st_mtime,
+                offset=self.offset,
+            )
+            self._save_json(self.checkpoint_path, checkpoint)
+
+        # The manifest covers the whole catalog, so it's too big to
+        # write out after every book. Losing a few minutes' worth of
+        # it just means those books get looked at again.
+        now = time.time()
+        if self.manifest is not None and (
+                force or self.manifest_saved_at is None
+                or now - self.manifest_saved_at >= self.MANIFEST_INTERVAL):
+            self._save_json(self.manifest_path, self.manifest)
+            if self.skip_list is not None:
+                self._save_json(self.skip_list_path, self.skip_list)
+            self.manifest_saved_at = now
+
+    def clear_checkpoint(self):
+        """Make sure the next run starts from the top of the catalog."""
+        self.save_checkpoint(force=True)
+        self.offset = None
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def load_manifest(self):
+        """Find out which version of each book's RDF has been applied
+        to the database.
+
+        :return: A dictionary mapping Gutenberg IDs to [tar mtime,
+            SHA-1 of RDF document] 2-lists.
+        """
+        return self._load_json(self.manifest_path) or {}
+
+    def load_skip_list(self):
+        """Find the books that are being skipped because their RDF
+        describes no book, or couldn't be parsed or applied.
+
+        :return: A dictionary mapping Gutenberg IDs to dictionaries
+            with the keys 'mtime' and 'hash' (identifying the version
+            of the RDF that was skipped), 'reason' and 'skipped_at'.
         """
-        books = list(self.all_books())
-        for pg_id, archive, archive_item in books:
+        return self._load_json(self.skip_list_path) or {}
+
+    def clear_skip_list(self, pg_ids=None):
+        """Give skipped books another chance on the next run.
+
+        :param pg_ids: Only clear these Gutenberg IDs. By default,
+            the whole skip list is cleared.
+        :return: The Gutenberg IDs that were cleared.
+        """
+        skip_list = self.load_skip_list()
+        if pg_ids is None:
+            pg_ids = skip_list.keys()
+        cleared = [pg_id for pg_id in pg_ids if pg_id in skip_list]
+        for pg_id in cleared:
+            del skip_list[pg_id]
+        self._save_json(self.skip_list_path, skip_list)
+        return cleared
+
+    def skip(self, pg_id, version, reason):
+        """Skip this version of a book's RDF from now on."""
+        offset, mtime, digest = version
+        self.log.warn("Skipping Gutenberg book %s: %s", pg_id, reason)
+        self.skip_list[pg_id] = dict(
+            mtime=mtime, hash=digest, reason=reason,
+            skipped_at=time.time(),
+        )
+
+    def known_ids(self):
+        """Find the Gutenberg IDs of every book that already has an
+        Edition from Project Gutenberg.
+
+        This lets us check the whole catalog against the database
+        with a single query, rather than looking up each book in turn.
+
+        :return: A set of Gutenberg IDs.
+        """
+        qu = self._db.query(Identifier.identifier).join(
+            Edition, Edition.primary_identifier_id==Identifier.id
+        ).filter(
+            Identifier.type==Identifier.GUTENBERG_ID,
+            Edition.data_source==self.source,
+        )
+        return set(identifier for [identifier] in qu.yield_per(10000))
+
+    def changed_books(self, subset=None):
+        """Finds books in the PG catalog that are missing from Edition,
+        or whose RDF has changed since it was last applied.
+
+        A member whose tar mtime matches the manifest (or the skip
+        list) isn't even read. A member with a new mtime is read and
+        hashed, and only passed on if its contents have actually
+        changed.
+
+        Yields (pg_id, version, RDF document) 3-tuples, where version
+        is an (archive offset, tar mtime, SHA-1) 3-tuple.
+        """
+        if self.manifest is None:
+            self.manifest = self.load_manifest()
+        if self.skip_list is None:
+            self.skip_list = self.load_skip_list()
+        known_ids = self.known_ids()
+        self.log.info(
+            "%d Gutenberg books already known, %d in the manifest, %d skipped.",
+            len(known_ids), len(self.manifest), len(self.skip_list)
+        )
+
+        for pg_id, archive, archive_item in self.all_books():
             if subset is not None and not subset(pg_id, archive, archive_item):
                 continue
+            applied = self.manifest.get(pg_id)
+            if applied and applied[0] == archive_item.mtime:
+                # This member hasn't been touched since we last
+                # applied it.
+                continue
+            skipped = self.skip_list.get(pg_id)
+            if skipped and skipped['mtime'] == archive_item.mtime:
+                continue
+
+            data = archive.extractfile(archive_item).read()
+            digest = hashlib.sha1(data).hexdigest()
+            if skipped and skipped['hash'] == digest:
+                # This member is no better than it was last time.
+                skipped['mtime'] = archive_item.mtime
+                continue
+            if applied and applied[1] == digest:
+                # The member was touched but its contents are the
+                # same.
+                self.manifest[pg_id] = [archive_item.mtime, digest]
+                continue
+            if not applied and pg_id in known_ids:
+                # There's already an Edition for this book, made
+                # before we kept a manifest. Assume it's up to date
+                # and start tracking changes from here.
+                self.manifest[pg_id] = [archive_item.mtime, digest]
+                continue
+
             self.log.info("Considering %s" % pg_id)
-            # Find an existing Edition for the book.
-            book = Edition.for_foreign_id(
-                self._db, self.source, Identifier.GUTENBERG_ID, pg_id,
-                create_if_not_exists=False)
+            version = (archive_item.offset, archive_item.mtime, digest)
+            yield pg_id, version, data
+
+    def records_in_pool(self, books, processes, chunk_size=None):
+        """Parse RDF documents into records in a pool of worker
+        processes.
+
+        Books are handed to the pool a chunk at a time. While one
+        chunk is being parsed, the records from the previous chunk are
+        yielded to the caller, so the database work and the parsing
+        happen at the same time, and no more than two chunks are ever
+        held in memory.
+
+        :param books: An iterator over (pg_id, version, data) 3-tuples.
+        :yield: (pg_id, version, record, error) 4-tuples, in the order
+            the books came in.
+        """
+        chunk_size = chunk_size or self.PARSE_CHUNK_SIZE
+        pool = multiprocessing.Pool(processes)
+        try:
+            pending = None
+            while True:
+                chunk = [(self.extractor, pg_id, version, data)
+                         for pg_id, version, data
+                         in itertools.islice(books, chunk_size)]
+                submitted = None
+                if chunk:
+                    submitted = pool.map_async(_record_in, chunk)
+                if pending is not None:
+                    for result in pending.get():
+                        yield result
+                if submitted is None:
+                    break
+                pending = submitted
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def update_books(self, subset=None, processes=None):
+        """Creates books present in the PG catalog but missing from
+        Edition, and brings books whose RDF has changed up to date.
+
+        :param processes: If this is more than one, the RDF documents
+            are parsed in a pool of this many worker processes. The
+            database work always happens in this process.
+
+        Yields (Edition, LicensePool, is_new) 3-tuples.
+        """
+        books = self.changed_books(subset)
+        if processes and processes > 1:
+            records = self.records_in_pool(books, processes)
+        else:
+            records = (
+                _record_in((self.extractor, pg_id, version, data))
+                for pg_id, version, data in books
+            )
+
+        for pg_id, version, record, error in records:
+            # Once this book has been dealt with, so has everything
+            # before it in the catalog.
+            offset, mtime, digest = version
+            self.offset = offset
+            if error:
+                self.skip(pg_id, version, error)
+                continue
+            if not record:
+                self.skip(pg_id, version, "No book described.")
+                continue
+
+            # Create or update an Edition with bibliographic
+            # information from the Project Gutenberg RDF file.
+            #
+            # This happens inside a savepoint, so that if one record
+            # can't be applied, the rest of the caller's transaction
+            # survives.
+            savepoint = self._db.begin_nested()
+            try:
+                book, license, new = self.extractor.book_from_record(
+                    self.collection, record)
+                savepoint.commit()
+            except Exception, e:
+                savepoint.rollback()
+                self.log.error(
+                    "Could not apply Gutenberg book %s", pg_id, exc_info=e
+                )
+                self.skip(pg_id, version, _describe(e))
+                continue
+            self.manifest[pg_id] = [mtime, digest]
+            self.skip_list.pop(pg_id, None)
 
-            if not book:
-                # Create a new Edition object with bibliographic
-                # information from the Project Gutenberg RDF file.
-                fh = archive.extractfile(archive_item)
-                data = fh.read()
-                fake_fh = StringIO(data)
-                book, license, new = GutenbergRDFExtractor.book_in(
-                    self.collection, pg_id, fake_fh)
+            if book and license:
+                yield (book, license, new)
 
-                if book and license:
-                    yield (book, license)
+    def create_missing_books(self, subset=None, processes=None):
+        """Finds books present in the PG catalog but missing from Edition,
+        and creates them.
+
+        Books whose RDF has changed are brought up to date along the
+        way, but only the new ones are yielded.
+
+        Yields (Edition, LicensePool) 2-tuples.
+        """
+        for book, license, new in self.update_books(subset, processes):
+            if new:
+                yield (book, license)
 
 
 class GutenbergRDFExtractor(object):
@@ -202,51 +713,138 @@ class GutenbergRDFExtractor(object):
         reserved for George Orwell's "1984"). In that case,
         ``book_in()`` will return None.
         """
+        record = cls.record_in(pg_id, fh)
+        if not record:
+            return None, None, False
+        return cls.book_from_record(collection, record)
+
+    @classmethod
+    def record_in(cls, pg_id, fh):
+        """Extract the raw bibliographic information for the book
+        described by the given filehandle.
+
+        This doesn't touch the database, and the result is made up of
+        plain Python types, so it can be done in a worker process.
+
+        :return: A dictionary, or None if the file describes no books.
+        """
         g = rdflib.Graph()
         g.load(fh)
-        data = dict()
 
         # Determine the 'about' URI.
         title_triples = list(g.triples((None, cls.dcterms['title'], None)))
 
-        new = False
-        if title_triples:
-            if len(title_triples) > 1:
-                uris = set([x[0] for x in title_triples])
-                if len(uris) > 1:
-                    # Each filehandle is associated with one Project
-                    # Gutenberg ID and should thus describe at most
-                    # one title.
-                    raise ValueError(
-                        "More than one book in file for Project Gutenberg ID %s" % pg_id)
-                else:
-                    self.log.warn("WEIRD MULTI-TITLE: %s", pg_id)
-
-            # TODO: Some titles such as 44244 have titles in multiple
-            # languages. Not sure what to do about that.
-            uri, ignore, title = title_triples[0]
-            logging.info("Parsing book %s", title)
-            book, license, new = cls.parse_book(collection, g, uri, title)
+        if not title_triples:
+            return None
+
+        if len(title_triples) > 1:
+            uris = set([x[0] for x in title_triples])
+            if len(uris) > 1:
+                # Each filehandle is associated with one Project
+                # Gutenberg ID and should thus describe at most
+                # one title.
+                raise ValueError(
+                    "More than one book in file for Project Gutenberg ID %s" % pg_id)
+            else:
+                logging.warn("WEIRD MULTI-TITLE: %s", pg_id)
+
+        # TODO: Some titles such as 44244 have titles in multiple
+        # languages. Not sure what to do about that.
+        uri, ignore, title = title_triples[0]
+        logging.info("Parsing book %s", title)
+        return cls.record_from_graph(g, uri, title)
 
-        else:
-            book = None
-            license = None
-            new = False
+    @classmethod
+    def record_from_graph(cls, g, uri, title):
+        """Pull the information we care about for the given `uri` and
+        `title` out of an RDF graph.
+        """
+        def text(value):
+            if value is None:
+                return None
+            return unicode(value)
 
-        return book, license, new
+        issued = cls._value(g, (uri, cls.dcterms.issued, None))
+        rights = cls._value(g, (uri, cls.dcterms.rights, None))
+        publisher = cls._value(g, (uri, cls.dcterms.publisher, None))
+
+        languages = []
+        for ignore, ignore, language_uri in g.triples(
+                (uri, cls.dcterms.language, None)):
+            languages.append(
+                text(cls._value(g, (language_uri, cls.rdf.value, None))))
+
+        creators = []
+        for ignore, ignore, author_uri in g.triples((uri, cls.dcterms.creator, None)):
+            name = cls._value(g, (author_uri, cls.gutenberg.name, None))
+            aliases = cls._values(g, (author_uri, cls.gutenberg.alias, None))
+            creators.append((text(name), [text(x) for x in aliases]))
+
+        subjects = []
+        for subject in cls._values(g, (uri, cls.dcterms.subject, None)):
+            value = cls._value(g, (subject, cls.rdf.value, None))
+            vocabulary = cls._value(g, (subject, cls.dcam.memberOf, None))
+            subjects.append((text(vocabulary), text(value)))
+
+        formats = []
+        download_links = cls._values(g, (uri, cls.dcterms.hasFormat, None))
+        for href in download_links:
+            for format_uri in cls._values(
+                    g, (href, cls.dcterms['format'], None)):
+                formats.append(
+                    text(cls._value(g, (format_uri, cls.rdf.value, None))))
+
+        return dict(
+            uri=text(uri),
+            title=text(title),
+            issued=text(issued),
+            rights=text(rights),
+            publisher=text(publisher),
+            languages=languages,
+            creators=creators,
+            subjects=subjects,
+            formats=formats,
+        )
+
+    @classmethod
+    def comparable(cls, record):
+        """Put a record in a form where it can be compared against a
+        record extracted from the same file in some other way.
+
+        The order of multi-valued properties isn't significant.
+        """
+        if not record:
+            return record
+        record = dict(record)
+        record['creators'] = sorted(
+            (name, sorted(aliases)) for name, aliases in record['creators'])
+        for key in 'languages', 'subjects', 'formats':
+            record[key] = sorted(record[key])
+        return record
 
     @classmethod
     def parse_book(cls, collection, g, uri, title):
         """Turn an RDF graph into a Edition for the given `uri` and
         `title`.
         """
+        record = cls.record_from_graph(g, uri, title)
+        return cls.book_from_record(collection, record)
+
+    @classmethod
+    def metadata_for_record(cls, record):
+        """Turn a record extracted from an RDF file into Metadata and
+        CirculationData.
+
+        :return: A (Metadata, CirculationData) 2-tuple.
+        """
+        uri = record['uri']
         source_id = unicode(cls.ID_IN_URI.search(uri).groups()[0])
         primary_identifier = IdentifierData(
             Identifier.GUTENBERG_ID, source_id
         )
 
         # Split a subtitle out from the main title.
-        title = unicode(title)
+        title = record['title']
         subtitle = None
         for separator in "\r\n", "\n":
             if separator in title:
@@ -255,10 +853,10 @@ class GutenbergRDFExtractor(object):
                 subtitle = "\n".join(parts[1:])
                 break
 
-        issued = cls._value(g, (uri, cls.dcterms.issued, None))
-        issued = datetime.datetime.strptime(issued, cls.DATE_FORMAT).date()
+        issued = datetime.datetime.strptime(
+            record['issued'], cls.DATE_FORMAT).date()
 
-        rights = cls._value(g, (uri, cls.dcterms.rights, None))
+        rights = record['rights']
         if rights:
             rights = str(rights)
         else:
@@ -269,13 +867,11 @@ class GutenbergRDFExtractor(object):
         # useless for our purposes. They should not be used, even if
         # no other description is available.
 
-        publisher = cls._value(g, (uri, cls.dcterms.publisher, None))
+        publisher = record['publisher']
 
         languages = []
-        for ignore, ignore, language_uri in g.triples(
-                (uri, cls.dcterms.language, None)):
-            code = str(cls._value(g, (language_uri, cls.rdf.value, None)))
-            code = LanguageCodes.two_to_three[code]
+        for code in record['languages']:
+            code = LanguageCodes.two_to_three[str(code)]
             if code:
                 languages.append(code)
 
@@ -287,9 +883,7 @@ class GutenbergRDFExtractor(object):
             language = None
 
         contributors = []
-        for ignore, ignore, author_uri in g.triples((uri, cls.dcterms.creator, None)):
-            name = cls._value(g, (author_uri, cls.gutenberg.name, None))
-            aliases = cls._values(g, (author_uri, cls.gutenberg.alias, None))
+        for name, aliases in record['creators']:
             contributors.append(ContributorData(
                 sort_name=name,
                 aliases=aliases,
@@ -297,10 +891,7 @@ class GutenbergRDFExtractor(object):
             ))
 
         subjects = []
-        subject_links = cls._values(g, (uri, cls.dcterms.subject, None))
-        for subject in subject_links:
-            value = cls._value(g, (subject, cls.rdf.value, None))
-            vocabulary = cls._value(g, (subject, cls.dcam.memberOf, None))
+        for vocabulary, value in record['subjects']:
             vocabulary = Subject.by_uri[str(vocabulary)]
             subjects.append(SubjectData(vocabulary, value))
 
@@ -309,7 +900,6 @@ class GutenbergRDFExtractor(object):
         # Turn the Gutenberg download links into Hyperlinks associated 
         # with the new Edition. They will serve either as open access
         # downloads or cover images.
-        download_links = cls._values(g, (uri, cls.dcterms.hasFormat, None))
         links = [LinkData(
             rel=Hyperlink.CANONICAL,
             href=str(uri),
@@ -320,27 +910,23 @@ class GutenbergRDFExtractor(object):
         # we can look through the links to determine which medium to
         # assign to this book.
         formats = []
-        for href in download_links:
-            for format_uri in cls._values(
-                    g, (href, cls.dcterms['format'], None)):
-                media_type = unicode(
-                    cls._value(g, (format_uri, cls.rdf.value, None)))
-                if media_type.startswith('audio/'):
-                    medium = Edition.AUDIO_MEDIUM
-                    formats.append(FormatData(
-                        content_type=Representation.MP3_MEDIA_TYPE,
-                        drm_scheme=DeliveryMechanism.NO_DRM,
-                    ))
-                elif media_type.startswith('video/'):
-                    medium = Edition.VIDEO_MEDIUM
-                else:
-                    formats.append(FormatData(
-                        content_type=Representation.EPUB_MEDIA_TYPE,
-                        drm_scheme=DeliveryMechanism.NO_DRM,
-                        rights_uri=rights_uri,
-                    ))
+        for media_type in record['formats']:
+            media_type = unicode(media_type)
+            if media_type.startswith('audio/'):
+                medium = Edition.AUDIO_MEDIUM
+                formats.append(FormatData(
+                    content_type=Representation.MP3_MEDIA_TYPE,
+                    drm_scheme=DeliveryMechanism.NO_DRM,
+                ))
+            elif media_type.startswith('video/'):
+                medium = Edition.VIDEO_MEDIUM
+            else:
+                formats.append(FormatData(
+                    content_type=Representation.EPUB_MEDIA_TYPE,
+                    drm_scheme=DeliveryMechanism.NO_DRM,
+                    rights_uri=rights_uri,
+                ))
 
-        _db  = Session.object_session(collection)
         metadata = Metadata(
             data_source=DataSource.GUTENBERG,
             title=title,
@@ -354,10 +940,7 @@ class GutenbergRDFExtractor(object):
             contributors=contributors,
             links=links,
         )
-        edition, new = metadata.edition(_db)
-        metadata.apply(edition, collection)
 
-        # Ensure that an open-access LicensePool exists for this book.
         circulation_data = CirculationData(
             data_source=DataSource.GUTENBERG,
             primary_identifier=primary_identifier,
@@ -365,7 +948,30 @@ class GutenbergRDFExtractor(object):
             default_rights_uri=rights_uri,
             links=links,
         )
+        return metadata, circulation_data
+
+    @classmethod
+    def book_from_record(cls, collection, record):
+        """Create or update an Edition and an open-access LicensePool
+        from a record extracted from an RDF file.
+
+        :return: An (Edition, LicensePool, is_new) 3-tuple.
+        """
+        metadata, circulation_data = cls.metadata_for_record(record)
+
+        _db  = Session.object_session(collection)
+        edition, new = metadata.edition(_db)
 
+        # Project Gutenberg is the authority on its own books, so when
+        # a record changes, its subjects and contributors replace the
+        # old ones rather than piling up alongside them. A new book is
+        # created the way it always has been.
+        replace = None
+        if not new:
+            replace = ReplacementPolicy.from_metadata_source()
+        metadata.apply(edition, collection, replace=replace)
+
+        # Ensure that an open-access LicensePool exists for this book.
         license_pool, new_license_pool = circulation_data.license_pool(
             _db, collection
         )
@@ -375,29 +981,242 @@ class GutenbergRDFExtractor(object):
         return edition, license_pool, new
 
 
+class GutenbergLxmlRDFExtractor(GutenbergRDFExtractor):
+
+    """Extract the same information as GutenbergRDFExtractor, but
+    without building an RDF graph.
+
+    Project Gutenberg's RDF files always have the same shape, so we
+    can pick the values we want straight out of the XML.
+    """
+
+    NAMESPACES = {
+        'rdf': unicode(GutenbergRDFExtractor.rdf),
+        'dcterms': unicode(GutenbergRDFExtractor.dcterms),
+        'dcam': unicode(GutenbergRDFExtractor.dcam),
+        'pgterms': unicode(GutenbergRDFExtractor.gutenberg),
+    }
+
+    XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+    ABOUT = '{%s}about' % GutenbergRDFExtractor.rdf
+    RESOURCE = '{%s}resource' % GutenbergRDFExtractor.rdf
+    NODE_ID = '{%s}nodeID' % GutenbergRDFExtractor.rdf
+
+    # Every element with a title. There should only be one.
+    TITLED = etree.XPath('//*[dcterms:title]', namespaces=NAMESPACES)
+
+    # Properties of the book.
+    TITLE = etree.XPath('dcterms:title', namespaces=NAMESPACES)
+    ISSUED = etree.XPath('dcterms:issued', namespaces=NAMESPACES)
+    RIGHTS = etree.XPath('dcterms:rights', namespaces=NAMESPACES)
+    PUBLISHER = etree.XPath('dcterms:publisher', namespaces=NAMESPACES)
+    LANGUAGE = etree.XPath('dcterms:language', namespaces=NAMESPACES)
+    CREATOR = etree.XPath('dcterms:creator', namespaces=NAMESPACES)
+    SUBJECT = etree.XPath('dcterms:subject', namespaces=NAMESPACES)
+    HAS_FORMAT = etree.XPath('dcterms:hasFormat', namespaces=NAMESPACES)
+
+    # Properties of the nodes those properties point to.
+    NAME = etree.XPath('pgterms:name', namespaces=NAMESPACES)
+    ALIAS = etree.XPath('pgterms:alias', namespaces=NAMESPACES)
+    MEMBER_OF = etree.XPath('dcam:memberOf', namespaces=NAMESPACES)
+    VALUE = etree.XPath('rdf:value', namespaces=NAMESPACES)
+    FORMAT = etree.XPath('dcterms:format', namespaces=NAMESPACES)
+
+    @classmethod
+    def _text(cls, elements):
+        """The text of the first of the given elements, or None."""
+        for element in elements:
+            return unicode(element.text or '')
+        return None
+
+    @classmethod
+    def _description(cls, root, element):
+        """Find the node that describes the subject of the given
+        property element.
+
+        Usually the node is nested inside the property, but RDF/XML
+        also allows the property to refer to a node described
+        elsewhere in the document.
+        """
+        for child in element:
+            if isinstance(child.tag, basestring):
+                return child
+        resource = element.get(cls.RESOURCE)
+        node_id = element.get(cls.NODE_ID)
+        if resource:
+            matches = root.xpath(
+                '//*[@rdf:about=$about]', about=resource,
+                namespaces=cls.NAMESPACES)
+        elif node_id:
+            matches = root.xpath(
+                '//*[@rdf:nodeID=$node_id]', node_id=node_id,
+                namespaces=cls.NAMESPACES)
+        else:
+            return None
+        if matches:
+            return matches[0]
+        return None
+
+    @classmethod
+    def record_in(cls, pg_id, fh):
+        """Extract the raw bibliographic information for the book
+        described by the given filehandle.
+
+        :return: A dictionary, or None if the file describes no books.
+        """
+        root = etree.parse(fh).getroot()
+
+        # Determine the 'about' URI.
+        titled = cls.TITLED(root)
+        if not titled:
+            return None
+
+        if len(titled) > 1:
+            uris = set([x.get(cls.ABOUT) for x in titled])
+            if len(uris) > 1:
+                # Each filehandle is associated with one Project
+                # Gutenberg ID and should thus describe at most
+                # one title.
+                raise ValueError(
+                    "More than one book in file for Project Gutenberg ID %s" % pg_id)
+            else:
+                logging.warn("WEIRD MULTI-TITLE: %s", pg_id)
+
+        book = titled[0]
+        base = root.get(cls.XML_BASE) or ''
+        uri = urljoin(base, book.get(cls.ABOUT))
+        title = cls._text(cls.TITLE(book))
+        logging.info("Parsing book %s", title)
+
+        def value_of(element):
+            node = cls._description(root, element)
+            if node is None:
+                return None
+            return cls._text(cls.VALUE(node))
+
+        languages = [value_of(x) for x in cls.LANGUAGE(book)]
+
+        creators = []
+        for creator in cls.CREATOR(book):
+            agent = cls._description(root, creator)
+            if agent is None:
+                continue
+            aliases = [unicode(x.text or '') for x in cls.ALIAS(agent)]
+            creators.append((cls._text(cls.NAME(agent)), aliases))
+
+        subjects = []
+        for subject in cls.SUBJECT(book):
+            node = cls._description(root, subject)
+            if node is None:
+                continue
+            vocabulary = None
+            for member_of in cls.MEMBER_OF(node):
+                vocabulary = unicode(
+                    urljoin(base, member_of.get(cls.RESOURCE)))
+                break
+            subjects.append((vocabulary, cls._text(cls.VALUE(node))))
+
+        formats = []
+        for has_format in cls.HAS_FORMAT(book):
+            download = cls._description(root, has_format)
+            if download is None:
+                continue
+            for format in cls.FORMAT(download):
+                formats.append(value_of(format))
+
+        return dict(
+            uri=unicode(uri),
+            title=title,
+            issued=cls._text(cls.ISSUED(book)),
+            rights=cls._text(cls.RIGHTS(book)),
+            publisher=cls._text(cls.PUBLISHER(book)),
+            languages=languages,
+            creators=creators,
+            subjects=subjects,
+            formats=formats,
+        )
+
+
+def _record_in(args):
+    """Parse a single catalog member. Runs in a worker process.
+
+    An exception is turned into an error message rather than being
+    raised, since it would otherwise bring down the whole pool.
+    """
+    extractor, pg_id, version, data = args
+    try:
+        record = extractor.record_in(pg_id, StringIO(data))
+    except Exception, e:
+        return pg_id, version, None, _describe(e)
+    return pg_id, version, record, None
+
+
+def _describe(exception):
+    """Explain why a book was skipped."""
+    return "%s: %s" % (exception.__class__.__name__, exception)
+
+
 class GutenbergMonitor(Monitor):
     """Maintain license pool and metadata info for Gutenberg titles.
+
+    TODO: This monitor doesn't really use the normal monitor process,
+    but since it doesn't access an 'API' in the traditional sense it
+    doesn't matter much.
     """
 
-    def __init__(self, _db, data_directory):
+    # Commit after this many books have been created or updated.
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, _db, data_directory, processes=None, extractor=None,
+                 batch_size=None):
         self._db = _db
+        self.processes = processes
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        self.log = logging.getLogger("Gutenberg Monitor")
         path = os.path.join(data_directory, DataSource.GUTENBERG)
         if not os.path.exists(path):
             os.makedirs(path)
-        self.source = GutenbergAPI(_db, path)
+        self.source = GutenbergAPI(_db, path, extractor=extractor)
 
     def run(self, subset=None):
-        added_books = 0
-        for edition, license_pool in self.source.create_missing_books(subset):
-            # Log a circulation event for this title.
-            event = get_one_or_create(
-                self._db, CirculationEvent,
-                type=CirculationEvent.TITLE_ADD,
-                license_pool=license_pool,
-                create_method_kwargs=dict(
-                    start=license_pool.last_checked
+        start = time.time()
+        books = 0
+        new_books = 0
+        in_batch = 0
+        for edition, license_pool, new in self.source.update_books(
+                subset, processes=self.processes):
+            books += 1
+            if new:
+                # Log a circulation event for this title. The license
+                # pool is brand new, so there's no need to check
+                # whether the event already exists.
+                new_books += 1
+                event = CirculationEvent(
+                    type=CirculationEvent.TITLE_ADD,
+                    license_pool=license_pool,
+                    start=license_pool.last_checked,
                 )
-            )
+                self._db.add(event)
+
+            in_batch += 1
+            if in_batch >= self.batch_size:
+                self.finish_batch()
+                in_batch = 0
+        self.finish_batch()
+
+        # We made it all the way through the catalog.
+        self.source.clear_checkpoint()
 
-            self._db.commit()
+        elapsed = time.time() - start
+        self.log.info(
+            "Applied %d Gutenberg books (%d new) in %.1f sec: %.1f books/sec",
+            books, new_books, elapsed, books / max(elapsed, 0.001)
+        )
+
+    def finish_batch(self):
+        """Commit the current batch of books and note how far through
+        the catalog we've gotten.
+        """
+        self._db.commit()
+        self.source.save_checkpoint()
 
@@ -6,7 +6,10 @@ from core.model import (
     LicensePool,
     Work,
 )
-from core.lane import QueryGeneratedLane
+from core.lane import (
+    Pagination,
+    QueryGeneratedLane,
+)
 
 
 class StaticFeedBaseLane(QueryGeneratedLane):
@@ -54,3 +57,53 @@ class StaticFeedParentLane(QueryGeneratedLane):
         for lane in self.base_sublanes:
             identifiers += lane.identifiers
         return Work.from_identifiers(self._db, identifiers, base_query=qu)
+
+
+class PrefetchedPagination(Pagination):
+
+    """Pagination through a list of works that has already been loaded,
+    so each page can be cut out of the list without a query.
+    """
+
+    def __init__(self, works, offset=0, size=Pagination.DEFAULT_SIZE):
+        super(PrefetchedPagination, self).__init__(offset=offset, size=size)
+        self.works = works
+
+    @property
+    def page_works(self):
+        return self.works[self.offset:self.offset+self.size]
+
+    @property
+    def has_next_page(self):
+        return self.offset + self.size < len(self.works)
+
+    @property
+    def next_page(self):
+        return PrefetchedPagination(
+            self.works, offset=self.offset+self.size, size=self.size
+        )
+
+
+class PrefetchedLane(object):
+
+    """Stands in for a lane whose works have all been loaded, and hands
+    out the page of them that a PrefetchedPagination asks for.
+    Everything else comes from the real lane.
+    """
+
+    def __init__(self, lane):
+        self.lane = lane
+
+    def works(self, facets=None, pagination=None, **kwargs):
+        return PageOfWorks(pagination.page_works)
+
+    def __getattr__(self, name):
+        return getattr(self.lane, name)
+
+
+class PageOfWorks(list):
+
+    """A page of works that can be used where a query is expected."""
+
+    def all(self):
+        return list(self)
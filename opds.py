@@ -4,7 +4,12 @@ from collections import defaultdict
 from datetime import datetime
 from nose.tools import set_trace
 from flask import url_for
-from sqlalchemy.orm import lazyload
+from lxml import etree
+from sqlalchemy import event
+from sqlalchemy.orm import (
+    joinedload,
+    lazyload,
+)
 
 from core.app_server import cdn_url_for
 from core.classifier import Classifier
@@ -16,13 +21,16 @@ from core.opds import (
     VerboseAnnotator,
 )
 from core.model import (
+    Hyperlink,
     Identifier,
+    Representation,
     Resource,
     Session,
     Subject,
     Work,
     Edition,
     LicensePool,
+    LicensePoolDeliveryMechanism,
 )
 from core.util import slugify
 
@@ -30,15 +38,41 @@ from config import Configuration
 
 class ContentServerAnnotator(VerboseAnnotator):
 
+    # Changes to these kinds of objects can make a prerendered entry
+    # out of date.
+    PRERENDERED_DEPENDENCIES = (
+        Hyperlink, LicensePool, LicensePoolDeliveryMechanism,
+        Representation, Resource,
+    )
+
     @classmethod
     def annotate_work_entry(cls, work, active_license_pool, edition, identifier, feed, entry):
         """Annotate the feed with all open-access links for this book."""
         if not active_license_pool.open_access:
             return
 
+        # A ContentServerAcquisitionFeed has already loaded the links
+        # for every work in it.
+        prefetched = getattr(feed, 'open_access_links', None)
+        if prefetched is not None:
+            resources = prefetched.get(identifier.id, [])
+        else:
+            resources = active_license_pool.open_access_links
+
+        if cls.is_prerendered(entry):
+            # This entry came out of the cache with its annotations
+            # already in place. See prerender_entry(). The cache is
+            # cleared when the work's links change, but the work still
+            # has to be fulfillable right now.
+            if not any(resource.representation
+                       and resource.representation.mirror_url
+                       for resource in resources):
+                raise UnfulfillableWork()
+            return
+
         rel = OPDSFeed.OPEN_ACCESS_REL
         fulfillable = False
-        for resource in active_license_pool.open_access_links:
+        for resource in resources:
             if not resource.representation:
                 continue
             url = resource.representation.mirror_url
@@ -64,6 +98,102 @@ class ContentServerAnnotator(VerboseAnnotator):
             work, active_license_pool, edition, identifier, feed, entry
         )
 
+    @classmethod
+    def is_prerendered(cls, entry):
+        """Has this entry already been annotated?
+
+        A freshly made entry never has open-access links; they're only
+        added by annotate_work_entry().
+        """
+        if entry is None:
+            return False
+        return bool(entry.xpath(
+            '*[local-name()="link"][@rel=$rel]', rel=OPDSFeed.OPEN_ACCESS_REL
+        ))
+
+    @classmethod
+    def prerender_entry(cls, work):
+        """Replace a work's cached verbose OPDS entry with the fully
+        annotated entry, so rendering it in a feed doesn't have to
+        look at the work's links and their representations again.
+
+        :return: The annotated entry, or None if the work can't be
+            shown in a feed.
+        """
+        _db = Session.object_session(work)
+        entry = AcquisitionFeed.single_entry(_db, work, cls())
+        if not isinstance(entry, etree._Element):
+            return None
+        work.verbose_opds_entry = etree.tostring(entry)
+        return entry
+
+    @classmethod
+    def forget_prerendered_entry(cls, work):
+        """Make sure a work's open-access links are looked up again
+        the next time it's put in a feed.
+        """
+        if work and work.verbose_opds_entry:
+            work.verbose_opds_entry = None
+
+    @classmethod
+    def works_affected_by(cls, obj):
+        """Find the works whose prerendered entries might be out of
+        date once a change to a license pool, a delivery mechanism, a
+        link, a resource or a representation is saved.
+        """
+        if isinstance(obj, LicensePool):
+            return [obj.work]
+
+        identifiers = []
+        if isinstance(obj, (Hyperlink, LicensePoolDeliveryMechanism)):
+            identifiers = [obj.identifier]
+        elif isinstance(obj, Representation) and obj.resource:
+            identifiers = [link.identifier for link in obj.resource.links]
+        elif isinstance(obj, Resource):
+            identifiers = [link.identifier for link in obj.links]
+
+        works = []
+        for identifier in identifiers:
+            if not identifier:
+                continue
+            pools = identifier.licensed_through
+            if not isinstance(pools, list):
+                pools = [pools]
+            works.extend(pool.work for pool in pools if pool)
+        return works
+
+    @classmethod
+    def watch_session(cls, session):
+        """Clear prerendered entries whenever a change that makes them
+        out of date is flushed from this session.
+
+        Only the content server itself and the scripts that import
+        books or mirror them need this, so the listener is added to
+        their sessions rather than to every session.
+        """
+        listener = cls.forget_stale_prerendered_entries
+        if not event.contains(session, "before_flush", listener):
+            event.listen(session, "before_flush", listener)
+
+    @classmethod
+    def forget_stale_prerendered_entries(cls, session, flush_context, instances):
+        """Before the session is flushed, clear the prerendered entries
+        of any works whose license pools or links are being changed.
+
+        See watch_session().
+        """
+        changed = list(session.new) + list(session.deleted) + [
+            obj for obj in session.dirty if session.is_modified(obj)
+        ]
+        for obj in changed:
+            if not isinstance(obj, cls.PRERENDERED_DEPENDENCIES):
+                continue
+            for work in cls.works_affected_by(obj):
+                if work and work.verbose_opds_entry and (
+                    OPDSFeed.OPEN_ACCESS_REL in work.verbose_opds_entry
+                ):
+                    cls.forget_prerendered_entry(work)
+
     @classmethod
     def default_lane_url(cls):
         return cdn_url_for("feed", _external=True)
@@ -84,28 +214,167 @@ class ContentServerAnnotator(VerboseAnnotator):
         return cdn_url_for(view, _external=True, **kwargs)
 
 
-class AllCoverLinksAnnotator(ContentServerAnnotator):
+class ContentServerAcquisitionFeed(AcquisitionFeed):
+
+    """An AcquisitionFeed that loads everything ContentServerAnnotator
+    needs for its works up front, so that a page takes the same number
+    of queries however many works are on it.
+    """
+
+    def __init__(self, _db, title, url, works, annotator=None, **kwargs):
+        works = list(works)
+        self.open_access_links = self.prefetch(_db, works)
+        if isinstance(annotator, AllCoverLinksAnnotator):
+            annotator.prefetch_covers(_db, works)
+        super(ContentServerAcquisitionFeed, self).__init__(
+            _db, title, url, works, annotator, **kwargs
+        )
 
     @classmethod
-    def cover_links(cls, work):
+    def prefetch(cls, _db, works):
+        """Load the license pools and identifiers of these works, and
+        the open-access links of those identifiers along with their
+        representations.
+
+        :param works: Works or materialized works.
+        :return: A dictionary mapping identifier ID to a list of
+            open-access Resources, each of them listed once.
+        """
+        pool_ids = set()
+        for work in works:
+            pool_id = getattr(work, 'license_pool_id', None)
+            if pool_id:
+                pool_ids.add(pool_id)
+            else:
+                pool_ids.update(pool.id for pool in work.license_pools)
+
+        links = defaultdict(list)
+        if not pool_ids:
+            return links
+
+        # Once these are in the session, the lazy loads of
+        # work.license_pool and license_pool.identifier don't need
+        # to query the database.
+        pools = _db.query(LicensePool).filter(
+            LicensePool.id.in_(pool_ids)
+        ).options(joinedload(LicensePool.identifier)).all()
+
+        identifier_ids = [pool.identifier_id for pool in pools]
+        qu = _db.query(Hyperlink.identifier_id, Resource).join(
+            Hyperlink.resource
+        ).filter(
+            Hyperlink.identifier_id.in_(identifier_ids),
+            Hyperlink.rel==Hyperlink.OPEN_ACCESS_DOWNLOAD,
+        ).options(joinedload(Resource.representation))
+        seen = set()
+        for identifier_id, resource in qu:
+            if (identifier_id, resource.id) in seen:
+                # More than one link, e.g. from different data
+                # sources, points to this resource.
+                continue
+            seen.add((identifier_id, resource.id))
+            links[identifier_id].append(resource)
+        return links
+
+
+class AllCoverLinksAnnotator(ContentServerAnnotator):
+
+    # How many equivalencies to follow when looking for covers.
+    EQUIVALENT_IDENTIFIER_LEVELS = 5
+
+    def __init__(self, max_cover_links=None):
+        """Constructor.
+
+        :param max_cover_links: Send out at most this many full-size
+            covers and this many thumbnails for a work.
+        """
+        self.max_cover_links = max_cover_links
+        self.covers_by_work = {}
+
+    def cover_links(self, work):
         """The content server sends out _all_ cover links for the work.
 
         For books covered by Gutenberg Illustrated, this can be over a
         hundred cover links.
         """
+        key = self._work_key(work)
+        if key in self.covers_by_work:
+            # prefetch_covers() found these along with the covers for
+            # the rest of the page.
+            return self.covers_by_work[key]
+
         _db = Session.object_session(work)
-        ids = work.all_identifier_ids()
+        ids = work.all_identifier_ids(self.EQUIVALENT_IDENTIFIER_LEVELS)
         image_resources = Identifier.resources_for_identifier_ids(
             _db, ids, Resource.IMAGE)
+        return self._cover_lists(image_resources)
+
+    def prefetch_covers(self, _db, works):
+        """Find the covers for a whole page of works at once: one pass
+        to find every identifier equivalent to any of the works, and
+        one query for all of their images.
+        """
+        primary_ids = dict()
+        for work in works:
+            pools = getattr(work, 'license_pools', None)
+            if pools is None:
+                # A materialized work has only the one pool.
+                pools = [work.license_pool]
+            primary_ids[self._work_key(work)] = [
+                pool.identifier_id for pool in pools if pool.identifier_id
+            ]
+        all_primary_ids = set()
+        for ids in primary_ids.values():
+            all_primary_ids.update(ids)
+        if not all_primary_ids:
+            return
+
+        equivalents = Identifier.recursively_equivalent_identifier_ids(
+            _db, list(all_primary_ids), self.EQUIVALENT_IDENTIFIER_LEVELS
+        )
+        all_ids = set()
+        for ids in equivalents.values():
+            all_ids.update(ids)
+
+        resources_by_identifier = defaultdict(list)
+        qu = Identifier.resources_for_identifier_ids(
+            _db, list(all_ids), Resource.IMAGE
+        ).add_columns(Hyperlink.identifier_id)
+        for resource, identifier_id in qu:
+            resources_by_identifier[identifier_id].append(resource)
+
+        for key, ids in primary_ids.items():
+            identifier_ids = set()
+            for primary_id in ids:
+                identifier_ids.update(equivalents.get(primary_id, [primary_id]))
+            image_resources = []
+            for identifier_id in identifier_ids:
+                image_resources.extend(resources_by_identifier[identifier_id])
+            self.covers_by_work[key] = self._cover_lists(image_resources)
+
+    def _cover_lists(self, image_resources):
         thumbnails = []
         full = []
+        seen = set()
         for cover in image_resources:
+            if cover in seen:
+                # More than one of the work's identifiers links to
+                # this image.
+                continue
+            seen.add(cover)
             if cover.mirrored_path:
                 full.append(cover.mirrored_path)
             if cover.scaled_path:
                 thumbnails.append(cover.scaled_path)
+        if self.max_cover_links is not None:
+            thumbnails = thumbnails[:self.max_cover_links]
+            full = full[:self.max_cover_links]
         return thumbnails, full
 
+    @classmethod
+    def _work_key(cls, work):
+        return getattr(work, 'works_id', None) or work.id
+
 
 class StaticFeedAnnotator(ContentServerAnnotator):
 
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 from nose.tools import set_trace
 
@@ -22,6 +23,93 @@ class S3Uploader(BaseS3Uploader):
             filename += extension
         return root + filename
 
+    # Read local files this many bytes at a time when checksumming.
+    CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+    def mirror_one_if_changed(self, representation):
+        """Mirror a single representation, unless the same content is
+        already at its mirror URL.
+        """
+        return self.mirror_batch_if_changed([representation])
+
+    def mirror_batch_if_changed(self, representations):
+        """Mirror the given representations, skipping the ones whose
+        content is already at their mirror URLs.
+
+        The MD5 of each representation's content is compared against
+        the ETag S3 has for the mirror URL, which is the MD5 of the
+        object unless it was uploaded in several parts.
+
+        :return: The representations that were actually uploaded.
+        """
+        checksums = dict(
+            (representation, self.checksum(representation))
+            for representation in representations
+        )
+        etags = self.remote_etags(
+            [representation.mirror_url for representation in representations
+             if representation.mirror_url and checksums[representation]]
+        )
+
+        to_upload = []
+        for representation in representations:
+            checksum = checksums[representation]
+            if checksum and etags.get(representation.mirror_url) == checksum:
+                logging.info(
+                    "%s is unchanged, not uploading.", representation.mirror_url)
+                representation.set_as_mirrored()
+            else:
+                to_upload.append(representation)
+
+        if to_upload:
+            self.mirror_batch(to_upload)
+        return to_upload
+
+    @classmethod
+    def checksum(cls, representation):
+        """The hex MD5 of a representation's content, or None if it has
+        no content we can get to.
+        """
+        md5 = hashlib.md5()
+        if representation.local_content_path:
+            try:
+                with open(representation.local_content_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(cls.CHECKSUM_CHUNK_SIZE), ''):
+                        md5.update(chunk)
+            except IOError, e:
+                return None
+        elif representation.content:
+            md5.update(representation.content)
+        else:
+            return None
+        return md5.hexdigest()
+
+    def remote_etags(self, urls):
+        """Find the ETags S3 has for the given mirror URLs.
+
+        The HEAD requests go through the connection pool, so they
+        happen concurrently.
+
+        :return: A dictionary mapping each URL that exists in S3 to
+            its ETag, without the surrounding quotes.
+        """
+        futures = []
+        for url in urls:
+            bucket, filename = self.bucket_and_filename(url)
+            futures.append((url, self.pool.head_object(filename, bucket)))
+
+        etags = dict()
+        for url, future in futures:
+            try:
+                response = future.result()
+            except Exception, e:
+                # Most likely the file isn't there yet.
+                continue
+            etag = response.headers.get('ETag')
+            if etag:
+                etags[url] = etag.strip('"')
+        return etags
+
     def delete_batch(self, keys, _db=None, external_hosts=None):
         """Deletes files identified by their keys (i.e. mirror urls)
         from s3 bucket and--if a database session is provided--their
@@ -87,4 +175,16 @@ class S3Uploader(BaseS3Uploader):
 
 
 class DummyS3Uploader(BaseDummyS3Uploader, S3Uploader):
-    pass
+
+    def __init__(self, *args, **kwargs):
+        super(DummyS3Uploader, self).__init__(*args, **kwargs)
+        # Maps mirror URLs to the ETags they should appear to have.
+        self.etags = dict()
+        # The mirror URLs of deleted files.
+        self.deleted = list()
+
+    def remote_etags(self, urls):
+        return dict((url, self.etags[url]) for url in urls if url in self.etags)
+
+    def delete_batch(self, keys, _db=None, external_hosts=None):
+        self.deleted.extend(keys)
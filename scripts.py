@@ -1,18 +1,35 @@
 import argparse
+import contextlib
 import csv
+import hashlib
+import json
+import multiprocessing
 import os
 import re
+import tarfile
+import time
+import urllib
 import yaml
-from collections import defaultdict
+from collections import (
+    defaultdict,
+    deque,
+)
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 from nose.tools import set_trace
 from lxml import etree
 
 from sqlalchemy import (
+    inspect,
     not_,
     or_,
 )
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import (
+    joinedload,
+    subqueryload,
+)
+from sqlalchemy.orm.state import InstanceState
 from sqlalchemy.orm.exc import (
     NoResultFound,
 )
@@ -58,6 +75,7 @@ from core.model import (
     create,
     get_one,
     get_one_or_create,
+    production_session,
 )
 from core.monitor import MakePresentationReadyMonitor
 from core.opds import AcquisitionFeed
@@ -72,14 +90,25 @@ from config import (
     Configuration,
     temp_config,
 )
-from coverage import GutenbergEPUBCoverageProvider
+from coverage import (
+    GutenbergEPUBCoverageProvider,
+    GutenbergEPUBIndex,
+)
+from gutenberg import (
+    GutenbergAPI,
+    GutenbergMonitor,
+    GutenbergRDFExtractor,
+    GutenbergLxmlRDFExtractor,
+)
 from lanes import (
+    PrefetchedLane,
+    PrefetchedPagination,
     StaticFeedBaseLane,
     StaticFeedParentLane,
 )
 from marc import MARCExtractor
-from monitor import GutenbergMonitor
 from opds import (
+    ContentServerAcquisitionFeed,
     ContentServerAnnotator,
     StaticFeedAnnotator,
     StaticFeedCOPPAAnnotator,
@@ -171,14 +200,293 @@ class GutenbergMonitorScript(Script):
 
     subset = None
 
-    def run(self):
+    EXTRACTORS = {
+        'rdflib' : GutenbergRDFExtractor,
+        'lxml' : GutenbergLxmlRDFExtractor,
+    }
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='Parse the RDF catalog in this many worker processes.'
+        )
+        parser.add_argument(
+            '--extractor', choices=sorted(cls.EXTRACTORS), default='rdflib',
+            help='The way to extract information from the RDF catalog.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=GutenbergMonitor.DEFAULT_BATCH_SIZE,
+            help='Commit after this many books.'
+        )
+        return parser
+
+    def run(self, cmd_args=None):
+        parsed = self.arg_parser().parse_args(cmd_args)
+        ContentServerAnnotator.watch_session(self._db)
         GutenbergMonitor(
-            self._db, self.data_directory).run(self.subset)
+            self._db, self.data_directory, processes=parsed.processes,
+            extractor=self.EXTRACTORS[parsed.extractor],
+            batch_size=parsed.batch_size,
+        ).run(self.subset)
+
+
+class GutenbergRDFBenchmarkScript(Script):
+
+    """Compare the speed and the output of the Gutenberg RDF extractors."""
+
+    EXTRACTORS = [GutenbergRDFExtractor, GutenbergLxmlRDFExtractor]
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            'files', nargs='*',
+            help='RDF files to parse. By default, records are taken from '\
+            'the downloaded Project Gutenberg catalog.'
+        )
+        parser.add_argument(
+            '--limit', type=int, default=1000,
+            help='The number of records to take from the catalog.'
+        )
+        return parser
+
+    def do_run(self, cmd_args=None):
+        parsed = self.arg_parser().parse_args(cmd_args)
+        if parsed.files:
+            documents = [(path, open(path).read()) for path in parsed.files]
+        else:
+            documents = list(self.catalog_documents(parsed.limit))
+
+        timings, differences = self.benchmark(documents)
+
+        print "%-30s %8s %12s %16s" % (
+            "Extractor", "Records", "Total (s)", "Per record (ms)")
+        for extractor in self.EXTRACTORS:
+            total = timings[extractor]
+            per_record = 0
+            if documents:
+                per_record = total / len(documents) * 1000
+            print "%-30s %8d %12.2f %16.3f" % (
+                extractor.__name__, len(documents), total, per_record)
+
+        if differences:
+            print "%d records were extracted differently:" % len(differences)
+            for name in differences:
+                print "    %s" % name
+        else:
+            print "All extractors agree on all records."
+
+    def catalog_documents(self, limit):
+        """Yield (name, RDF document) 2-tuples from the Project Gutenberg
+        catalog.
+        """
+        catalog_path = os.path.join(
+            self.data_directory, DataSource.GUTENBERG, GutenbergAPI.FILENAME)
+        archive = tarfile.open(catalog_path, "r|bz2")
+        try:
+            count = 0
+            for item in archive:
+                archive.members = []
+                if not (item.isfile() and item.name.endswith(".rdf")):
+                    continue
+                yield item.name, archive.extractfile(item).read()
+                count += 1
+                if count >= limit:
+                    break
+        finally:
+            archive.close()
+
+    def benchmark(self, documents):
+        """Parse every document with every extractor.
+
+        :return: A 2-tuple (total parse time in seconds for each
+            extractor, names of documents the extractors disagreed on).
+        """
+        timings = defaultdict(float)
+        differences = []
+        for name, data in documents:
+            results = []
+            for extractor in self.EXTRACTORS:
+                start = time.time()
+                try:
+                    record = extractor.record_in(name, StringIO(data))
+                except Exception, e:
+                    record = repr(e)
+                timings[extractor] += time.time() - start
+                if isinstance(record, dict):
+                    record = extractor.comparable(record)
+                results.append(record)
+            if any(x != results[0] for x in results[1:]):
+                differences.append(name)
+        return timings, differences
+
+
+class URNLookupBenchmarkScript(Script):
+
+    """Time lookup requests for different numbers of URNs, with the
+    default controller and with the bulk controller.
+    """
+
+    SIZES = [1, 100, 1000]
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=cls.SIZES,
+            help='The numbers of URNs to look up in one request.'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='Time each request this many times and keep the best.'
+        )
+        return parser
+
+    def do_run(self, cmd_args=None):
+        # Importing the app sets up the routes that the lookup feed
+        # links to.
+        from app import app
+        from controller import BulkURNLookupController
+        from core.app_server import URNLookupController
+
+        parsed = self.arg_parser().parse_args(cmd_args)
+        urns = self.urns(max(parsed.sizes))
+        controllers = [URNLookupController, BulkURNLookupController]
+
+        print "%-28s %8s %12s %14s" % (
+            "Controller", "URNs", "Best (s)", "Per URN (ms)")
+        for size in parsed.sizes:
+            query_string = urllib.urlencode([('urn', x) for x in urns[:size]])
+            for controller_class in controllers:
+                best = None
+                for i in range(parsed.repeat):
+                    with app.test_request_context(
+                            '/lookup', query_string=query_string):
+                        start = time.time()
+                        controller_class(self._db).work_lookup(
+                            ContentServerAnnotator)
+                        elapsed = time.time() - start
+                    # Don't keep anything a lookup may have created.
+                    self._db.rollback()
+                    if best is None or elapsed < best:
+                        best = elapsed
+                print "%-28s %8d %12.3f %14.3f" % (
+                    controller_class.__name__, min(size, len(urns)), best,
+                    best / max(min(size, len(urns)), 1) * 1000)
+
+    def urns(self, limit):
+        """Find the URNs of presentation-ready, licensed books."""
+        qu = self._db.query(Identifier).join(
+            LicensePool, LicensePool.identifier_id==Identifier.id
+        ).join(Work, LicensePool.work_id==Work.id).filter(
+            Work.presentation_ready==True
+        ).order_by(Identifier.id).limit(limit)
+        return [identifier.urn for identifier in qu]
+
+
+class GutenbergSkipListScript(Script):
+
+    """Show the Project Gutenberg books that are being skipped because
+    their RDF describes no book or couldn't be parsed, and optionally
+    give them another chance.
+    """
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            'pg_ids', nargs='*',
+            help='Only consider these Project Gutenberg IDs.'
+        )
+        parser.add_argument(
+            '--clear', action='store_true',
+            help='Remove books from the skip list, so the next run of '\
+            'the Gutenberg monitor tries them again.'
+        )
+        return parser
+
+    def do_run(self, cmd_args=None, api=None):
+        parsed = self.arg_parser().parse_args(cmd_args)
+        api = api or GutenbergAPI(
+            self._db, os.path.join(self.data_directory, DataSource.GUTENBERG))
+        pg_ids = parsed.pg_ids or None
+
+        if parsed.clear:
+            cleared = api.clear_skip_list(pg_ids)
+            print "Cleared %d books from the skip list." % len(cleared)
+            return
+
+        skip_list = api.load_skip_list()
+        for pg_id in sorted(pg_ids or skip_list, key=int):
+            if pg_id not in skip_list:
+                continue
+            entry = skip_list[pg_id]
+            skipped_at = datetime.utcfromtimestamp(entry['skipped_at'])
+            print "%-8s %s %s" % (
+                pg_id, skipped_at.strftime("%Y-%m-%d %H:%M"), entry['reason'])
+
+
+class GutenbergEPUBIndexScript(Script):
+
+    """Bring the index of the Project Gutenberg EPUB mirror up to date
+    after the mirror has been rsynced.
+    """
+
+    # A path mentioned in rsync's verbose output, e.g.
+    # "12345/pg12345-images.epub".
+    CHANGED_PATH = re.compile("^(?:deleting )?([0-9]+)(/|$)")
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--changed',
+            help='A file containing the output of rsync -v. Only the '\
+            'directories it mentions will be re-indexed.'
+        )
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Throw away the index and index the whole mirror again.'
+        )
+        return parser
+
+    def do_run(self, cmd_args=None):
+        parsed = self.arg_parser().parse_args(cmd_args)
+        epub_mirror = os.path.join(
+            self.data_directory, DataSource.GUTENBERG, "gutenberg-epub")
+        index = None
+        if not parsed.rebuild:
+            index = GutenbergEPUBIndex.for_mirror(epub_mirror)
+        if not index:
+            index = GutenbergEPUBIndex(
+                epub_mirror, GutenbergEPUBIndex.path_for(epub_mirror))
+
+        pg_ids = None
+        if parsed.changed and index.directories:
+            with open(parsed.changed) as f:
+                pg_ids = self.changed_ids(f)
+        index.refresh(pg_ids)
+
+    @classmethod
+    def changed_ids(cls, lines):
+        """Find the Gutenberg IDs whose directories are mentioned in
+        rsync's output.
+        """
+        pg_ids = set()
+        for line in lines:
+            match = cls.CHANGED_PATH.search(line.strip())
+            if match:
+                pg_ids.add(match.groups()[0])
+        return pg_ids
 
 
 class MakePresentationReadyScript(Script):
 
     def run(self):
+        ContentServerAnnotator.watch_session(self._db)
         epub = GutenbergEPUBCoverageProvider(self._db)
 
         providers = [epub]
@@ -207,6 +515,7 @@ class DirectoryImportScript(Script):
                     data_source_name, collection))
 
     def run(self, data_source_name, metadata_records, epub_directory, cover_directory):
+        ContentServerAnnotator.watch_session(self._db)
         self.create_collection(data_source_name)
 
         replacement_policy = ReplacementPolicy(rights=True, links=True, formats=True, contributions=True)
@@ -269,7 +578,7 @@ class DirectoryImportScript(Script):
                     representation.mirror_url = link.resource.url
                     representation.local_content_path = paths[link.resource.url]
                     try:
-                        uploader.mirror_one(representation)
+                        uploader.mirror_one_if_changed(representation)
                         if link.rel == Hyperlink.IMAGE:
                             height = 300
                             width = 200
@@ -282,7 +591,7 @@ class DirectoryImportScript(Script):
                                 height, width, thumbnail_url, 
                                 Representation.PNG_MEDIA_TYPE
                             )
-                            uploader.mirror_one(thumbnail)
+                            uploader.mirror_one_if_changed(thumbnail)
                     except ValueError, e:
                         print "Failed to mirror file %s" % representation.local_content_path, e
             work, ignore = pool.calculate_work()
@@ -303,6 +612,7 @@ class OPDSImportScript(BaseOPDSImportScript):
                  collection_data=None, _db=None
     ):
         super(OPDSImportScript, self).__init__(_db=_db)
+        ContentServerAnnotator.watch_session(self._db)
 
         self.IMPORTER_CLASS = importer_class
 
@@ -1095,6 +1405,30 @@ class StaticFeedGenerationScript(StaticFeedScript):
 
     __library = None
 
+    # Whether feed_pages() loads all of a feed's works with one
+    # query by default.
+    single_query = False
+
+    # The sitewide setting that keeps track of the feed files uploaded
+    # to a bucket and prefix, and a hash of what's in each one.
+    MANIFEST_KEY = u"static_feed_manifest"
+
+    # The feed-level timestamp that's left out of a feed file's hash.
+    FEED_UPDATED = re.compile(r"<(\w+:)?updated>[^<]*</(\w+:)?updated>")
+
+    # How many feed files are uploaded to S3 at once.
+    UPLOAD_BATCH_SIZE = 50
+
+    # How many results each worker process or thread may have in
+    # flight ahead of the one that's being used.
+    RESULTS_PER_PROCESS = 2
+
+    # How many documents go into one bulk request to the search index.
+    INDEX_CHUNK_SIZE = 500
+
+    # How many of a chunk's search index errors are logged.
+    LOGGED_INDEX_ERRORS = 5
+
     @classmethod
     def arg_parser(cls):
         parser = argparse.ArgumentParser()
@@ -1118,6 +1452,24 @@ class StaticFeedGenerationScript(StaticFeedScript):
         parser.add_argument(
             '--search-index', help='Upload to this elasticsearch index. elasticsearch-url must also be included'
         )
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='Render the feeds in this many worker processes.'
+        )
+        parser.add_argument(
+            '--single-query', action='store_true',
+            help='Load all the works for a feed at once, rather than '\
+            'running a query for every page.'
+        )
+        parser.add_argument(
+            '--reupload', action='store_true',
+            help='Upload every feed file, even the ones that are the '\
+            'same as last time.'
+        )
+        parser.add_argument(
+            '--index-threads', type=int, default=1,
+            help='Send this many bulk requests to the search index at once.'
+        )
         return parser
 
     @property
@@ -1135,14 +1487,18 @@ class StaticFeedGenerationScript(StaticFeedScript):
 
     def feed_pages_by_filename(self, feed_id, full_lane, youth_lane=None,
                                prefix='', license_link=None, include_search=False,
-                               enabled_facets=None, page_size=None
+                               enabled_facets=None, page_size=None, processes=None
     ):
-        """Creates and returns static feed content.
+        """Creates static feed content.
+
+        Feeds are rendered as they're needed, so only a few of them
+        are in memory at once.
 
-        :return: A list of tuples (prospective filename, AcquistionFeed
-        representing the static feed)
+        :param processes: If this is more than one, the feeds are
+            rendered in a pool of this many worker processes.
+
+        :yield: Tuples (prospective filename, pages of the static feed)
         """
-        feeds = list()
         annotator = None
         if youth_lane:
             # When a youth lane exists, we create a navigation feed to
@@ -1154,9 +1510,8 @@ class StaticFeedGenerationScript(StaticFeedScript):
                 license_link=license_link,
                 include_search=include_search,
             )
-            feeds.append((
-                prefix + StaticFeedCOPPAAnnotator.HOME_FILENAME,
-                [unicode(nav_feed)]))
+            yield (prefix + StaticFeedCOPPAAnnotator.HOME_FILENAME,
+                   [unicode(nav_feed)])
 
             annotator = StaticFeedCOPPAAnnotator(
                 feed_id, youth_lane,
@@ -1165,11 +1520,14 @@ class StaticFeedGenerationScript(StaticFeedScript):
                 include_search=include_search,
             )
 
-            feeds += list(self.create_feeds(
+            for feed in self.create_feeds(
                 [youth_lane], annotator,
                 enabled_facets=enabled_facets,
-                page_size=page_size
-            ))
+                page_size=page_size,
+                processes=processes,
+                stream=True
+            ):
+                yield feed
         else:
             # Without a youth feed, we don't need to create a navigation feed.
             annotator = StaticFeedAnnotator(
@@ -1179,19 +1537,48 @@ class StaticFeedGenerationScript(StaticFeedScript):
                 include_search=include_search,
             )
 
-        feeds += list(self.create_feeds(
+        for feed in self.create_feeds(
             [full_lane], annotator,
             enabled_facets=enabled_facets,
-            page_size=page_size
-        ))
-        return feeds
-
-    def create_feeds(self, lanes, annotator, enabled_facets=None, page_size=None):
+            page_size=page_size,
+            processes=processes,
+            stream=True
+        ):
+            yield feed
+
+    def create_feeds(self, lanes, annotator, enabled_facets=None,
+                     page_size=None, processes=None, stream=False):
         """Creates feeds for facets that may be required
 
+        :param processes: If this is more than one, the feeds are
+            rendered in a pool of this many worker processes.
+
+        :param stream: Render each feed's pages one at a time, as
+            they're asked for, instead of all at once. The annotator
+            is shared between feeds, so each feed's pages must be used
+            up before the next feed is asked for. Feeds rendered in a
+            pool of worker processes always come back whole.
+
         :return: A dictionary of filenames pointing to a list of CachedFeed
         objects representing pages
         """
+        units = self.feed_units(
+            lanes, annotator, enabled_facets=enabled_facets,
+            page_size=page_size
+        )
+        if processes and processes > 1:
+            return self.render_in_pool(list(units), annotator, processes)
+        return (self.render_feed_unit(unit, annotator, stream=stream)
+                for unit in units)
+
+    def feed_units(self, lanes, annotator, enabled_facets=None, page_size=None):
+        """Find every feed that needs to be rendered for these lanes and
+        their sublanes.
+
+        :yield: (filename, lane, lane URL, facets, pagination) 5-tuples.
+            An intermediate lane gets a groups feed, and no facets or
+            pagination.
+        """
         for lane in lanes:
             annotator.reset(lane)
             filename = annotator.lane_filename()
@@ -1199,19 +1586,11 @@ class StaticFeedGenerationScript(StaticFeedScript):
             if lane.sublanes:
                 # This is an intermediate lane, without its own works.
                 # It needs a groups feed.
-                self.log.info("Creating groups feed for lane: %s", lane.name)
-                feed = AcquisitionFeed.groups(
-                    self._db, lane.name, url, lane, annotator,
-                    cache_type=AcquisitionFeed.NO_CACHE,
-                    use_materialized_works=False
-                )
-                yield filename, [feed]
+                yield filename, lane, url, None, None
 
                 # Return filenames and feeds for any sublanes as well.
-                for filename, feeds in self.create_feeds(
-                    lane.sublanes, annotator
-                ):
-                    yield filename, feeds
+                for unit in self.feed_units(lane.sublanes, annotator):
+                    yield unit
             else:
                 enabled_facets = enabled_facets or self.DEFAULT_ENABLED_FACETS
                 static_facets = Facets(
@@ -1222,43 +1601,303 @@ class StaticFeedGenerationScript(StaticFeedScript):
                     enabled_facets=enabled_facets
                 )
 
-                self.log.info("Creating feed pages for lane: %s", lane.name)
                 for facet_group in list(static_facets.facet_groups):
                     ordered_by, facet_obj = facet_group[1:3]
                     pagination = Pagination.default()
                     if page_size:
                         pagination.size = page_size
 
-                    feed_pages = self.create_feed_pages(
-                        lane, pagination, url, annotator, facet_obj
-                    )
-
                     if ordered_by != annotator.DEFAULT_ORDER:
                         filename += ('_' + ordered_by)
-                    yield filename, feed_pages
+                    yield filename, lane, url, facet_obj, pagination
+
+    def render_feed_unit(self, unit, annotator, stream=False):
+        """Render one of the feeds from feed_units().
+
+        :param stream: Render the pages as they're asked for.
+
+        :return: A (filename, list of pages) 2-tuple. If `stream` is
+            set, the pages come from a generator instead of a list.
+        """
+        filename, lane, url, facet_obj, pagination = unit
+        annotator.reset(lane)
+        if facet_obj is None:
+            self.log.info("Creating groups feed for lane: %s", lane.name)
+            feed = AcquisitionFeed.groups(
+                self._db, lane.name, url, lane, annotator,
+                cache_type=AcquisitionFeed.NO_CACHE,
+                use_materialized_works=False
+            )
+            return filename, [feed]
+
+        self.log.info("Creating feed pages for lane: %s", lane.name)
+        feed_pages = self.feed_pages(
+            lane, pagination, url, annotator, facet_obj
+        )
+        if not stream:
+            feed_pages = list(feed_pages)
+        return filename, feed_pages
+
+    def render_in_pool(self, units, annotator, processes):
+        """Render feeds in a pool of worker processes.
+
+        The workers are forked from this process, so they start out
+        with the lanes and the annotator, and only need to be told
+        which unit to render.
+
+        Only RESULTS_PER_PROCESS feeds for each process are rendered
+        ahead of the one that's been asked for, so rendered feeds don't
+        pile up in memory when they're used more slowly than they're
+        made.
+
+        :yield: (filename, list of pages) 2-tuples, in the same order
+            as the units, so the result is the same as rendering them
+            one after another.
+        """
+        global _static_feed_job
+        _static_feed_job = (self, units, annotator)
+        self.close_connections()
+        pool = multiprocessing.Pool(processes, _start_static_feed_worker)
+        try:
+            in_flight = deque()
+            next_index = 0
+            max_in_flight = processes * self.RESULTS_PER_PROCESS
+            while in_flight or next_index < len(units):
+                while next_index < len(units) and len(in_flight) < max_in_flight:
+                    in_flight.append(pool.apply_async(
+                        _render_static_feed_unit, (next_index,)
+                    ))
+                    next_index += 1
+                yield in_flight.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _static_feed_job = None
+
+    def close_connections(self):
+        """Close this process's database connections, after committing,
+        so that forked worker processes don't inherit any of them.
+        A new connection is opened the next time one is needed.
+        """
+        session = getattr(self, '_session', None)
+        if session is None:
+            return
+        session.commit()
+        self.dispose_engine(session)
+
+    @classmethod
+    def dispose_engine(cls, session):
+        """Close the pooled connections of a session's engine."""
+        bind = session.get_bind()
+        getattr(bind, 'engine', bind).dispose()
+
+    def start_worker(self, units, annotator=None):
+        """Get a newly forked worker process ready to render feeds.
+
+        The worker mustn't use the database connection it inherited,
+        so it gets a session of its own, and the library, the lanes,
+        the facets and the annotator are moved over to the new session
+        by looking up every database object they refer to again.
+        """
+        # The parent process closed its connections before forking,
+        # so the inherited session doesn't have one. Disposing of its
+        # engine makes sure none is ever opened and shared here.
+        inherited = getattr(self, '_session', None)
+        if inherited is not None:
+            self.dispose_engine(inherited)
+        self._session = self.worker_session()
+        self.__library = None
+
+        lanes = list()
+        for filename, lane, url, facets, pagination in units:
+            lanes.append(lane)
+            if facets is not None:
+                self.move_to_session(facets)
+        if annotator is not None:
+            self.move_to_session(annotator)
+        seen = set()
+        while lanes:
+            lane = lanes.pop()
+            if id(lane) in seen:
+                continue
+            seen.add(id(lane))
+            self.move_to_session(lane)
+            lane._db = self._db
+            lanes.extend(lane.sublanes or [])
+
+    def move_to_session(self, obj):
+        """Replace the database objects among an object's attributes,
+        including the ones in lists, tuples and sets, with the same
+        rows loaded in this script's session.
+
+        The objects are found by the primary keys they were loaded
+        with, so nothing is loaded through the session they came from.
+        """
+        for name, value in vars(obj).items():
+            if isinstance(value, (list, tuple, set, frozenset)):
+                if any(self._identity(item) for item in value):
+                    value = type(value)(self._reloaded(item) for item in value)
+                    setattr(obj, name, value)
+            elif self._identity(value):
+                setattr(obj, name, self._reloaded(value))
+
+    def _reloaded(self, value):
+        identity = self._identity(value)
+        if not identity:
+            return value
+        return self._db.query(type(value)).get(identity)
+
+    @classmethod
+    def _identity(cls, value):
+        """The primary key of a database object, or None for anything
+        else.
+        """
+        state = inspect(value, raiseerr=False)
+        if not isinstance(state, InstanceState):
+            return None
+        return state.identity
+
+    def worker_session(self):
+        return production_session()
+
+    def create_feed_pages(self, lane, pagination, lane_url, annotator, facet,
+                          single_query=None):
+        """Returns a list of every page of the feed for a particular lane."""
+        return list(self.feed_pages(
+            lane, pagination, lane_url, annotator, facet,
+            single_query=single_query
+        ))
+
+    def feed_pages(self, lane, pagination, lane_url, annotator, facet,
+                   single_query=None):
+        """Yields each page of the feed for a particular lane.
+
+        :param single_query: Load all of the lane's works, and what the
+            annotator needs to know about them, with one query, and cut
+            the pages out of that list. Otherwise the lane's query is
+            run once for each page. Defaults to self.single_query.
+        """
+        if single_query is None:
+            single_query = self.single_query
+        feed_class = AcquisitionFeed
+        if single_query:
+            works = self.all_works(lane, facet)
+            pagination = PrefetchedPagination(
+                works, offset=pagination.offset, size=pagination.size
+            )
+            lane = PrefetchedLane(lane)
+            feed_class = ContentServerAcquisitionFeed
 
-    def create_feed_pages(self, lane, pagination, lane_url, annotator, facet):
-        """Yields each page of the feed for a particular lane."""
-        pages = list()
         previous_page = pagination.previous_page
         while (not previous_page) or previous_page.has_next_page:
-            page = AcquisitionFeed.page(
+            page = feed_class.page(
                 self._db, lane.name, lane_url, lane, annotator,
                 cache_type=AcquisitionFeed.NO_CACHE,
                 facets=facet,
                 pagination=pagination,
                 use_materialized_works=False
             )
-            pages.append(page)
+            yield page
 
             # Reset values to determine if next page should be created.
             previous_page = pagination
             pagination = pagination.next_page
-        return pages
 
-    def load(self, feeds, uploader=None, bucket=None):
-        """Uploads feeds via S3 or downloads them locally."""
-        upload_files = list()
+    def all_works(self, lane, facets):
+        """Load every work in a lane, in order, along with the license
+        pools and editions their entries are made from.
+        """
+        qu = lane.works(facets)
+        if not qu:
+            return []
+        return qu.options(
+            subqueryload(Work.license_pools).joinedload(LicensePool.identifier),
+            joinedload(Work.presentation_edition),
+        ).all()
+
+    def load(self, feeds, uploader=None, bucket=None, prefix='',
+             reupload=False, upload_config=None):
+        """Uploads feeds via S3 or downloads them locally.
+
+        Only the feed files that have changed since the last upload to
+        the same bucket and prefix are uploaded, and files that are no
+        longer part of the feed are deleted.
+
+        Feed files are saved or uploaded as they're rendered,
+        UPLOAD_BATCH_SIZE at a time, so the feeds don't all have to
+        fit in memory at once.
+
+        :param feeds: (filename, pages) 2-tuples, like the ones
+            yielded by feed_pages_by_filename().
+        :param reupload: Upload every file, changed or not.
+        :param upload_config: A configuration to use while uploading,
+            but not while the feeds are being rendered.
+        """
+        feed_files = self.feed_files(feeds)
+        if not uploader:
+            for filename, content in feed_files:
+                filename = os.path.abspath(filename + '.xml')
+                with open(filename, 'w') as f:
+                    f.write(content)
+                self.log.info("OPDS feed saved locally at %s", filename)
+            return
+
+        if not bucket:
+            raise ValueError('No S3 bucket provided for upload')
+        # The works for the feeds that haven't been rendered yet
+        # mustn't be expired when a batch of uploads is committed.
+        with self.commits_keep_objects_loaded():
+            manifest = self.manifest_setting(bucket, prefix)
+            previous = dict()
+            if manifest.value:
+                previous = json.loads(manifest.value)
+            uploaded = previous
+            if reupload:
+                uploaded = dict()
+
+            filenames = set()
+            hashes = dict()
+            changed = list()
+            changed_count = 0
+            for filename, content in feed_files:
+                filenames.add(filename)
+                hashes[filename] = self.content_hash(content)
+                if uploaded.get(filename) != hashes[filename]:
+                    changed.append((filename, content))
+                if len(changed) >= self.UPLOAD_BATCH_SIZE:
+                    self.upload_batch(
+                        uploader, bucket, changed, hashes, previous,
+                        upload_config
+                    )
+                    changed_count += len(changed)
+                    changed = list()
+            if changed:
+                self.upload_batch(
+                    uploader, bucket, changed, hashes, previous, upload_config
+                )
+                changed_count += len(changed)
+            self.log.info(
+                "%d of %d feed files have changed.",
+                changed_count, len(filenames)
+            )
+
+            with self.upload_context(upload_config):
+                # A file that failed to upload is still part of the
+                # feed, so it's never an orphan, even if it isn't in
+                # `hashes`.
+                orphans = sorted(set(previous) - filenames)
+                if orphans:
+                    self.delete_feed_files(uploader, bucket, orphans)
+
+                manifest.value = unicode(json.dumps(hashes, sort_keys=True))
+                self._db.commit()
+
+    def feed_files(self, feeds):
+        """Give each page of each feed its own filename.
+
+        :yield: (filename, page content) 2-tuples.
+        """
         for base_filename, feed_pages in feeds:
             # Each feed needs a unique filename, ending with the
             # expected page number as a suffix.
@@ -1267,62 +1906,248 @@ class StaticFeedGenerationScript(StaticFeedScript):
                 if index != 0:
                     # The first page of a feed does not get a suffix.
                     filename += '_%i' % (index+1)
-                upload_files.append((filename, page))
+                yield filename, page
+
+    def upload_batch(self, uploader, bucket, upload_files, hashes,
+                     previous=None, upload_config=None):
+        """Upload some changed feed files.
 
-        if uploader:
-            if not bucket:
-                raise ValueError('No S3 bucket provided for upload')
-            upload_files = [[f, c, uploader.feed_url(bucket, f)] for f, c in upload_files]
-            representations = self._create_representations(upload_files)
+        A file that fails to upload keeps the hash it had in the
+        `previous` manifest, if any, since the copy in S3 hasn't
+        changed. Either way, it will be tried again next time.
+        """
+        previous = previous or dict()
+        with self.upload_context(upload_config):
+            changed = [[f, c, uploader.feed_url(bucket, f)]
+                       for f, c in upload_files]
+            representations = self._create_representations(changed)
             uploader.mirror_batch(representations)
+            for (f, c, url), representation in zip(changed, representations):
+                if representation.mirror_exception:
+                    # Try again next time.
+                    if f in previous:
+                        hashes[f] = previous[f]
+                    else:
+                        del hashes[f]
+
+            # Once they're committed, the session doesn't hold on to
+            # the Representations, or the content that was uploaded.
+            self._db.commit()
+
+    @contextlib.contextmanager
+    def commits_keep_objects_loaded(self):
+        """Don't expire the session's objects when it's committed.
+
+        Each batch of uploads is committed while the rest of the feeds
+        are still being rendered, and the works that feed_pages() has
+        loaded for them ahead of time would otherwise be loaded again,
+        one at a time.
+        """
+        expire_on_commit = self._db.expire_on_commit
+        self._db.expire_on_commit = False
+        try:
+            yield
+        finally:
+            self._db.expire_on_commit = expire_on_commit
+
+    @contextlib.contextmanager
+    def upload_context(self, upload_config=None):
+        if upload_config is None:
+            yield
         else:
-            for filename, content in upload_files:
-                filename = os.path.abspath(filename + '.xml')
-                with open(filename, 'w') as f:
-                    f.write(content)
-                self.log.info("OPDS feed saved locally at %s", filename)
+            with temp_config(upload_config):
+                yield
+
+    def manifest_setting(self, bucket, prefix=''):
+        key = u"%s:%s/%s" % (self.MANIFEST_KEY, bucket, prefix)
+        return ConfigurationSetting.sitewide(self._db, key)
+
+    @classmethod
+    def content_hash(cls, content):
+        """Hash a feed file's content, leaving out the feed-level
+        <updated> timestamp, which is different every time a feed is
+        rendered. The entries' timestamps are left in, since they only
+        change when the works do.
+        """
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        head, entry_tag, entries = content.partition("<entry")
+        head = cls.FEED_UPDATED.sub("", head)
+        return hashlib.md5(head + entry_tag + entries).hexdigest()
+
+    def delete_feed_files(self, uploader, bucket, filenames):
+        """Delete feed files that are no longer part of the feed, and
+        the Representations that were made to upload them.
+        """
+        urls = [uploader.feed_url(bucket, f) for f in filenames]
+        self.log.info("Deleting %d feed files.", len(urls))
+        uploader.delete_batch(urls, external_hosts=[])
+        for representation in self._db.query(Representation).filter(
+            Representation.mirror_url.in_(urls)
+        ):
+            self._db.delete(representation)
 
     def _create_representations(self, upload_files):
+        urls = [mirror_url for filename, content, mirror_url in upload_files]
+        existing = dict()
+        for representation in self._db.query(Representation).filter(
+            Representation.mirror_url.in_(urls)
+        ):
+            # Any of several Representations with the same mirror URL
+            # will do.
+            existing.setdefault(representation.mirror_url, representation)
+
         representations = list()
         for filename, content, mirror_url in upload_files:
-            feed_representation = get_one_or_create(
-                self._db, Representation,
-                mirror_url=mirror_url,
-                on_multiple='interchangeable'
-            )[0]
+            feed_representation = existing.get(mirror_url)
+            if not feed_representation:
+                feed_representation, ignore = create(
+                    self._db, Representation, mirror_url=mirror_url
+                )
+                existing[mirror_url] = feed_representation
             feed_representation.set_fetched_content(content, content_path=filename)
             representations.append(feed_representation)
         self._db.commit()
 
         return representations
 
-    def load_index(self, search_client, full_query):
-        annotator = ContentServerAnnotator()
-        search_documents = []
+    def load_index(self, search_client, full_query, chunk_size=None,
+                   threads=None):
+        """Add the works in a query to a search index.
 
-        # It's slow to do these individually, but this won't run very often.
-        for work in full_query:
-            if StaticFeedAnnotator.active_licensepool_for(work):
-                doc = work.to_search_document()
-                doc["_index"] = search_client.works_index
-                doc["_type"] = search_client.work_document_type
-                doc["opds_entry"] = etree.tostring(
-                    AcquisitionFeed.single_entry(self._db, work, annotator))
-                search_documents.append(doc)
-
-        success_count, errors = search_client.bulk(
-            search_documents,
-            raise_on_error=False,
-            raise_on_exception=False,
-        )
+        Search documents are made as they're needed and sent to the
+        index in bulk requests of `chunk_size` documents.
+
+        :param threads: If this is more than one, this many bulk
+            requests are sent at once.
+        """
+        chunk_size = chunk_size or self.INDEX_CHUNK_SIZE
+        documents = self.search_documents(search_client, full_query, chunk_size)
+        chunks = self.chunked(documents, chunk_size)
+
+        success_count = 0
+        error_count = 0
+        results = self.bulk_index(search_client, chunks, threads=threads)
+        for index, (success, errors) in enumerate(results):
+            success_count += success
+            if errors:
+                error_count += len(errors)
+                self.log.error(
+                    "%i errors uploading chunk %i to search index: %r",
+                    len(errors), index+1, errors[:self.LOGGED_INDEX_ERRORS]
+                )
 
-        if (len(errors) > 0):
-            self.log.error("%i errors uploading to search index" % len(errors))
+        if error_count:
+            self.log.error("%i errors uploading to search index" % error_count)
         # TODO: Reference the URL in this log as well as the index.
         self.log.info(
             "%i documents uploaded to search index %s" % (
             success_count, search_client.works_index))
 
+    def search_documents(self, search_client, full_query, batch_size):
+        """Yield a search document for each work in the query that has
+        an active license pool.
+        """
+        annotator = ContentServerAnnotator()
+        feed = ContentServerAcquisitionFeed(self._db, '', '', [], annotator)
+        for works in self.work_batches(full_query, batch_size):
+            feed.open_access_links = feed.prefetch(self._db, works)
+            for work in works:
+                if not StaticFeedAnnotator.active_licensepool_for(work):
+                    continue
+                entry = feed.create_entry(work)
+                if not isinstance(entry, etree._Element):
+                    # This work can't be shown in a feed.
+                    continue
+                doc = work.to_search_document()
+                doc["_index"] = search_client.works_index
+                doc["_type"] = search_client.work_document_type
+                doc["opds_entry"] = etree.tostring(entry)
+                yield doc
+
+    def work_batches(self, full_query, batch_size):
+        """Yield the works in a query in lists of `batch_size`, with
+        their license pools and presentation editions loaded.
+
+        The work IDs come from a server-side cursor, and the works
+        themselves are loaded a batch at a time.
+        """
+        if not full_query:
+            return
+        ids = full_query.from_self(Work.id).execution_options(
+            stream_results=True
+        ).yield_per(batch_size)
+
+        for batch in self.chunked((work_id for [work_id] in ids), batch_size):
+            yield self._db.query(Work).filter(Work.id.in_(batch)).options(
+                subqueryload(Work.license_pools).joinedload(LicensePool.identifier),
+                joinedload(Work.presentation_edition),
+            ).order_by(Work.id).all()
+
+    def bulk_index(self, search_client, chunks, threads=None):
+        """Send lists of search documents to the search index, one bulk
+        request per list.
+
+        :param threads: If this is more than one, requests are sent
+            from a pool of this many threads, each with up to
+            RESULTS_PER_PROCESS chunks waiting for it.
+
+        :yield: A (number of documents indexed, list of errors) 2-tuple
+            for each chunk, in the same order as the chunks.
+        """
+        def index(documents):
+            return search_client.bulk(
+                documents,
+                raise_on_error=False,
+                raise_on_exception=False,
+            )
+
+        if not threads or threads <= 1:
+            for chunk in chunks:
+                yield index(chunk)
+            return
+
+        pool = ThreadPool(threads)
+        try:
+            in_flight = deque()
+            for chunk in chunks:
+                in_flight.append(pool.apply_async(index, (chunk,)))
+                if len(in_flight) >= threads * self.RESULTS_PER_PROCESS:
+                    yield in_flight.popleft().get()
+            while in_flight:
+                yield in_flight.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @classmethod
+    def chunked(cls, items, size):
+        """Yield lists of up to `size` items."""
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+# The script, the feed units and the annotator for a pool of
+# worker processes rendering static feeds. Set before the pool is
+# created, so every worker process inherits it.
+_static_feed_job = None
+
+def _start_static_feed_worker():
+    script, units, annotator = _static_feed_job
+    script.start_worker(units, annotator)
+
+def _render_static_feed_unit(index):
+    """Render one static feed. Runs in a worker process."""
+    script, units, annotator = _static_feed_job
+    return script.render_feed_unit(units[index], annotator)
+
 
 class CustomListFeedGenerationScript(StaticFeedGenerationScript):
 
@@ -1452,6 +2277,7 @@ class CustomListFeedGenerationScript(StaticFeedGenerationScript):
         prefix = unicode(parsed.prefix)
         feed_id = unicode(parsed.domain)
         static_feed_bucket = parsed.storage_bucket
+        self.single_query = parsed.single_query
 
         # Remove configuration elements from the source config file.
         feed_config = self.get_json_config(parsed.feed_config)
@@ -1499,17 +2325,25 @@ class CustomListFeedGenerationScript(StaticFeedGenerationScript):
             prefix=prefix,
             license_link=license_link,
             include_search=include_search,
-            enabled_facets=enabled_facets
+            enabled_facets=enabled_facets,
+            processes=parsed.processes
         )
 
-        with temp_config(feed_config) as config:
-            # The feed configuration is required as an upload context
-            # to ensure the temporary static_feed_bucket will be used
-            # (as opposed to a locally-defined bucket).
-            self.load(feeds, uploader=uploader, bucket=static_feed_bucket)
+        # The feed configuration is required as an upload context
+        # to ensure the temporary static_feed_bucket will be used
+        # (as opposed to a locally-defined bucket). The feeds are
+        # rendered as they're uploaded, but not in that context.
+        self.load(
+            feeds, uploader=uploader, bucket=static_feed_bucket,
+            prefix=prefix, reupload=parsed.reupload,
+            upload_config=feed_config
+        )
 
         if search_client:
-            self.load_index(search_client, full_lane.works())
+            self.load_index(
+                search_client, full_lane.works(),
+                threads=parsed.index_threads
+            )
 
     def create_base_lane(self, name, lanelist=None, **kwargs):
         lanes = lanelist
@@ -1556,6 +2390,7 @@ class CSVFeedGenerationScript(StaticFeedGenerationScript):
         feed_id = unicode(parsed.domain)
         prefix = unicode(parsed.prefix)
         static_feed_bucket = parsed.storage_bucket
+        self.single_query = parsed.single_query
 
         # Determine if the resulting feeds should have a search link.
         include_search = bool(parsed.search_url and parsed.search_index)
@@ -1595,15 +2430,21 @@ class CSVFeedGenerationScript(StaticFeedGenerationScript):
             prefix=prefix,
             license_link=parsed.license,
             include_search=include_search,
-            page_size=parsed.page_size
+            page_size=parsed.page_size,
+            processes=parsed.processes
         )
 
         uploader = uploader or S3Uploader.from_config(self._db)
-        self.load(feeds, uploader=uploader, bucket=static_feed_bucket)
+        self.load(
+            feeds, uploader=uploader, bucket=static_feed_bucket,
+            prefix=prefix, reupload=parsed.reupload
+        )
 
         if include_search:
             search_client = ExternalSearchIndex(parsed.search_url, parsed.search_index)
-            self.load_index(search_client, full_query)
+            self.load_index(
+                search_client, full_query, threads=parsed.index_threads
+            )
 
     def make_lanes_from_csv(self, filename):
         """Parses a CSV file and creates the appropriate lane structure
@@ -1,19 +1,30 @@
 # encoding=utf8
+import datetime
+import gzip
+import json
 import os
+import time
+import urllib
+import urlparse
+from StringIO import StringIO
 from nose.tools import (
     eq_,
     set_trace,
 )
 
 from flask import url_for
+from sqlalchemy import event
 
 from . import DatabaseTest
 from ..config import Configuration
 from ..opds import ContentServerAnnotator
 
 from ..controller import (
+    BulkURNLookupController,
     ContentServer,
     ContentServerController,
+    ExpiringCache,
+    LookupCache,
 )
 
 from ..core.app_server import (
@@ -22,8 +33,11 @@ from ..core.app_server import (
 )
 
 from ..core.model import (
+    CustomList,
     DataSource,
+    Library,
     SessionManager,
+    Work,
 )
 
 from ..core.lane import(
@@ -158,6 +172,135 @@ class TestFeedController(ControllerTest):
             assert 'after=1' in next_url
 
 
+    def test_feed_is_cached(self):
+        controller = self.content_server.opds_feeds
+        with self.app.test_request_context("/"):
+            response = controller.feed()
+            eq_(dict(size=1, hits=0, misses=1), controller.feed_cache.stats())
+            etag = response.headers['ETag']
+            assert 'Last-Modified' in response.headers
+            assert 'max-age=%d' % controller.FEED_CACHE_TIME in (
+                response.headers['Cache-Control'])
+
+        # The same request is served from the cache.
+        with self.app.test_request_context("/"):
+            response2 = controller.feed()
+            eq_(1, controller.feed_cache.hits)
+            eq_(response.data, response2.data)
+            eq_(etag, response2.headers['ETag'])
+
+        # A different page is a different cache entry.
+        with self.app.test_request_context("/?size=1"):
+            response3 = controller.feed()
+            eq_(2, len(controller.feed_cache.entries))
+            assert response3.headers['ETag'] != etag
+
+    def test_feed_cache_cleared_when_works_change(self):
+        controller = self.content_server.opds_feeds
+        with self.app.test_request_context("/"):
+            controller.feed()
+
+        new_work = self._work(
+            "Brand New", "New Author", with_open_access_download=True
+        )
+        SessionManager.refresh_materialized_views(self._db)
+
+        # Until it's time to check, the cached feed is served.
+        with self.app.test_request_context("/"):
+            response = controller.feed()
+            assert new_work.title not in response.data
+
+        # Once we check, the new work shows up.
+        controller._generation_checked_at = None
+        with self.app.test_request_context("/"):
+            response = controller.feed()
+            assert new_work.title in response.data
+
+    def test_conditional_get(self):
+        controller = self.content_server.opds_feeds
+        self.english_1.last_update_time = datetime.datetime(2017, 1, 1)
+        with self.app.test_request_context("/"):
+            response = controller.feed()
+            eq_(200, response.status_code)
+            etag = response.headers['ETag']
+            last_modified = response.headers['Last-Modified']
+
+        # A client that already has the feed gets a 304, and the feed
+        # isn't even looked up.
+        controller.feed_cache.clear()
+        with self.app.test_request_context(
+                "/", headers={"If-None-Match": etag}):
+            response = controller.feed()
+            eq_(304, response.status_code)
+            eq_("", response.data)
+            eq_(etag, response.headers['ETag'])
+            eq_({}, controller.feed_cache.entries)
+
+        with self.app.test_request_context(
+                "/", headers={"If-Modified-Since": last_modified}):
+            eq_(304, controller.feed().status_code)
+
+        # A different page has a different ETag.
+        with self.app.test_request_context(
+                "/?size=1", headers={"If-None-Match": etag}):
+            eq_(200, controller.feed().status_code)
+
+        # Once the works change, so does the ETag.
+        self.english_1.last_update_time = datetime.datetime.utcnow()
+        controller._generation_checked_at = None
+        with self.app.test_request_context(
+                "/", headers={"If-None-Match": etag}):
+            response = controller.feed()
+            eq_(200, response.status_code)
+            assert response.headers['ETag'] != etag
+
+    def test_custom_list_feed_conditional_get(self):
+        custom_list, editions = self._customlist(foreign_identifier='my-faves')
+        custom_list.data_source = DataSource.lookup(
+            self._db, DataSource.LIBRARY_STAFF)
+        SessionManager.refresh_materialized_views(self._db)
+        controller = self.content_server.opds_feeds
+
+        with self.app.test_request_context('/'):
+            etag = controller.custom_list_feed('my-faves').headers['ETag']
+        with self.app.test_request_context(
+                '/', headers={"If-None-Match": etag}):
+            eq_(304, controller.custom_list_feed('my-faves').status_code)
+
+        # Changing the list changes the ETag.
+        custom_list.updated = datetime.datetime.utcnow()
+        with self.app.test_request_context(
+                '/', headers={"If-None-Match": etag}):
+            eq_(200, controller.custom_list_feed('my-faves').status_code)
+
+    def test_conditional_get_without_list_timestamp(self):
+        # The works have been updated, but this feed has no other
+        # timestamp to go on.
+        controller = self.content_server.opds_feeds
+        self.english_1.last_update_time = datetime.datetime(2017, 1, 1)
+        with self.app.test_request_context("/"):
+            response = controller.feed()
+            eq_(200, response.status_code)
+            assert 'ETag' in response.headers
+            assert 'Last-Modified' in response.headers
+
+    def test_custom_list_feed_without_timestamps(self):
+        custom_list, editions = self._customlist(foreign_identifier='my-faves')
+        custom_list.data_source = DataSource.lookup(
+            self._db, DataSource.LIBRARY_STAFF)
+        custom_list.updated = None
+        SessionManager.refresh_materialized_views(self._db)
+        controller = self.content_server.opds_feeds
+
+        # Neither the list nor the works know when they last changed.
+        controller._generation = (None, 0)
+        controller._generation_checked_at = time.time()
+        with self.app.test_request_context('/'):
+            response = controller.custom_list_feed('my-faves')
+            eq_(200, response.status_code)
+            assert 'ETag' in response.headers
+            assert 'Last-Modified' not in response.headers
+
     def test_multipage_feed(self):
         with self.app.test_request_context("/?size=1&order=title"):
             
@@ -179,6 +322,185 @@ class TestFeedController(ControllerTest):
             assert 'size=1' in next_link
             assert 'order=title' in next_link
 
+    def test_cursor_pagination(self):
+        controller = self.content_server.opds_feeds
+        titles = []
+        cursor = ''
+        for i in range(4):
+            with self.app.test_request_context(
+                    "/", query_string=dict(order="title", size=1, cursor=cursor)):
+                response = controller.feed()
+                feed = feedparser.parse(response.data)
+            titles.extend(entry.title for entry in feed.entries)
+            next_links = [x['href'] for x in feed.feed.links
+                          if x['rel'] == 'next']
+            if not next_links:
+                break
+            [next_link] = next_links
+            assert 'order=title' in next_link
+            query = urlparse.parse_qs(urlparse.urlparse(next_link).query)
+            [cursor] = query['cursor']
+
+        # We walked through every book, one page at a time, in title
+        # order, and the last page had no next link.
+        eq_(3, i)
+        expect = sorted(
+            [self.english_1, self.english_2, self.french_1],
+            key=lambda work: work.presentation_edition.sort_title
+        )
+        eq_([work.title for work in expect], titles)
+
+    def test_cursor_pagination_bad_cursor(self):
+        controller = self.content_server.opds_feeds
+        with self.app.test_request_context("/?cursor=nonsense"):
+            response = controller.feed()
+            eq_(INVALID_INPUT.uri, response.uri)
+            assert response.detail.startswith("Invalid cursor")
+
+        # A cursor only makes sense for the order it was made for.
+        cursor = controller.encode_cursor("title", "A", 1)
+        with self.app.test_request_context(
+                "/", query_string=dict(order="author", cursor=cursor)):
+            response = controller.feed()
+            eq_(INVALID_INPUT.uri, response.uri)
+
+        # A cursor whose sort key or work ID is the wrong type is
+        # rejected before it gets anywhere near the database.
+        cursor = controller.encode_cursor("title", "A", "1")
+        with self.app.test_request_context(
+                "/", query_string=dict(order="title", cursor=cursor)):
+            response = controller.feed()
+            eq_(INVALID_INPUT.uri, response.uri)
+            assert response.detail.startswith("Invalid cursor")
+
+        added = Facets.ORDER_ADDED_TO_COLLECTION
+        for order, key, work_id in [
+            ("title", "A", 1.5),
+            ("title", "A", None),
+            ("title", "A", True),
+            ("title", ["A"], 1),
+            ("title", {"A": 1}, 1),
+            ("title", 1, 1),
+            (added, "yesterday", 1),
+            (added, 20170101, 1),
+        ]:
+            cursor = controller.encode_cursor(order, key, work_id)
+            with self.app.test_request_context(
+                    "/", query_string=dict(cursor=cursor)):
+                response = controller.load_cursor_from_request(
+                    MockFacets(order))
+                eq_(INVALID_INPUT.uri, response.uri)
+
+        # A good cursor is decoded.
+        cursor = controller.encode_cursor(
+            added, datetime.datetime(2017, 1, 2), 5)
+        with self.app.test_request_context(
+                "/", query_string=dict(cursor=cursor)):
+            eq_((datetime.datetime(2017, 1, 2), 5),
+                controller.load_cursor_from_request(MockFacets(added)))
+
+        # A missing sort key is treated like an empty one.
+        cursor = controller.encode_cursor("title", None, 1)
+        with self.app.test_request_context(
+                "/", query_string=dict(order="title", cursor=cursor)):
+            eq_(200, controller.feed().status_code)
+
+    def test_bulk_export(self):
+        controller = self.content_server.opds_feeds
+
+        # A book that isn't presentation-ready is left out.
+        not_ready = self._work(
+            "Not Ready", "Someone", with_open_access_download=True
+        )
+        not_ready.presentation_ready = False
+
+        more = [self._work(with_open_access_download=True, authors=[
+            self._str, self._str]) for i in range(2)]
+        expect = sorted([self.english_1.title, self.english_2.title,
+                         self.french_1.title] + [w.title for w in more])
+        self._db.flush()
+
+        # Keep track of the statements run for each batch, from when
+        # it's loaded until its entries have been written out.
+        statements = []
+        def count(*args):
+            statements.append(args)
+        per_batch = []
+        batches = controller.bulk_export_batches
+        def counted_batches():
+            for works in batches():
+                yield works
+                per_batch.append((len(works), len(statements)))
+                del statements[:]
+        controller.bulk_export_batches = counted_batches
+
+        # Use tiny batches to make sure they're stitched together.
+        controller.BULK_EXPORT_BATCH_SIZE = 2
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", count)
+        try:
+            with self.app.test_request_context(
+                    "/crawlable", headers={"Accept-Encoding": "gzip"}):
+                response = controller.bulk_export()
+                eq_("gzip", response.headers['Content-Encoding'])
+                data = gzip.GzipFile(
+                    fileobj=StringIO(response.get_data())).read()
+        finally:
+            event.remove(connection, "before_cursor_execute", count)
+            del controller.bulk_export_batches
+
+        feed = feedparser.parse(data)
+        eq_(expect, sorted(entry.title for entry in feed.entries))
+
+        # Each batch's works, editions and contributors were loaded
+        # together, so a full batch took as many statements as the
+        # last, smaller one. (The first batch also ran the query that
+        # finds the work IDs.)
+        eq_([2, 2, 1], [size for size, ignore in per_batch])
+        eq_(per_batch[1][1], per_batch[2][1])
+
+        # The works were let go of once they'd been written out.
+        eq_([], [obj for obj in self._db if isinstance(obj, Work)])
+
+        # A client that can't handle gzip gets the same feed,
+        # uncompressed.
+        with self.app.test_request_context("/crawlable"):
+            response = controller.bulk_export()
+            assert 'Content-Encoding' not in response.headers
+            uncompressed = feedparser.parse(response.get_data())
+        eq_([entry.id for entry in feed.entries],
+            [entry.id for entry in uncompressed.entries])
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        for i in range(3):
+            self._work(with_open_access_download=True)
+        for work in self._db.query(Work):
+            work.calculate_opds_entries()
+        SessionManager.refresh_materialized_views(self._db)
+
+        controller = self.content_server.opds_feeds
+        def queries_for(url):
+            statements = []
+            def count(*args):
+                statements.append(args)
+            connection = self._db.connection()
+            event.listen(connection, "before_cursor_execute", count)
+            try:
+                with self.app.test_request_context(url):
+                    response = controller.feed()
+            finally:
+                event.remove(connection, "before_cursor_execute", count)
+            return len(feedparser.parse(response.data).entries), len(statements)
+
+        # Get the lookups that only happen once out of the way.
+        queries_for("/?size=1")
+
+        entries, small = queries_for("/?size=2")
+        eq_(2, entries)
+        entries, large = queries_for("/?size=6")
+        eq_(6, entries)
+        eq_(small, large)
+
     def test_verbose_opds_entry(self):
         engdahl, new_contributor = self._contributor(
             name = u"Sylvia Engdahl",
@@ -240,3 +562,211 @@ class TestFeedController(ControllerTest):
             feed_from_name = feedparser.parse(response.data)
             eq_('All books from My Faves', feed_from_name.feed.title)
             eq_(feed_from_identifier, feed_from_name)
+
+    def test_cache_stats(self):
+        with self.app.test_request_context('/'):
+            self.content_server.opds_feeds.feed()
+            response = self.content_server.operations.cache_stats()
+        stats = json.loads(response.data)
+        eq_(1, stats['feeds']['size'])
+        eq_(1, stats['lookups']['misses'])
+
+
+class TestBulkURNLookupController(ControllerTest):
+
+    def test_process_urns(self):
+        ready = self.english_1.license_pools[0].identifier
+        not_licensed = self._identifier()
+        pool = self._licensepool(None)
+        not_ready = self.english_2
+        not_ready.presentation_ready = False
+        not_ready_identifier = not_ready.license_pools[0].identifier
+
+        # A message about an unknown identifier uses the URN the
+        # client sent, even if it isn't in the usual form.
+        gutenberg_url = "http://www.gutenberg.org/ebooks/99999"
+
+        urns = [
+            ready.urn, not_licensed.urn, "not a urn", pool.identifier.urn,
+            not_ready_identifier.urn, ready.urn, gutenberg_url,
+        ]
+        controller = BulkURNLookupController(self._db)
+        with self.app.test_request_context('/'):
+            controller.process_urns(urns)
+
+        # The work only shows up once, even though it was asked for
+        # twice.
+        eq_([(ready, self.english_1)], controller.works)
+        messages = sorted(
+            (x.urn, x.status_code) for x in controller.precomposed_entries
+        )
+        eq_(sorted([
+            (not_licensed.urn, 404), ("not a urn", 400), (gutenberg_url, 404),
+            (pool.identifier.urn, 202), (not_ready_identifier.urn, 202),
+        ]), messages)
+
+    def test_work_lookup(self):
+        identifier = self.french_1.license_pools[0].identifier
+        controller = BulkURNLookupController(self._db)
+        with self.app.test_request_context('/lookup?urn=%s' % urllib.quote(identifier.urn)):
+            response = controller.work_lookup(ContentServerAnnotator)
+        feed = feedparser.parse(response.data)
+        [entry] = feed['entries']
+        eq_(self.french_1.title, entry['title'])
+
+
+class MockFacets(object):
+
+    def __init__(self, order):
+        self.order = order
+
+
+class TestLookupCache(DatabaseTest):
+
+    def test_get(self):
+        cache = LookupCache(self._db)
+        calls = []
+        def lookup():
+            calls.append(1)
+            return Library.default(self._db)
+        library = cache.get('library', lookup)
+        eq_(Library.default(self._db), library)
+
+        # After the session is committed, the library comes from the
+        # cache, and it's the same object the session knows about.
+        self._db.commit()
+        cached = cache.get('library', lookup)
+        eq_(1, len(calls))
+        eq_(library.id, cached.id)
+        eq_(library.short_name, cached.short_name)
+        assert cached in self._db
+        eq_(dict(size=1, hits=1, misses=1), cache.stats())
+
+        # Changes made in the session aren't overwritten by the cache.
+        cached.name = u"A new name"
+        eq_(u"A new name", cache.get('library', lookup).name)
+        self._db.commit()
+        eq_(u"A new name", cache.get('library', lookup).name)
+        eq_(1, len(calls))
+
+        # Once invalidated, it's looked up again.
+        cache.invalidate()
+        eq_(u"A new name", cache.get('library', lookup).name)
+        eq_(2, len(calls))
+
+    def test_lookups_are_not_repeated_across_requests(self):
+        cache = LookupCache(self._db)
+        library = cache.default_library()
+        source = cache.data_source(DataSource.GUTENBERG)
+        short_name = library.short_name
+        name = source.name
+
+        # The next request starts with a committed session that has
+        # forgotten both objects.
+        self._db.commit()
+        self._db.expunge_all()
+
+        statements = []
+        def count(*args):
+            statements.append(args)
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", count)
+        try:
+            library = cache.default_library()
+            source = cache.data_source(DataSource.GUTENBERG)
+            eq_(short_name, library.short_name)
+            eq_(name, source.name)
+        finally:
+            event.remove(connection, "before_cursor_execute", count)
+        eq_([], statements)
+        assert library in self._db
+        assert source in self._db
+
+    def test_invalidate_model(self):
+        cache = LookupCache(self._db)
+        custom_list, ignore = self._customlist(
+            foreign_identifier=u'my-list', num_entries=0
+        )
+        cache.default_library()
+        cache.data_source(DataSource.GUTENBERG)
+        cache.custom_list(custom_list.data_source.name, u'my-list')
+        eq_(3, cache.stats()['size'])
+
+        cache.invalidate(DataSource)
+        eq_(set([('library', 'default'),
+                 ('custom_list', custom_list.data_source.name, u'my-list')]),
+            set(cache.cache.entries))
+
+        cache.invalidate(CustomList)
+        eq_([('library', 'default')], cache.cache.entries.keys())
+
+    def test_custom_list_is_always_current(self):
+        cache = LookupCache(self._db)
+        custom_list, ignore = self._customlist(
+            foreign_identifier=u'my-list', num_entries=0
+        )
+        source = custom_list.data_source.name
+        cache.custom_list(source, u'my-list')
+        self._db.commit()
+
+        # The list is changed without going through the ORM.
+        now = datetime.datetime(2018, 1, 1)
+        self._db.execute(
+            CustomList.__table__.update().values(updated=now)
+        )
+        eq_(now, cache.custom_list(source, u'my-list').updated)
+
+    def test_deleted_object_is_looked_up_again(self):
+        cache = LookupCache(self._db)
+        custom_list, ignore = self._customlist(
+            foreign_identifier=u'my-list', num_entries=0
+        )
+        source = custom_list.data_source.name
+        eq_(custom_list, cache.custom_list(source, u'my-list'))
+
+        self._db.delete(custom_list)
+        self._db.commit()
+        eq_(None, cache.custom_list(source, u'my-list'))
+
+    def test_missing_object_is_not_cached(self):
+        cache = LookupCache(self._db)
+        eq_(None, cache.data_source("No such source"))
+        eq_(0, cache.stats()['size'])
+
+        source = cache.data_source(DataSource.GUTENBERG)
+        eq_(DataSource.lookup(self._db, DataSource.GUTENBERG), source)
+        eq_(1, cache.stats()['size'])
+
+
+class TestExpiringCache(object):
+
+    def test_expiry(self):
+        now = [1000]
+        cache = ExpiringCache(10, clock=lambda: now[0])
+        cache.set("key", "value")
+        eq_("value", cache.get("key"))
+
+        now[0] += 10
+        eq_(None, cache.get("key"))
+        eq_("default", cache.get("key", "default"))
+        eq_(dict(size=0, hits=1, misses=2), cache.stats())
+
+    def test_max_size(self):
+        now = [1000]
+        cache = ExpiringCache(10, max_size=2, clock=lambda: now[0])
+        cache.set("a", 1)
+        now[0] += 1
+        cache.set("b", 2)
+        now[0] += 1
+
+        # The oldest entry makes way for the new one.
+        cache.set("c", 3)
+        eq_(set(["b", "c"]), set(cache.entries))
+
+        # Replacing an entry doesn't push anything out.
+        cache.set("c", 4)
+        eq_(4, cache.get("c"))
+        eq_(2, len(cache.entries))
+
+        cache.clear()
+        eq_({}, cache.entries)
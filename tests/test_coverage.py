@@ -3,12 +3,18 @@ from nose.tools import (
     eq_,
 )
 import datetime
+import hashlib
+import os
+import shutil
 import tempfile
 import urllib
 from ..core.testing import DatabaseTest
 from ..config import temp_config
-from ..coverage import GutenbergEPUBCoverageProvider
-from ..core.s3 import DummyS3Uploader
+from ..coverage import (
+    GutenbergEPUBCoverageProvider,
+    GutenbergEPUBIndex,
+)
+from ..s3 import DummyS3Uploader
 from ..core.coverage import CoverageFailure
 from ..core.model import (
     get_one_or_create,
@@ -85,6 +91,71 @@ class TestGutenbergEPUBCoverageProvider(DatabaseTest):
         eq_(self.provider.epub_path_for(identifier), 
             representation.local_content_path)
 
+    def test_process_batch_uploads_all_at_once(self):
+        class MockUploader(DummyS3Uploader):
+            def __init__(self):
+                super(MockUploader, self).__init__()
+                self.batches = []
+
+            def mirror_batch(self, representations):
+                self.batches.append(representations)
+                for representation in representations:
+                    if representation.mirror_url.endswith("2.epub"):
+                        representation.mirror_exception = "S3 is down"
+                    else:
+                        representation.set_as_mirrored()
+        self.provider.uploader = MockUploader()
+
+        identifiers = []
+        for identifier_id in ["1", "2", "fail3"]:
+            edition, pool = self._edition(
+                identifier_type=Identifier.GUTENBERG_ID,
+                identifier_id=identifier_id, with_license_pool=True
+            )
+            identifiers.append(edition.primary_identifier)
+        [i1, i2, i3] = identifiers
+        [r1, r2, r3] = self.provider.process_batch(identifiers)
+
+        # The two books that could be prepared were uploaded together.
+        [batch] = self.provider.uploader.batches
+        eq_(2, len(batch))
+
+        # The results line up with the identifiers, and a failed
+        # upload becomes a transient failure for that book alone.
+        eq_(i1, r1)
+        assert isinstance(r2, CoverageFailure)
+        eq_("S3 is down", r2.exception)
+        eq_(True, r2.transient)
+        eq_("failure!", r3.exception)
+
+        # Only the book that was uploaded got a new delivery mechanism.
+        epub_mechanisms = lambda identifier: [
+            x for x in identifier.delivery_mechanisms
+            if x.resource and x.resource.representation.mirror_url]
+        eq_(1, len(epub_mechanisms(i1)))
+        eq_(0, len(epub_mechanisms(i2)))
+
+    def test_process_batch_skips_unchanged_epubs(self):
+        epub = tempfile.NamedTemporaryFile(suffix=".epub")
+        epub.write("An EPUB")
+        epub.flush()
+        self.provider.epub_path_for = lambda identifier: epub.name
+
+        edition, pool = self._edition(with_license_pool=True)
+        identifier = edition.primary_identifier
+
+        # The EPUB is already in S3.
+        url = self.provider.uploader.book_url(identifier, 'epub')
+        self.provider.uploader.etags[url] = hashlib.md5("An EPUB").hexdigest()
+
+        eq_([identifier], self.provider.process_batch([identifier]))
+        eq_([], self.provider.uploader.uploaded)
+
+        # It's still treated as mirrored.
+        [link] = [x for x in identifier.links
+                  if x.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD]
+        assert link.resource.representation.mirrored_at
+
     def test_epub_path_for_wrong_identifier_type(self):
         identifier = self._identifier(Identifier.OVERDRIVE_ID)
         real_provider = GutenbergEPUBCoverageProvider(
@@ -135,3 +206,86 @@ class TestGutenbergEPUBCoverageProvider(DatabaseTest):
         eq_("bar.epub", f(["foo.txt", "bar.epub"]))
         eq_("bar-noimages.epub", f(["foo.txt", "bar-noimages.epub"]))
         eq_("bar-images.epub", f(["foo-noimages.epub", "bar-images.epub"]))
+
+
+class TestGutenbergEPUBIndex(DatabaseTest):
+
+    def setup(self):
+        super(TestGutenbergEPUBIndex, self).setup()
+        self.data_directory = tempfile.mkdtemp()
+        self.epub_mirror = os.path.join(
+            self.data_directory, "Gutenberg", "gutenberg-epub")
+        os.makedirs(self.epub_mirror)
+        self.index = GutenbergEPUBIndex(
+            self.epub_mirror, GutenbergEPUBIndex.path_for(self.epub_mirror))
+
+    def teardown(self):
+        shutil.rmtree(self.data_directory)
+        super(TestGutenbergEPUBIndex, self).teardown()
+
+    def add_files(self, pg_id, *filenames):
+        directory = os.path.join(self.epub_mirror, pg_id)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for filename in filenames:
+            with open(os.path.join(directory, filename), "w") as f:
+                f.write("An EPUB")
+        return directory
+
+    def test_refresh(self):
+        self.add_files("1", "pg1.epub", "pg1-images.epub")
+        self.add_files("2", "pg2.txt")
+        eq_(2, self.index.refresh())
+
+        eq_("pg1-images.epub", self.index.best_epub("1"))
+        filename, size, mtime = self.index.epubs["1"]
+        eq_(len("An EPUB"), size)
+
+        # Directory 2 exists but has no EPUB.
+        eq_(True, self.index.has_directory("2"))
+        eq_(None, self.index.best_epub("2"))
+        eq_(False, self.index.has_directory("3"))
+
+        # The index was saved.
+        index = GutenbergEPUBIndex.for_mirror(self.epub_mirror)
+        eq_("pg1-images.epub", index.best_epub("1"))
+
+        # Only directories whose mtimes have changed are looked at
+        # again.
+        directory = self.add_files("2", "pg2.epub")
+        os.utime(directory, (0, 0))
+        eq_(1, index.refresh())
+        eq_("pg2.epub", index.best_epub("2"))
+
+        # Directories that have gone away are forgotten.
+        shutil.rmtree(os.path.join(self.epub_mirror, "1"))
+        index.refresh()
+        eq_(False, index.has_directory("1"))
+
+    def test_refresh_only_some_directories(self):
+        self.add_files("1", "pg1.epub")
+        self.add_files("2", "pg2.epub")
+        self.index.refresh(["2", "3"])
+        eq_(["2"], self.index.directories.keys())
+
+    def test_coverage_provider_uses_index(self):
+        self.add_files("1", "pg1.epub")
+        self.add_files("2", "pg2.txt")
+        self.index.refresh()
+
+        # Once the index has been made, the filesystem isn't checked.
+        self.add_files("3", "pg3.epub")
+        with temp_config() as config:
+            config['data_directory'] = self.data_directory
+            provider = GutenbergEPUBCoverageProvider(
+                self._db, uploader=DummyS3Uploader()
+            )
+        f = provider.epub_path_for
+        eq_(os.path.join(self.epub_mirror, "1", "pg1.epub"),
+            f(self._identifier(Identifier.GUTENBERG_ID, "1")))
+
+        failure = f(self._identifier(Identifier.GUTENBERG_ID, "2"))
+        assert failure.exception.startswith("Could not find a good EPUB")
+
+        failure = f(self._identifier(Identifier.GUTENBERG_ID, "3"))
+        assert failure.exception.endswith("does not exist!")
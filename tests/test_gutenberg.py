@@ -2,11 +2,18 @@
 
 import datetime
 import os
+import pickle
+import shutil
 import StringIO
+import tarfile
+import tempfile
 
-from nose.tools import set_trace, eq_ 
+from nose.tools import set_trace, eq_, assert_raises
+import requests
 
+from ..core.metadata_layer import ReplacementPolicy
 from ..core.model import (
+    CirculationEvent,
     Contributor,
     DataSource,
     ExternalIntegration,
@@ -20,6 +27,8 @@ from ..core.model import (
 )
 from ..gutenberg import (
     GutenbergAPI,
+    GutenbergMonitor,
+    GutenbergLxmlRDFExtractor,
     GutenbergRDFExtractor,
 )
 from . import (
@@ -27,6 +36,408 @@ from . import (
     sample_data,
 )
 
+class MockResponse(object):
+    """Just enough of a requests Response to stream a download."""
+
+    def __init__(self, status_code, content="", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class TestGutenbergAPI(DatabaseTest):
+
+    def setup(self):
+        super(TestGutenbergAPI, self).setup()
+        self.collection = self._collection(protocol=ExternalIntegration.GUTENBERG)
+        self.data_directory = tempfile.mkdtemp()
+        self.api = GutenbergAPI(self._db, self.data_directory)
+
+        # Build a miniature version of the Project Gutenberg catalog.
+        self.documents = [
+            ("17", sample_data("gutenberg-17.rdf", "gutenberg"), 1000),
+            ("10130", sample_data("gutenberg-10130.rdf", "gutenberg"), 1000),
+            ("16", sample_data("pg16.rdf", "gutenberg"), 1000),
+        ]
+        self.write_catalog(self.documents)
+
+    def write_catalog(self, documents):
+        """Write out a catalog containing the given (pg_id, RDF
+        document, mtime) 3-tuples.
+        """
+        archive = tarfile.open(self.api.catalog_path, "w:bz2")
+        for pg_id, data, mtime in documents:
+            item = tarfile.TarInfo("cache/epub/%s/pg%s.rdf" % (pg_id, pg_id))
+            item.size = len(data)
+            item.mtime = mtime
+            archive.addfile(item, StringIO.StringIO(data))
+        archive.close()
+
+    def teardown(self):
+        shutil.rmtree(self.data_directory)
+        super(TestGutenbergAPI, self).teardown()
+
+    def mock_api(self):
+        """Set up a GutenbergAPI that gets its HTTP responses from
+        self.responses.
+        """
+        self.requests = []
+        self.responses = []
+        def http_get(url, headers, **kwargs):
+            self.requests.append((url, headers))
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return GutenbergAPI(self._db, self.data_directory, http_get=http_get)
+
+    def test_download_catalog(self):
+        api = self.mock_api()
+        os.remove(api.catalog_path)
+        eq_(True, api.needs_refresh())
+
+        url = "http://mirror/rdf-files.tar.bz2"
+        headers = {"ETag": '"v1"', "Content-Length": "6",
+                   "Last-Modified": "Mon, 02 Jan 2017 00:00:00 GMT"}
+        self.responses.append(MockResponse(200, "abcdef", headers))
+        eq_(True, api.download_catalog(url))
+        eq_("abcdef", open(api.catalog_path).read())
+        eq_([(url, {})], self.requests)
+        eq_(False, api.needs_refresh())
+
+        # Next time, we only want the catalog if it has changed.
+        stat = os.stat(api.catalog_path)
+        self.responses.append(MockResponse(304))
+        eq_(False, api.download_catalog(url))
+        url, headers = self.requests[-1]
+        eq_('"v1"', headers['If-None-Match'])
+        eq_("Mon, 02 Jan 2017 00:00:00 GMT", headers['If-Modified-Since'])
+
+        # The catalog file wasn't touched, so any checkpoint made
+        # against it is still good.
+        eq_(stat.st_mtime, os.stat(api.catalog_path).st_mtime)
+        eq_(False, api.needs_refresh())
+
+        # A different mirror won't know about the first mirror's ETag.
+        self.responses.append(MockResponse(304))
+        api.download_catalog("http://other-mirror/")
+        url, headers = self.requests[-1]
+        assert 'If-None-Match' not in headers
+        assert 'If-Modified-Since' in headers
+
+    def test_download_catalog_resumes_interrupted_download(self):
+        api = self.mock_api()
+        url = "http://mirror/rdf-files.tar.bz2"
+
+        # The mirror stops sending partway through.
+        headers = {"ETag": '"v1"', "Content-Length": "6"}
+        self.responses.append(MockResponse(200, "abc", headers))
+        assert_raises(IOError, api.download_catalog, url)
+
+        # The old catalog is still in place.
+        eq_(3, len(list(api.all_books(resume=False))))
+        eq_("abc", open(api.catalog_path + ".tmp").read())
+
+        # Next time we ask for the rest of the file.
+        headers = {"ETag": '"v1"', "Content-Length": "3",
+                   "Content-Range": "bytes 3-5/6"}
+        self.responses.append(MockResponse(206, "def", headers))
+        eq_(True, api.download_catalog(url))
+        url, headers = self.requests[-1]
+        eq_("bytes=3-", headers['Range'])
+        eq_('"v1"', headers['If-Range'])
+        eq_("abcdef", open(api.catalog_path).read())
+        assert not os.path.exists(api.catalog_path + ".tmp")
+
+    def test_update_catalog_fails_over_to_another_mirror(self):
+        api = self.mock_api()
+        api.MIRRORS = ["http://mirror1/", "http://mirror2/"]
+        self.responses.append(requests.exceptions.ConnectionError("down"))
+        self.responses.append(MockResponse(403))
+        api.update_catalog()
+
+        # Both mirrors were tried, and the catalog we already had was
+        # left alone.
+        eq_(set(api.MIRRORS), set(url for url, headers in self.requests))
+        eq_(3, len(list(api.all_books())))
+
+        # If we have no catalog at all, failure is an error.
+        os.remove(api.catalog_path)
+        self.responses.append(MockResponse(500))
+        self.responses.append(MockResponse(500))
+        assert_raises(IOError, api.update_catalog)
+
+        self.responses.append(MockResponse(500))
+        self.responses.append(MockResponse(200, "abcdef"))
+        api.update_catalog()
+        eq_("abcdef", open(api.catalog_path).read())
+
+    def test_all_books(self):
+        books = [(pg_id, archive.extractfile(item).read())
+                 for pg_id, archive, item in self.api.all_books()]
+        eq_(["17", "10130", "16"], [pg_id for pg_id, data in books])
+        eq_(sample_data("pg16.rdf", "gutenberg"), books[-1][1])
+
+    def test_all_books_resumes_from_checkpoint(self):
+        # Nothing has been checkpointed yet.
+        eq_(None, self.api.load_checkpoint())
+
+        # Stop partway through the catalog and record our progress.
+        books = self.api.all_books()
+        pg_id, archive, item = books.next()
+        eq_("17", pg_id)
+        self.api.offset = item.offset
+        self.api.save_checkpoint()
+        assert self.api.load_checkpoint() is not None
+
+        # The next walk through the catalog picks up where we left off.
+        eq_(["10130", "16"],
+            [pg_id for pg_id, archive, item in self.api.all_books()])
+
+        # ...unless we ask it to start over.
+        eq_(["17", "10130", "16"],
+            [pg_id for pg_id, archive, item
+             in self.api.all_books(resume=False)])
+
+        # A checkpoint made against an old copy of the catalog is ignored.
+        stat = os.stat(self.api.catalog_path)
+        os.utime(self.api.catalog_path, (stat.st_atime, stat.st_mtime+1))
+        eq_(None, self.api.load_checkpoint())
+
+        # Clearing the checkpoint also starts us over from the top.
+        self.api.save_checkpoint()
+        self.api.clear_checkpoint()
+        eq_(None, self.api.load_checkpoint())
+        eq_(3, len(list(self.api.all_books())))
+
+    def test_known_ids(self):
+        eq_(set(), self.api.known_ids())
+
+        self._edition(
+            data_source_name=DataSource.GUTENBERG,
+            identifier_type=Identifier.GUTENBERG_ID, identifier_id="17"
+        )
+        # An Edition of a Gutenberg book from some other source
+        # doesn't count.
+        self._edition(
+            data_source_name=DataSource.GUTENBERG_EPUB_GENERATOR,
+            identifier_type=Identifier.GUTENBERG_ID, identifier_id="16"
+        )
+        eq_(set(["17"]), self.api.known_ids())
+
+    def test_create_missing_books(self):
+        self._edition(
+            data_source_name=DataSource.GUTENBERG,
+            identifier_type=Identifier.GUTENBERG_ID, identifier_id="17"
+        )
+
+        # Only the books we didn't already know about are created.
+        created = [edition.primary_identifier.identifier
+                   for edition, pool in self.api.create_missing_books()]
+        eq_(["10130", "16"], created)
+
+        # Having been created, they're not created again.
+        eq_([], list(self.api.create_missing_books()))
+
+    def test_update_books_only_applies_new_or_changed_records(self):
+        # The first time through, every book is new.
+        results = [(edition.primary_identifier.identifier, new)
+                   for edition, pool, new in self.api.update_books()]
+        eq_([("17", True), ("10130", True), ("16", True)], results)
+        self.api.clear_checkpoint()
+        eq_(set(["17", "10130", "16"]), set(self.api.load_manifest()))
+
+        # A later run finds nothing to do.
+        api = GutenbergAPI(self._db, self.data_directory)
+        eq_([], list(api.update_books()))
+
+        # Now a new catalog comes out. Book 17 has been touched but
+        # hasn't changed, and book 16 has been given a new title.
+        [(id1, rdf1, ignore), (id2, rdf2, mtime2), (id3, rdf3, ignore)] = (
+            self.documents)
+        rdf3 = rdf3.replace("Peter Pan", "Peter and Wendy")
+        self.write_catalog(
+            [(id1, rdf1, 2000), (id2, rdf2, mtime2), (id3, rdf3, 2000)])
+
+        # Only book 16 is applied, and it's an update, not a new book.
+        api = GutenbergAPI(self._db, self.data_directory)
+        [(edition, pool, new)] = list(api.update_books())
+        eq_("16", edition.primary_identifier.identifier)
+        eq_(False, new)
+        eq_("Peter and Wendy", edition.title)
+
+        # The manifest notes the new mtime for book 17, so next time
+        # it won't even need to be read.
+        eq_(2000, api.manifest["17"][0])
+
+    def test_update_books_only_replaces_metadata_of_existing_books(self):
+        policies = []
+        class RecordingExtractor(GutenbergRDFExtractor):
+            @classmethod
+            def metadata_for_record(cls, record):
+                metadata, circulation_data = super(
+                    RecordingExtractor, cls).metadata_for_record(record)
+                apply = metadata.apply
+                def recording_apply(*args, **kwargs):
+                    policies.append(kwargs.get('replace'))
+                    return apply(*args, **kwargs)
+                metadata.apply = recording_apply
+                return metadata, circulation_data
+        self.api.extractor = RecordingExtractor
+
+        # New books get the default policy.
+        eq_(3, len(list(self.api.update_books())))
+        eq_([None, None, None], policies)
+        self.api.clear_checkpoint()
+
+        # A changed record replaces the book's old metadata.
+        [(id1, rdf1, mtime1), (id2, rdf2, mtime2), (id3, rdf3, ignore)] = (
+            self.documents)
+        rdf3 = rdf3.replace("Peter Pan", "Peter and Wendy")
+        self.write_catalog(
+            [(id1, rdf1, mtime1), (id2, rdf2, mtime2), (id3, rdf3, 2000)])
+        api = GutenbergAPI(self._db, self.data_directory)
+        api.extractor = RecordingExtractor
+        eq_(1, len(list(api.update_books())))
+        eq_(4, len(policies))
+        assert isinstance(policies[-1], ReplacementPolicy)
+        eq_(True, policies[-1].subjects)
+
+    def test_update_books_trusts_books_made_before_the_manifest(self):
+        # Book 17 was created before we started keeping a manifest.
+        self._edition(
+            data_source_name=DataSource.GUTENBERG,
+            identifier_type=Identifier.GUTENBERG_ID, identifier_id="17"
+        )
+        eq_(["10130", "16"],
+            [edition.primary_identifier.identifier
+             for edition, pool, new in self.api.update_books()])
+
+        # It's now in the manifest, so later changes will be noticed.
+        assert "17" in self.api.manifest
+
+    def test_update_books_survives_a_bad_record(self):
+        class BrokenExtractor(GutenbergRDFExtractor):
+            @classmethod
+            def book_from_record(cls, collection, record):
+                if record['uri'].endswith('/10130'):
+                    raise Exception("bad record")
+                return super(BrokenExtractor, cls).book_from_record(
+                    collection, record)
+        self.api.extractor = BrokenExtractor
+
+        # The books on either side of the bad one are still applied.
+        eq_(["17", "16"],
+            [edition.primary_identifier.identifier
+             for edition, pool, new in self.api.update_books()])
+
+        # The bad one is skipped rather than applied.
+        eq_(set(["17", "16"]), set(self.api.manifest))
+        eq_("Exception: bad record", self.api.skip_list["10130"]["reason"])
+
+    def test_update_books_skips_bad_records_until_they_change(self):
+        empty = sample_data("gutenberg-0.rdf", "gutenberg")
+        self.write_catalog([
+            ("0", empty, 1000),
+            ("1", "This is not RDF.", 1000),
+            self.documents[-1],
+        ])
+        eq_(["16"],
+            [edition.primary_identifier.identifier
+             for edition, pool, new in self.api.update_books()])
+        self.api.clear_checkpoint()
+
+        skip_list = self.api.load_skip_list()
+        eq_(set(["0", "1"]), set(skip_list))
+        eq_("No book described.", skip_list["0"]["reason"])
+        assert "1" not in self.api.load_manifest()
+
+        # Next time, nothing is even parsed.
+        class NoParsing(GutenbergRDFExtractor):
+            @classmethod
+            def record_in(cls, pg_id, fh):
+                raise Exception("Nothing should be parsed.")
+        api = GutenbergAPI(self._db, self.data_directory, extractor=NoParsing)
+        eq_([], list(api.update_books()))
+
+        # Touching a skipped book isn't enough to get it looked at
+        # again...
+        self.write_catalog([
+            ("0", empty, 2000),
+            ("1", "This is not RDF.", 2000),
+            self.documents[-1],
+        ])
+        api = GutenbergAPI(self._db, self.data_directory, extractor=NoParsing)
+        eq_([], list(api.update_books()))
+
+        # ...but changing it is.
+        self.write_catalog([
+            ("0", empty, 2000),
+            ("1", self.documents[0][1], 3000),
+            self.documents[-1],
+        ])
+        api = GutenbergAPI(self._db, self.data_directory)
+        eq_(["17"],
+            [edition.primary_identifier.identifier
+             for edition, pool, new in api.update_books()])
+        assert "1" not in api.skip_list
+
+    def test_clear_skip_list(self):
+        self.api.skip_list = {}
+        self.api.manifest = {}
+        self.api.skip("0", (0, 1000, "hash"), "No book described.")
+        self.api.skip("1", (0, 1000, "hash"), "Bad date.")
+        self.api.save_checkpoint(force=True)
+
+        eq_(["1"], self.api.clear_skip_list(["1", "2"]))
+        eq_(["0"], self.api.load_skip_list().keys())
+        eq_(["0"], self.api.clear_skip_list())
+        eq_({}, self.api.load_skip_list())
+
+    def test_monitor_commits_in_batches(self):
+        class Monitor(GutenbergMonitor):
+            batches = 0
+            def finish_batch(self):
+                self.batches += 1
+                super(Monitor, self).finish_batch()
+        monitor = Monitor(self._db, self.data_directory, batch_size=2)
+        monitor.source = self.api
+        monitor.run()
+
+        # Three books make one full batch and one partial batch.
+        eq_(2, monitor.batches)
+
+        # Each new book got a TITLE_ADD event.
+        events = self._db.query(CirculationEvent).filter(
+            CirculationEvent.type==CirculationEvent.TITLE_ADD).all()
+        eq_(set(["17", "10130", "16"]),
+            set(event.license_pool.identifier.identifier for event in events))
+
+        # We made it to the end of the catalog, so the next run will
+        # start from the top.
+        eq_(None, self.api.load_checkpoint())
+
+    def test_create_missing_books_in_worker_processes(self):
+        # A tiny chunk size makes sure books are spread across
+        # several chunks.
+        self.api.PARSE_CHUNK_SIZE = 2
+        created = [edition.primary_identifier.identifier
+                   for edition, pool
+                   in self.api.create_missing_books(processes=2)]
+
+        # The books come out in catalog order, just as they do when
+        # they're parsed in this process.
+        eq_(["17", "10130", "16"], created)
+
+
 class TestGutenbergMetadataExtractor(DatabaseTest):
 
     def setup(self):
@@ -108,6 +519,45 @@ class TestGutenbergMetadataExtractor(DatabaseTest):
         # If we want to use it, we'll find it in the rsynced mirror.
         eq_([], [x for x in identifier.links if x.rel == Hyperlink.IMAGE])
 
+    def test_record_in(self):
+        """The raw information extracted from an RDF file is made up of
+        plain Python types, so it can be passed between processes.
+        """
+        fh = StringIO.StringIO(self.sample_data("gutenberg-17.rdf"))
+        record = GutenbergRDFExtractor.record_in("17", fh)
+        eq_(u"http://www.gutenberg.org/ebooks/17", record['uri'])
+        eq_(u"2008-06-25", record['issued'])
+        eq_([u"en"], record['languages'])
+        eq_(record, pickle.loads(pickle.dumps(record)))
+
+        # Nothing has been written to the database.
+        eq_([], self._db.query(Edition).all())
+
+        fh = StringIO.StringIO(self.sample_data("gutenberg-0.rdf"))
+        eq_(None, GutenbergRDFExtractor.record_in("0", fh))
+
+    def test_lxml_extractor_matches_rdflib_extractor(self):
+        for pg_id, filename in [
+                ("0", "gutenberg-0.rdf"), ("17", "gutenberg-17.rdf"),
+                ("10130", "gutenberg-10130.rdf"),
+                ("40993", "gutenberg-40993.rdf"),
+                ("16", "pg16.rdf"), ("28794", "pg28794.rdf")]:
+            data = self.sample_data(filename)
+            expect = GutenbergRDFExtractor.record_in(
+                pg_id, StringIO.StringIO(data))
+            actual = GutenbergLxmlRDFExtractor.record_in(
+                pg_id, StringIO.StringIO(data))
+            eq_(GutenbergRDFExtractor.comparable(expect),
+                GutenbergLxmlRDFExtractor.comparable(actual))
+
+        # The lxml extractor creates the same book.
+        fh = StringIO.StringIO(self.sample_data("gutenberg-17.rdf"))
+        book, pool, new = GutenbergLxmlRDFExtractor.book_in(
+            self.collection, "17", fh)
+        eq_("The Book of Mormon", book.title)
+        eq_(3, len(book.primary_identifier.classifications))
+        eq_(True, pool.open_access)
+
     def test_rdf_file_describing_no_books(self):
         """GutenbergRDFExtractor can handle an RDF document that doesn't
         describe any books."""
@@ -1,4 +1,5 @@
 import feedparser
+from lxml import etree
 
 from nose.tools import (
     assert_raises,
@@ -7,11 +8,21 @@ from nose.tools import (
 )
 from . import DatabaseTest
 from ..opds import (
+    AllCoverLinksAnnotator,
+    ContentServerAcquisitionFeed,
     ContentServerAnnotator,
     StaticFeedAnnotator,
     StaticCOPPANavigationFeed,
 )
-from ..core.opds import UnfulfillableWork
+from ..core.model import (
+    DataSource,
+    Hyperlink,
+)
+from ..core.opds import (
+    AcquisitionFeed,
+    OPDSFeed,
+    UnfulfillableWork,
+)
 
 class MockStaticLane(object):
 
@@ -42,6 +53,118 @@ class TestAnnotator(DatabaseTest):
             None, None
         )
 
+    def test_prerender_entry(self):
+        work = self._work(with_open_access_download=True)
+        [pool] = work.license_pools
+        work.calculate_opds_entries()
+        cached = etree.fromstring(work.verbose_opds_entry)
+        eq_(False, ContentServerAnnotator.is_prerendered(cached))
+
+        entry = ContentServerAnnotator.prerender_entry(work)
+        eq_(True, ContentServerAnnotator.is_prerendered(entry))
+        cached = etree.fromstring(work.verbose_opds_entry)
+        eq_(True, ContentServerAnnotator.is_prerendered(cached))
+
+        # The annotator leaves a prerendered entry alone, rather than
+        # adding the same links again.
+        before = etree.tostring(cached)
+        ContentServerAnnotator.annotate_work_entry(
+            work, pool, work.presentation_edition, pool.identifier,
+            None, cached
+        )
+        eq_(before, etree.tostring(cached))
+
+        ContentServerAnnotator.forget_prerendered_entry(work)
+        eq_(None, work.verbose_opds_entry)
+
+    def test_prerendered_entry_is_forgotten_when_links_change(self):
+        work = self._work(with_open_access_download=True)
+        [pool] = work.license_pools
+        [link] = [l for l in pool.identifier.links
+                  if l.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD]
+        def prerender():
+            ContentServerAnnotator.prerender_entry(work)
+            self._db.flush()
+            assert ContentServerAnnotator.is_prerendered(
+                etree.fromstring(work.verbose_opds_entry))
+
+        # Until the session is watched, changes to it are left alone.
+        prerender()
+        pool.open_access = False
+        self._db.flush()
+        assert work.verbose_opds_entry is not None
+        pool.open_access = True
+        self._db.flush()
+
+        # Once it's watched, mirroring the book somewhere else clears
+        # the entry.
+        ContentServerAnnotator.watch_session(self._db)
+        prerender()
+        link.resource.representation.mirror_url = self._url
+        self._db.flush()
+        eq_(None, work.verbose_opds_entry)
+
+        # So does a new open-access link.
+        prerender()
+        pool.identifier.add_link(
+            Hyperlink.OPEN_ACCESS_DOWNLOAD, self._url, pool.data_source
+        )
+        self._db.flush()
+        eq_(None, work.verbose_opds_entry)
+
+        # So does a change to the license pool.
+        prerender()
+        pool.open_access = False
+        self._db.flush()
+        eq_(None, work.verbose_opds_entry)
+
+    def test_prerendered_entry_for_unfulfillable_work(self):
+        work = self._work(with_open_access_download=True)
+        [pool] = work.license_pools
+        cached = ContentServerAnnotator.prerender_entry(work)
+
+        # The work's only open-access download stops being available.
+        [link] = [l for l in pool.identifier.links
+                  if l.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD]
+        link.resource.representation.mirror_url = None
+
+        # The prerendered entry still has the old link in it, but the
+        # work can't be shown in a feed.
+        assert_raises(
+            UnfulfillableWork,
+            ContentServerAnnotator.annotate_work_entry,
+            work, pool, work.presentation_edition, pool.identifier,
+            None, cached
+        )
+
+
+class TestContentServerAcquisitionFeed(DatabaseTest):
+
+    def test_prefetch_lists_each_resource_once(self):
+        work = self._work(with_open_access_download=True)
+        [pool] = work.license_pools
+        [link] = [l for l in pool.identifier.links
+                  if l.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD]
+
+        # Another data source links to the same download.
+        staff = DataSource.lookup(self._db, DataSource.LIBRARY_STAFF)
+        pool.identifier.add_link(
+            Hyperlink.OPEN_ACCESS_DOWNLOAD, link.resource.url, staff
+        )
+        eq_(2, len([l for l in pool.identifier.links
+                    if l.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD]))
+
+        links = ContentServerAcquisitionFeed.prefetch(self._db, [work])
+        eq_([link.resource], links[pool.identifier.id])
+
+        # So the work's entry only has one open-access link.
+        feed = ContentServerAcquisitionFeed(
+            self._db, "Downloads", self._url, [work], ContentServerAnnotator()
+        )
+        [entry] = feedparser.parse(unicode(feed)).entries
+        eq_(1, len([l for l in entry.links
+                    if l['rel'] == OPDSFeed.OPEN_ACCESS_REL]))
+
 
 class TestStaticFeedAnnotator(DatabaseTest):
 
@@ -86,6 +209,113 @@ class TestStaticFeedAnnotator(DatabaseTest):
         eq_([w3, w4, w2, w1], result)
 
 
+class MockCover(object):
+
+    def __init__(self, mirrored_path, scaled_path):
+        self.mirrored_path = mirrored_path
+        self.scaled_path = scaled_path
+
+
+class TestAllCoverLinksAnnotator(DatabaseTest):
+
+    def test_cover_lists(self):
+        covers = [
+            MockCover("full1", "thumb1"), MockCover("full2", None),
+            MockCover(None, "thumb3"),
+        ]
+        annotator = AllCoverLinksAnnotator()
+        eq_((["thumb1", "thumb3"], ["full1", "full2"]),
+            annotator._cover_lists(covers))
+
+        # A cover that shows up twice is only linked once.
+        eq_((["thumb1", "thumb3"], ["full1", "full2"]),
+            annotator._cover_lists(covers + covers[:1]))
+
+        # The number of links can be capped.
+        annotator = AllCoverLinksAnnotator(max_cover_links=1)
+        eq_((["thumb1"], ["full1"]), annotator._cover_lists(covers))
+
+    def test_prefetched_covers_are_used(self):
+        work = self._work(with_license_pool=True)
+        annotator = AllCoverLinksAnnotator()
+        annotator.covers_by_work[work.id] = (["thumb"], ["full"])
+        eq_((["thumb"], ["full"]), annotator.cover_links(work))
+
+    def test_prefetch_covers_without_identifiers(self):
+        annotator = AllCoverLinksAnnotator()
+        annotator.prefetch_covers(self._db, [])
+        eq_({}, annotator.covers_by_work)
+
+    def test_prefetch_covers_follows_equivalent_identifiers(self):
+        works = self._works_with_covers()
+
+        # Without prefetching, each work's covers are looked up
+        # separately.
+        expected = dict(
+            (work.id, AllCoverLinksAnnotator().cover_links(work))
+            for work in works
+        )
+
+        annotator = AllCoverLinksAnnotator()
+        annotator.prefetch_covers(self._db, works)
+        eq_(sorted(expected.keys()), sorted(annotator.covers_by_work.keys()))
+        for work in works:
+            thumbnails, full = annotator.covers_by_work[work.id]
+            expected_thumbnails, expected_full = expected[work.id]
+
+            # Each work gets its own cover, its equivalent identifier's
+            # cover, and the cover they share, once.
+            eq_(3, len(full))
+            eq_(sorted(expected_full), sorted(full))
+            eq_(sorted(expected_thumbnails), sorted(thumbnails))
+
+    def test_prefetched_feed_has_the_same_cover_links(self):
+        works = self._works_with_covers()
+
+        def image_links(feed_class):
+            feed = feed_class(
+                self._db, "Covers", self._url, works, AllCoverLinksAnnotator()
+            )
+            parsed = feedparser.parse(unicode(feed))
+            return dict(
+                (entry.id, sorted(
+                    (l['rel'], l['href']) for l in entry.links
+                    if 'image' in l['rel']
+                ))
+                for entry in parsed.entries
+            )
+
+        expected = image_links(AcquisitionFeed)
+        eq_(len(works), len(expected))
+        for links in expected.values():
+            eq_(6, len(links))
+        eq_(expected, image_links(ContentServerAcquisitionFeed))
+
+    def _works_with_covers(self):
+        """Make two open-access works, each with a cover, an equivalent
+        identifier with a cover, and a cover that both identifiers
+        share.
+        """
+        source = DataSource.lookup(self._db, DataSource.GUTENBERG)
+        works = []
+        for i in range(2):
+            work = self._work(with_open_access_download=True)
+            primary = work.license_pools[0].identifier
+            equivalent = self._identifier()
+            primary.equivalent_to(source, equivalent, 1)
+
+            shared_url = self._url
+            for identifier in (primary, equivalent):
+                for url in (self._url, shared_url):
+                    link, ignore = identifier.add_link(
+                        Hyperlink.IMAGE, url, source
+                    )
+                    link.resource.mirrored_path = url + "/full"
+                    link.resource.scaled_path = url + "/thumbnail"
+            works.append(work)
+        return works
+
+
 class TestStaticCOPPANavigationFeed(object):
 
     def test_feed(self):
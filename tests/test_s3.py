@@ -1,4 +1,6 @@
 import contextlib
+import hashlib
+import tempfile
 from nose.tools import (
     set_trace,
     eq_
@@ -10,7 +12,10 @@ from ..config import (
     Configuration,
     temp_config as core_temp_config
 )
-from ..s3 import S3Uploader
+from ..s3 import (
+    DummyS3Uploader,
+    S3Uploader,
+)
 
 class TestS3URLGeneration(DatabaseTest):
 
@@ -20,3 +25,44 @@ class TestS3URLGeneration(DatabaseTest):
 
         eq_('http://s3.amazonaws.com/test.feed.bucket/my_file.banana',
             S3Uploader.feed_url('test.feed.bucket', 'my_file', extension='banana'))
+
+
+class TestMirrorIfChanged(DatabaseTest):
+
+    def test_checksum(self):
+        representation, ignore = self._representation(content="Some content")
+        eq_(hashlib.md5("Some content").hexdigest(),
+            S3Uploader.checksum(representation))
+
+        # A local file is read in chunks.
+        local = tempfile.NamedTemporaryFile()
+        local.write("Local content")
+        local.flush()
+        representation.local_content_path = local.name
+        class TinyChunks(S3Uploader):
+            CHECKSUM_CHUNK_SIZE = 3
+        eq_(hashlib.md5("Local content").hexdigest(),
+            TinyChunks.checksum(representation))
+
+        # A missing file has no checksum.
+        representation.local_content_path = "/no/such/file"
+        eq_(None, S3Uploader.checksum(representation))
+
+    def test_mirror_batch_if_changed(self):
+        uploader = DummyS3Uploader()
+        unchanged, ignore = self._representation(content="Same")
+        unchanged.mirror_url = self._url
+        changed, ignore = self._representation(content="New")
+        changed.mirror_url = self._url
+        new, ignore = self._representation(content="Brand new")
+        new.mirror_url = self._url
+
+        uploader.etags[unchanged.mirror_url] = hashlib.md5("Same").hexdigest()
+        uploader.etags[changed.mirror_url] = hashlib.md5("Old").hexdigest()
+
+        uploaded = uploader.mirror_batch_if_changed([unchanged, changed, new])
+        eq_([changed, new], uploaded)
+        eq_([changed, new], uploader.uploaded)
+
+        # The unchanged representation still counts as mirrored.
+        assert unchanged.mirrored_at
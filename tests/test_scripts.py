@@ -10,7 +10,9 @@ from nose.tools import (
 )
 from os import path
 
+from sqlalchemy import event
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm.session import Session
 
 from . import DatabaseTest
 
@@ -38,7 +40,10 @@ from ..config import (
     Configuration,
     temp_config,
 )
-from ..lanes import StaticFeedBaseLane
+from ..lanes import (
+    PrefetchedPagination,
+    StaticFeedBaseLane,
+)
 from ..opds import StaticFeedAnnotator
 from ..s3 import DummyS3Uploader
 from ..scripts import (
@@ -46,6 +51,7 @@ from ..scripts import (
     CustomListUploadScript,
     CustomListFeedGenerationScript,
     DirectoryImportScript,
+    GutenbergEPUBIndexScript,
     OPDSImportScript,
     StaticFeedGenerationScript,
     StaticFeedCSVExportScript,
@@ -70,6 +76,22 @@ class TestDirectoryImportScript(DatabaseTest):
         eq_(DataSource.PLYMPTON, collection.data_source.name)
 
 
+class TestGutenbergEPUBIndexScript(DatabaseTest):
+
+    def test_changed_ids(self):
+        rsync_output = [
+            "receiving incremental file list\n",
+            "10/\n",
+            "10/pg10-images.epub\n",
+            "deleting 11/pg11.epub\n",
+            "12345/pg12345.epub\n",
+            "\n",
+            "sent 1,234 bytes  received 5,678 bytes\n",
+        ]
+        eq_(set(["10", "11", "12345"]),
+            GutenbergEPUBIndexScript.changed_ids(rsync_output))
+
+
 class TestOPDSImportScript(DatabaseTest):
 
     def test_create_collections(self):
@@ -504,6 +526,421 @@ class TestStaticFeedGenerationScript(DatabaseTest):
         eq_(first_link.href, first)
         eq_([], links_by_rel(parsed, 'next'))
 
+    def test_create_feed_pages_single_query(self):
+        works = [self._work(with_open_access_download=True) for i in range(3)]
+        identifiers = [w.license_pools[0].identifier for w in works]
+        lane = StaticFeedBaseLane(
+            self._db, self.library, identifiers,
+            StaticFeedAnnotator.TOP_LEVEL_LANE_NAME
+        )
+        facet = Facets(
+            None, 'main', 'always', 'author',
+            enabled_facets=self.script.DEFAULT_ENABLED_FACETS
+        )
+        annotator = StaticFeedAnnotator('https://ls.org', lane)
+
+        def summary(pages):
+            result = []
+            for page in pages:
+                parsed = feedparser.parse(page)
+                links = sorted(
+                    (l['rel'], l['href']) for l in parsed.feed.links
+                    if l['rel'] in ('next', 'previous', 'first')
+                )
+                result.append(([e.title for e in parsed.entries], links))
+            return result
+
+        paged = self.script.create_feed_pages(
+            lane, Pagination(size=2), 'https://ls.org', annotator, facet
+        )
+        single_query = self.script.create_feed_pages(
+            lane, Pagination(size=2), 'https://ls.org', annotator, facet,
+            single_query=True
+        )
+
+        # Both ways give the same pages, with the same links.
+        eq_(2, len(single_query))
+        eq_(summary(paged), summary(single_query))
+
+    def test_prefetched_pagination(self):
+        pagination = PrefetchedPagination(range(5), size=2)
+        eq_([0, 1], pagination.page_works)
+        eq_(True, pagination.has_next_page)
+
+        last = pagination.next_page.next_page
+        eq_([4], last.page_works)
+        eq_(4, last.offset)
+        eq_(False, last.has_next_page)
+
+    def test_load_uploads_only_changed_files(self):
+        bucket = 'test.feed.bucket'
+        def url(filename):
+            return self.uploader.feed_url(bucket, filename)
+
+        feeds = [('index', [u'one', u'two']), ('index_author', [u'three'])]
+        self.script.load(feeds, uploader=self.uploader, bucket=bucket)
+        eq_(sorted([url('index'), url('index_2'), url('index_author')]),
+            sorted(r.mirror_url for r in self.uploader.uploaded))
+
+        # Nothing has changed, so nothing is uploaded.
+        self.uploader = DummyS3Uploader()
+        self.script.load(feeds, uploader=self.uploader, bucket=bucket)
+        eq_([], self.uploader.uploaded)
+
+        # Only the changed page is uploaded, and the feed that's gone
+        # is deleted, along with its Representation.
+        self.uploader = DummyS3Uploader()
+        feeds = [('index', [u'one', u'TWO'])]
+        self.script.load(feeds, uploader=self.uploader, bucket=bucket)
+        eq_([url('index_2')], [r.mirror_url for r in self.uploader.uploaded])
+        eq_([url('index_author')], self.uploader.deleted)
+        eq_([], self._db.query(Representation).filter(
+            Representation.mirror_url==url('index_author')).all())
+
+        # A different prefix has its own manifest.
+        self.uploader = DummyS3Uploader()
+        self.script.load(
+            feeds, uploader=self.uploader, bucket=bucket, prefix='demo/')
+        eq_(2, len(self.uploader.uploaded))
+        eq_([], self.uploader.deleted)
+
+        # Everything can be uploaded again if necessary.
+        self.uploader = DummyS3Uploader()
+        self.script.load(
+            feeds, uploader=self.uploader, bucket=bucket, reupload=True)
+        eq_(2, len(self.uploader.uploaded))
+
+    def test_load_keeps_files_that_failed_to_upload(self):
+        bucket = 'test.feed.bucket'
+        def url(filename):
+            return self.uploader.feed_url(bucket, filename)
+        manifest = self.script.manifest_setting(bucket)
+
+        self.script.load(
+            [('index', [u'one', u'two'])], uploader=self.uploader, bucket=bucket
+        )
+        old_hashes = json.loads(manifest.value)
+
+        # A changed file and a new file both fail to upload.
+        feeds = [('index', [u'one', u'TWO', u'three'])]
+        failing = FailingS3Uploader([url('index_2'), url('index_3')])
+        self.script.load(feeds, uploader=failing, bucket=bucket)
+        eq_([], failing.uploaded)
+
+        # The file that's still in S3 isn't deleted, and the manifest
+        # still has the hash of what's in it. The new file isn't in
+        # the manifest at all.
+        eq_([], failing.deleted)
+        eq_(old_hashes, json.loads(manifest.value))
+        representation = self._db.query(Representation).filter(
+            Representation.mirror_url==url('index_2')).one()
+        eq_(u"S3 is down", representation.mirror_exception)
+
+        # Next time, both files are uploaded again.
+        self.uploader = DummyS3Uploader()
+        self.script.load(feeds, uploader=self.uploader, bucket=bucket)
+        eq_(sorted([url('index_2'), url('index_3')]),
+            sorted(r.mirror_url for r in self.uploader.uploaded))
+        eq_(['index', 'index_2', 'index_3'],
+            sorted(json.loads(manifest.value).keys()))
+
+    def test_load_skips_rerendered_feeds_that_havent_changed(self):
+        works = [self._work(with_open_access_download=True) for i in range(2)]
+        identifiers = [w.license_pools[0].identifier for w in works]
+        lane = StaticFeedBaseLane(
+            self._db, self.library, identifiers,
+            StaticFeedAnnotator.TOP_LEVEL_LANE_NAME
+        )
+        annotator = StaticFeedAnnotator('https://ls.org', lane)
+        bucket = 'test.feed.bucket'
+        def render():
+            return list(self.script.create_feeds([lane], annotator, page_size=1))
+
+        first = render()
+        self.script.load(first, uploader=self.uploader, bucket=bucket)
+        eq_(4, len(self.uploader.uploaded))
+
+        # Each page has a feed-level timestamp that's different every
+        # time it's rendered. It isn't part of the page's hash.
+        page = first[0][1][0]
+        restamped = self.script.FEED_UPDATED.sub(
+            u'<updated>2001-01-01T00:00:00Z</updated>', page, count=1
+        )
+        assert restamped != page
+        eq_(self.script.content_hash(page),
+            self.script.content_hash(restamped))
+
+        # So rendering the same works again doesn't upload anything.
+        self.uploader = DummyS3Uploader()
+        self.script.load(render(), uploader=self.uploader, bucket=bucket)
+        eq_([], self.uploader.uploaded)
+        eq_([], self.uploader.deleted)
+
+    def test_load_uploads_pages_as_they_are_rendered(self):
+        bucket = 'test.feed.bucket'
+        self.script.UPLOAD_BATCH_SIZE = 2
+
+        # Keep track of how many files had been uploaded when each
+        # page was rendered.
+        uploaded_before = list()
+        def pages(name, count):
+            for i in range(count):
+                uploaded_before.append(len(self.uploader.uploaded))
+                yield u'%s page %d' % (name, i)
+
+        feeds = (feed for feed in [
+            ('index', pages('index', 3)),
+            ('index_author', pages('index_author', 2)),
+        ])
+        self.script.load(feeds, uploader=self.uploader, bucket=bucket)
+
+        # The pages were uploaded two at a time, while the rest of the
+        # feeds were still waiting to be rendered.
+        eq_([0, 0, 2, 2, 4], uploaded_before)
+        eq_(5, len(self.uploader.uploaded))
+        manifest = self.script.manifest_setting(bucket)
+        eq_(['index', 'index_2', 'index_3', 'index_author', 'index_author_2'],
+            sorted(json.loads(manifest.value).keys()))
+
+    def test_load_doesnt_expire_prefetched_works(self):
+        works = [self._work(with_open_access_download=True) for i in range(3)]
+        identifiers = [w.license_pools[0].identifier for w in works]
+        lane = StaticFeedBaseLane(
+            self._db, self.library, identifiers,
+            StaticFeedAnnotator.TOP_LEVEL_LANE_NAME
+        )
+        annotator = StaticFeedAnnotator('https://ls.org', lane)
+        bucket = 'test.feed.bucket'
+        self.script.single_query = True
+        self.script.UPLOAD_BATCH_SIZE = 1
+        self._db.commit()
+
+        # Keep track of the statements run to render each page.
+        statements = list()
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        rendered = list()
+        def pages(feed_pages):
+            feed_pages = iter(feed_pages)
+            while True:
+                del statements[:]
+                try:
+                    page = next(feed_pages)
+                except StopIteration:
+                    return
+                rendered.append(list(statements))
+                yield page
+        feeds = self.script.create_feeds(
+            [lane], annotator, page_size=1, stream=True
+        )
+
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", record)
+        try:
+            self.script.load(
+                ((filename, pages(feed_pages))
+                 for filename, feed_pages in feeds),
+                uploader=self.uploader, bucket=bucket
+            )
+        finally:
+            event.remove(connection, "before_cursor_execute", record)
+
+        # Every page was uploaded, and committed, before the next one
+        # was rendered.
+        eq_(6, len(self.uploader.uploaded))
+        eq_(True, self._db.expire_on_commit)
+
+        # Each feed's works were loaded along with its first page, and
+        # weren't loaded again for the pages after a commit.
+        eq_(6, len(rendered))
+        for page_statements in rendered[1:3] + rendered[4:6]:
+            eq_([], [s for s in page_statements
+                     if 'FROM works' in s or 'FROM editions' in s])
+
+    def test_feed_units(self):
+        works = [self._work(with_open_access_download=True) for i in range(2)]
+        identifiers = [w.license_pools[0].identifier for w in works]
+        lane = StaticFeedBaseLane(
+            self._db, self.library, identifiers,
+            StaticFeedAnnotator.TOP_LEVEL_LANE_NAME
+        )
+        annotator = StaticFeedAnnotator('https://ls.org')
+
+        units = list(self.script.feed_units([lane], annotator, page_size=1))
+        eq_(['index', 'index_author'], [unit[0] for unit in units])
+        for filename, unit_lane, url, facets, pagination in units:
+            eq_(lane, unit_lane)
+            eq_('https://ls.org/index.xml', url)
+            eq_(1, pagination.size)
+        eq_([Facets.ORDER_TITLE, Facets.ORDER_AUTHOR],
+            [unit[3].order for unit in units])
+
+        # Rendering the units one at a time gives the same feeds as
+        # create_feeds().
+        rendered = [self.script.render_feed_unit(unit, annotator)
+                    for unit in units]
+        eq_(2, len(rendered[0][1]))
+        created = list(self.script.create_feeds([lane], annotator, page_size=1))
+        eq_([(f, len(pages)) for f, pages in rendered],
+            [(f, len(pages)) for f, pages in created])
+
+    def test_worker_renders_the_same_feeds(self):
+        works = [self._work(with_open_access_download=True) for i in range(3)]
+        identifiers = [w.license_pools[0].identifier for w in works]
+        lane = StaticFeedBaseLane(
+            self._db, self.library, identifiers,
+            StaticFeedAnnotator.TOP_LEVEL_LANE_NAME
+        )
+        annotator = StaticFeedAnnotator('https://ls.org', lane)
+        units = list(self.script.feed_units([lane], annotator, page_size=2))
+        serial = [self.script.render_feed_unit(unit, annotator)
+                  for unit in units]
+        self._db.flush()
+
+        # Do what each worker process does when it starts. The test
+        # data is only visible inside this test's transaction, so the
+        # worker's session has to use the same connection.
+        parent_session = self._db
+        connection = self._db.connection()
+        self.script.worker_session = lambda: Session(bind=connection)
+        self.script.start_worker(units, annotator)
+        worker_session = self.script._db
+        assert worker_session is not parent_session
+
+        # The lane and the library are in the worker's session now,
+        # and nothing can be loaded through the parent's session.
+        parent_session.expunge_all()
+        for identifier in lane.identifiers:
+            eq_(worker_session, Session.object_session(identifier))
+        eq_(worker_session, Session.object_session(self.script.library))
+        eq_(self.library.id, self.script.library.id)
+
+        # The worker renders the same feeds, apart from the feed-level
+        # timestamps.
+        in_worker = [self.script.render_feed_unit(unit, annotator)
+                     for unit in units]
+        def hashes(rendered):
+            return [(filename, [self.script.content_hash(p) for p in pages])
+                    for filename, pages in rendered]
+        eq_(['index', 'index_author'], [filename for filename, p in serial])
+        eq_(2, len(serial[0][1]))
+        eq_(hashes(serial), hashes(in_worker))
+
+    def test_load_index(self):
+        works = [self._work(with_open_access_download=True) for i in range(5)]
+        # A work without an open-access license pool isn't indexed.
+        self._work()
+
+        search_client = MockSearchClient()
+        self.script.load_index(search_client, self._db.query(Work), chunk_size=2)
+
+        # The documents were sent two at a time.
+        eq_([2, 2, 1], [len(chunk) for chunk in search_client.chunks])
+        documents = [doc for chunk in search_client.chunks for doc in chunk]
+        for doc in documents:
+            eq_('works', doc['_index'])
+            eq_('work-type', doc['_type'])
+            assert 'open-access' in doc['opds_entry']
+
+        # The same documents are sent when the chunks are sent from
+        # several threads at once.
+        threaded_client = MockSearchClient()
+        self.script.load_index(
+            threaded_client, self._db.query(Work), chunk_size=2, threads=2
+        )
+        eq_([1, 2, 2], sorted(len(chunk) for chunk in threaded_client.chunks))
+        eq_(sorted(doc['opds_entry'] for doc in documents),
+            sorted(doc['opds_entry'] for chunk in threaded_client.chunks
+                   for doc in chunk))
+
+    def test_bulk_index(self):
+        search_client = MockSearchClient(failing_chunk=1)
+        chunks = [[dict(id=i)] * (i+1) for i in range(5)]
+
+        # Each chunk's result is reported separately, and in order,
+        # whether or not the chunks are sent at the same time.
+        for threads in (None, 3):
+            results = list(self.script.bulk_index(
+                search_client, iter(chunks), threads=threads
+            ))
+            eq_([(1, []), (0, ['error']), (3, []), (4, []), (5, [])],
+                results)
+
+
+class FailingS3Uploader(DummyS3Uploader):
+
+    """Pretends that uploads to certain mirror URLs fail."""
+
+    def __init__(self, failing_urls):
+        super(FailingS3Uploader, self).__init__()
+        self.failing_urls = failing_urls
+
+    def mirror_batch(self, representations):
+        for representation in representations:
+            if representation.mirror_url in self.failing_urls:
+                representation.mirror_exception = u"S3 is down"
+                representation.mirrored_at = None
+            else:
+                self.uploaded.append(representation)
+                representation.set_as_mirrored()
+
+
+class MockSearchClient(object):
+
+    works_index = 'works'
+    work_document_type = 'work-type'
+
+    def __init__(self, failing_chunk=None):
+        self.chunks = []
+        self.failing_chunk = failing_chunk
+
+    def bulk(self, docs, raise_on_error=True, raise_on_exception=True):
+        eq_(False, raise_on_error)
+        eq_(False, raise_on_exception)
+        self.chunks.append(docs)
+        if docs and docs[0].get('id') == self.failing_chunk:
+            return 0, ['error']
+        return len(docs), []
+
+
+class MockLane(object):
+
+    def __init__(self, name, sublanes=None):
+        self.name = name
+        self.sublanes = sublanes or []
+        self._db = None
+
+
+class MockWorkerScript(StaticFeedGenerationScript):
+
+    def worker_session(self):
+        return "worker session"
+
+    def render_feed_unit(self, unit, annotator):
+        filename, lane = unit[:2]
+        return filename, [u"%s|%s|%d" % (filename, lane._db, os.getpid())]
+
+
+class TestStaticFeedWorkerPool(object):
+
+    def test_render_in_pool(self):
+        script = MockWorkerScript()
+        units = [("feed%d" % i, MockLane("Lane %d" % i), None, None, None)
+                 for i in range(6)]
+        results = list(script.render_in_pool(units, None, 2))
+
+        # The feeds come back in order, no matter which worker
+        # rendered them.
+        eq_(["feed%d" % i for i in range(6)], [r[0] for r in results])
+        for filename, [page] in results:
+            rendered_filename, session, pid = page.split("|")
+            eq_(filename, rendered_filename)
+
+            # Each feed was rendered in a worker process, using the
+            # worker's own session.
+            eq_("worker session", session)
+            assert int(pid) != os.getpid()
+
 
 class TestCustomListFeedGenerationScript(DatabaseTest):
 